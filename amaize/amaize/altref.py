@@ -0,0 +1,117 @@
+"""Build an alternate reference by applying SNPs to a copy of a genome."""
+
+import argparse
+import itertools
+import mmap
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+from amaize import faindex, vcf
+from amaize.fasta import Fasta
+
+HOMOZYGOUS_ALT = {b"1/1", b"1|1"}
+
+
+def snps(path):
+    """Yield (contig, position, ref, alt) of the SNPs to apply from a vcf.
+
+    Only unfiltered single base substitutions are applied and, if the vcf
+    has samples, only those homozygous for the alternate allele in the first
+    sample. Positions are 0-based.
+    """
+    with vcf.openVcf(path) as records:
+        for line in records:
+            if line.startswith(b"#"):
+                continue
+            fields = line.rstrip(b"\r\n").split(b"\t")
+            contig, pos, _, ref, alt, _, filters = fields[:7]
+            if filters not in (b"PASS", b".") or len(ref) != 1 or \
+                    len(alt) != 1 or alt in (b"*", b".", b"N"):
+                continue
+            if len(fields) > 9:
+                keys = fields[8].split(b":")
+                if b"GT" not in keys or fields[9].split(b":")[
+                        keys.index(b"GT")] not in HOMOZYGOUS_ALT:
+                    continue
+            yield contig.decode(), int(pos) - 1, ref, alt
+
+
+def applySnps(job):
+    """Write the SNPs of one contig into the mapped copy of the genome.
+
+    Each base is only replaced if it matches the ref allele, keeping its
+    case. Returns the contig, and the number applied and mismatched.
+    """
+    out, entry, positions, refs, alts = job
+    contig, _, offset, lineBases, lineWidth = entry
+    offsets = offset + positions // lineBases * lineWidth + \
+        positions % lineBases
+    with open(out, 'r+b') as fasta, \
+            mmap.mmap(fasta.fileno(), 0) as genome:
+        bases = np.frombuffer(genome, dtype=np.uint8)
+        current = bases[offsets]
+        matches = (current & 0xDF) == (refs & 0xDF)
+        bases[offsets[matches]] = ((alts[matches] & 0xDF) |
+                                   (current[matches] & 0x20))
+        del bases
+        genome.flush()
+    return contig, int(matches.sum()), int((~matches).sum())
+
+
+def contigJobs(out, fasta, variants):
+    """Group the SNPs of a vcf sorted by contig into one job per contig."""
+    for contig, group in itertools.groupby(variants, key=lambda snp: snp[0]):
+        if contig not in fasta.index:
+            raise ValueError(f"Contig {contig} is not in the reference")
+        _, positions, refs, alts = zip(*group)
+        yield (out, fasta.index[contig], np.array(positions, dtype=np.int64),
+               np.frombuffer(b"".join(refs), dtype=np.uint8),
+               np.frombuffer(b"".join(alts), dtype=np.uint8))
+
+
+def buildAltRef(reference, variants, out, processes=1):
+    """Write reference with the SNPs of the variants vcf applied to out.
+
+    The copy keeps the names and line layout of the reference, so its .fai
+    is that of the reference. The vcf is streamed a contig at a time, each
+    contig being patched in place by one of processes workers, and the .fai
+    and .dict of the copy are then written in one pass over it.
+    """
+    with Fasta(reference) as fasta:
+        shutil.copyfile(reference, out)
+        shutil.copyfile(f"{reference}.fai", f"{out}.fai")
+        with multiprocessing.Pool(processes) as pool:
+            results = list(pool.imap_unordered(
+                applySnps, contigJobs(out, fasta, snps(variants))))
+    faindex.index(out, processes)
+    applied = sum(result[1] for result in results)
+    mismatched = sum(result[2] for result in results)
+    print(f"Applied {applied} SNPs to {len(results)} contigs of {out}")
+    if mismatched:
+        print(f"Skipped {mismatched} SNPs whose ref allele does not match "
+              "the reference")
+    return applied, mismatched
+
+
+def main():
+    """Parse the command line and build the alternate reference."""
+    parser = argparse.ArgumentParser(
+        description=('Build an alternate reference by applying the '
+                     'homozygous SNPs of a vcf to a genome'))
+    parser.add_argument('reference', help='The reference genome')
+    parser.add_argument('vcf', help='The filtered SNP vcf, sorted by contig')
+    parser.add_argument('out', help='The alternate reference to write')
+    parser.add_argument(
+        '-p', '--processes',
+        help='Number of contigs patched at once. Default: all cpus',
+        type=int,
+        default=len(os.sched_getaffinity(0)))
+    args = parser.parse_args()
+    buildAltRef(args.reference, args.vcf, args.out, args.processes)
+
+
+if __name__ == "__main__":
+    main()
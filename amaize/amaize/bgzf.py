@@ -0,0 +1,247 @@
+"""Blocked gzip (BGZF) files, compressed and decompressed on thread pools.
+
+BGZF is a series of gzip members each holding at most 64 KiB, whose
+headers record their compressed size. It reads as plain gzip, and lets
+samtools, tabix and htslib seek into a file without decompressing all of
+it. Because the blocks are independent, a run of them can be compressed or
+decompressed by each of a pool of threads, zlib releasing the GIL.
+"""
+
+import builtins
+import collections
+import concurrent.futures
+import gzip
+import io
+import struct
+import zlib
+
+BLOCK_DATA = 65280
+BATCH_BLOCKS = 16
+HEADER = struct.Struct("<4BI2BH2BHH")
+FOOTER = struct.Struct("<II")
+EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003"
+                    "000000000000000000")
+
+
+def compressBlock(data, level=6):
+    """Return data of at most BLOCK_DATA bytes as one BGZF block.
+
+    Data that does not shrink enough to fit a block is stored instead.
+    """
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = deflate.compress(data) + deflate.flush()
+    if HEADER.size + len(body) + FOOTER.size > 65536:
+        deflate = zlib.compressobj(0, zlib.DEFLATED, -15)
+        body = deflate.compress(data) + deflate.flush()
+    size = HEADER.size + len(body) + FOOTER.size
+    return (HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, size - 1) +
+            body + FOOTER.pack(zlib.crc32(data), len(data)))
+
+
+def compress(data, level=6):
+    """Return data as BGZF blocks, without the end of file marker.
+
+    Outputs of compress concatenate into a BGZF file once EOF is written
+    after the last of them.
+    """
+    return b"".join(compressBlock(data[start:start + BLOCK_DATA], level)
+                    for start in range(0, len(data), BLOCK_DATA))
+
+
+def blockSize(header):
+    """Return the size of the BGZF block starting with header, else None.
+
+    header is the fixed gzip header and extra field of the block.
+    """
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        return None
+    extra = header[12:12 + struct.unpack("<H", header[10:12])[0]]
+    while len(extra) >= 4:
+        length = struct.unpack("<H", extra[2:4])[0]
+        if extra[:2] == b"BC" and length == 2:
+            return struct.unpack("<H", extra[4:6])[0] + 1
+        extra = extra[4 + length:]
+    return None
+
+
+def isBgzf(path):
+    """Return whether path starts with a BGZF block."""
+    with builtins.open(path, 'rb') as file:
+        return blockSize(file.read(HEADER.size)) is not None
+
+
+def rawBlocks(file):
+    """Yield the compressed blocks of a BGZF file in order."""
+    while True:
+        header = file.read(12)
+        if not header:
+            return
+        header += file.read(struct.unpack("<H", header[10:12])[0]
+                            if len(header) == 12 else 0)
+        size = blockSize(header)
+        if size is None:
+            raise ValueError(f"{file.name} is not a BGZF file")
+        block = header + file.read(size - len(header))
+        if len(block) != size:
+            raise EOFError(f"{file.name} ends within a BGZF block")
+        yield block
+
+
+def decompressBatch(blocks):
+    """Return the data of a batch of BGZF blocks."""
+    return b"".join(zlib.decompress(block, 31) for block in blocks)
+
+
+def batches(blocks, count):
+    """Yield lists of count blocks, the last may hold fewer."""
+    batch = []
+    for block in blocks:
+        batch.append(block)
+        if len(batch) == count:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Reader(io.RawIOBase):
+    """Read a BGZF file, decompressing batches of blocks on threads.
+
+    Batches are decompressed ahead of the reader, at most 2 * threads at a
+    time, and handed out in file order.
+    """
+
+    def __init__(self, path, threads=4):
+        self.file = builtins.open(path, 'rb')
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.window = 2 * threads
+        self.batches = batches(rawBlocks(self.file), BATCH_BLOCKS)
+        self.pending = collections.deque()
+        self.rest = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def nextBatch(self):
+        """Return the data of the next batch, b"" at the end of the file."""
+        for batch in self.batches:
+            self.pending.append(self.pool.submit(decompressBatch, batch))
+            if len(self.pending) >= self.window:
+                break
+        return self.pending.popleft().result() if self.pending else b""
+
+    def readinto(self, buffer):
+        while not self.rest:
+            self.rest = memoryview(self.nextBatch())
+            if not self.rest:
+                return 0
+        size = min(len(buffer), len(self.rest))
+        buffer[:size] = self.rest[:size]
+        self.rest = self.rest[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(cancel_futures=True)
+            self.file.close()
+        super().close()
+
+
+class Writer(io.RawIOBase):
+    """Write a BGZF file, compressing batches of blocks on threads.
+
+    Written data is cut into batches of BATCH_BLOCKS blocks, compressed by
+    a pool of threads and written in order, at most 2 * threads batches
+    being held at once. Closing writes the last batch and the end of file
+    marker.
+    """
+
+    def __init__(self, path, threads=4, level=6):
+        self.file = builtins.open(path, 'wb')
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.window = 2 * threads
+        self.level = level
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def submit(self, data):
+        """Compress data on the pool, writing out the oldest batches done."""
+        self.pending.append(self.pool.submit(compress, data, self.level))
+        while len(self.pending) >= self.window or \
+                (self.pending and self.pending[0].done()):
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        size = BATCH_BLOCKS * BLOCK_DATA
+        if len(self.buffer) >= size:
+            whole = len(self.buffer) // size * size
+            for start in range(0, whole, size):
+                self.submit(bytes(self.buffer[start:start + size]))
+            del self.buffer[:whole]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.buffer:
+                    self.submit(bytes(self.buffer))
+                while self.pending:
+                    self.file.write(self.pending.popleft().result())
+                self.file.write(EOF)
+            finally:
+                self.pool.shutdown()
+                self.file.close()
+        super().close()
+
+
+def open(path, mode='rb', threads=4, level=6):
+    """Open a BGZF file as bytes, buffered like gzip.open.
+
+    Writing always makes BGZF. A gzip file that is not BGZF is read with
+    gzip.open, on one thread.
+    """
+    if mode in ('w', 'wb'):
+        return io.BufferedWriter(Writer(path, threads, level))
+    if mode not in ('r', 'rb'):
+        raise ValueError(f"Invalid mode {mode}, BGZF files are bytes")
+    if not isBgzf(path):
+        return gzip.open(path, 'rb')
+    return io.BufferedReader(Reader(path, threads), BLOCK_DATA)
+
+
+def compressFile(path, out, threads=4, level=6):
+    """Compress the plain file at path into the BGZF out."""
+    with builtins.open(path, 'rb') as plain, open(out, 'wb', threads,
+                                                  level) as compressed:
+        while True:
+            data = plain.read(BATCH_BLOCKS * BLOCK_DATA)
+            if not data:
+                break
+            compressed.write(data)
+
+
+def concatenate(parts, out, size=16 * 1024 * 1024):
+    """Join BGZF parts into out with one end of file marker.
+
+    The marker of each part is dropped, so the join reads as one file.
+    """
+    with builtins.open(out, 'wb') as joined:
+        for part in parts:
+            with builtins.open(part, 'rb') as blocks:
+                blocks.seek(0, io.SEEK_END)
+                end = blocks.tell()
+                blocks.seek(max(end - len(EOF), 0))
+                if blocks.read() == EOF:
+                    end -= len(EOF)
+                blocks.seek(0)
+                while end > 0:
+                    data = blocks.read(min(size, end))
+                    if not data:
+                        break
+                    joined.write(data)
+                    end -= len(data)
+        joined.write(EOF)
@@ -0,0 +1,250 @@
+"""Cache of completed pipeline steps keyed on their inputs, script and args.
+
+Each cached step has a small json manifest next to its first output holding
+the key it was run with and fingerprints of the outputs it made. A running
+step records its manifest as its last command, once all its outputs exist,
+unless one of its commands failed.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+BLOCK = 64 * 1024
+# lines ending a script that summarize its job rather than doing its step
+SUMMARIES = {"", "report", "sreport", "source .bashrc"}
+STATUS = """
+amaize_status=0
+trap 'amaize_status=$?' ERR
+"""
+RECORD = """
+python -m amaize.cache record -s "$amaize_status" {spec} > /dev/null"""
+EXIT = """
+exit "$amaize_status"
+"""
+
+
+def fingerprint(path, blocks=0):
+    """Return the size and mtime of path, and a hash of blocks spread over it.
+
+    Hashing a few blocks sampled evenly across the file catches content
+    changes that keep the size and mtime, without reading the whole file.
+    """
+    stat = os.stat(path)
+    prints = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if blocks:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as sampled:
+            for block in range(blocks):
+                sampled.seek(stat.st_size * block // blocks)
+                digest.update(sampled.read(BLOCK))
+        prints["hash"] = digest.hexdigest()
+    return prints
+
+
+def manifestPath(pipeline, step, outputs):
+    """Return the manifest path of a step, next to its first output."""
+    return os.path.join(os.path.dirname(min(outputs)),
+                        f".{pipeline}_{step}.cache.json")
+
+
+def load(manifest):
+    """Return the entry recorded in a manifest, or None."""
+    try:
+        with open(manifest) as entry:
+            return json.load(entry)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save(manifest, entry):
+    """Atomically write an entry to a manifest."""
+    partial = f"{manifest}.{os.getpid()}"
+    with open(partial, 'w') as out:
+        json.dump(entry, out, indent=1, sort_keys=True)
+    os.replace(partial, manifest)
+
+
+def inputPrints(inputs, producers, blocks):
+    """Fingerprint the inputs, or return None if any cannot be.
+
+    An input that has since been removed as an intermediate file takes the
+    fingerprint its producer recorded in its manifest.
+    """
+    prints = {}
+    for path in sorted(inputs):
+        if os.path.exists(path):
+            prints[path] = fingerprint(path, blocks)
+            continue
+        entry = load(producers[path]) if path in producers else None
+        if not entry or path not in entry["outputs"]:
+            return None
+        prints[path] = entry["outputs"][path]
+    return prints
+
+
+def stepKey(script, args, prints):
+    """Return the key of a step run with script and args on its inputs."""
+    return hashlib.sha256(json.dumps(
+        [script, list(args), prints], sort_keys=True).encode()).hexdigest()
+
+
+def valid(manifest, script, args, inputs, outputs, producers, intermediates,
+          blocks=0):
+    """Return True if the step recorded in manifest need not be rerun.
+
+    Its key must match the current inputs, script and args and its outputs
+    must be unchanged, although intermediates may have been removed since.
+    """
+    entry = load(manifest)
+    if not entry:
+        return False
+    prints = inputPrints(inputs, producers, blocks)
+    if prints is None or stepKey(script, args, prints) != entry["key"]:
+        return False
+    for output in outputs:
+        if os.path.exists(output):
+            if fingerprint(output, blocks) != entry["outputs"].get(output):
+                return False
+        elif output not in intermediates:
+            return False
+    entry["used"] = time.time()
+    save(manifest, entry)
+    return True
+
+
+def writeSpec(manifest, script, args, inputs, outputs, producers, blocks=0):
+    """Write what record needs to know about a submitted step."""
+    spec = f"{manifest}.spec"
+    save(spec, {"manifest": manifest, "script": script, "args": list(args),
+                "inputs": sorted(inputs), "outputs": sorted(outputs),
+                "producers": producers, "blocks": blocks})
+    return spec
+
+
+def recording(script, spec=None):
+    """Return script exiting with the status of its step, recording it.
+
+    The status of the last command of the step to fail, as set -e would
+    see it, is kept from after the #SBATCH headers up to the summaries the
+    script ends with. The job exits with it, so steps after it do not run
+    on a failed step, and with a spec the step is recorded only if it is 0.
+    """
+    lines = script.splitlines(keepends=True)
+    first = max((i for i, line in enumerate(lines)
+                 if line.startswith("#SBATCH")), default=0) + 1
+    last = len(lines)
+    while last > first and lines[last - 1].strip() in SUMMARIES:
+        last -= 1
+    return "".join(lines[:first] + [STATUS] + lines[first:last] +
+                   ["trap - ERR\n"] + lines[last:] +
+                   [RECORD.format(spec=spec) if spec else ""] + [EXIT])
+
+
+def record(spec, status=0):
+    """Record the step described by spec if it exited with status 0.
+
+    All of its outputs must exist, as one a failed step left behind is
+    never recorded.
+    """
+    step = load(spec)
+    if status or not step or \
+            not all(os.path.exists(out) for out in step["outputs"]):
+        return False
+    prints = inputPrints(step["inputs"], step["producers"], step["blocks"])
+    if prints is None:
+        return False
+    now = time.time()
+    save(step["manifest"], {
+        "key": stepKey(step["script"], step["args"], prints),
+        "outputs": {out: fingerprint(out, step["blocks"])
+                    for out in step["outputs"]},
+        "recorded": now,
+        "used": now})
+    os.remove(spec)
+    return True
+
+
+def manifests(directory, steps=()):
+    """Return the manifests under directory, only of steps if given."""
+    found = glob.glob(os.path.join(directory, "**", ".*.cache.json"),
+                      recursive=True)
+    return sorted(path for path in found if not steps or any(
+        path.endswith(f"_{step}.cache.json") for step in steps))
+
+
+def invalidate(directory, steps=()):
+    """Remove the manifests of steps, or all, so they run again."""
+    for manifest in manifests(directory, steps):
+        os.remove(manifest)
+        print(f"Invalidated {manifest}")
+
+
+def evict(directory, days):
+    """Remove manifests unused for days or whose outputs are all gone."""
+    cutoff = time.time() - days * 86400
+    for manifest in manifests(directory):
+        entry = load(manifest)
+        if not entry or entry["used"] < cutoff or not any(
+                os.path.exists(out) for out in entry["outputs"]):
+            os.remove(manifest)
+            print(f"Evicted {manifest}")
+
+
+def show(directory):
+    """Print the cached steps under directory."""
+    for manifest in manifests(directory):
+        entry = load(manifest) or {}
+        used = time.strftime("%Y-%m-%d %H:%M",
+                             time.localtime(entry.get("used", 0)))
+        print(f"{manifest}\tlast used {used}\t"
+              f"{len(entry.get('outputs', {}))} outputs")
+
+
+def main():
+    """Parse the command line and manage the step cache."""
+    parser = argparse.ArgumentParser(
+        description='Manage the cache of completed pipeline steps')
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    parserShow = subparsers.add_parser(
+        'show', help='List the cached steps under a directory')
+    parserShow.add_argument('dir', help='Directory to search')
+    parserInvalidate = subparsers.add_parser(
+        'invalidate', help='Forget cached steps so they are rerun')
+    parserInvalidate.add_argument('dir', help='Directory to search')
+    parserInvalidate.add_argument(
+        'steps', help='Step names to forget. Default: all', nargs='*')
+    parserEvict = subparsers.add_parser(
+        'evict', help='Forget stale cached steps')
+    parserEvict.add_argument('dir', help='Directory to search')
+    parserEvict.add_argument(
+        '-d', '--days',
+        help='Forget steps not used for this many days. Default: 30',
+        type=float,
+        default=30)
+    parserRecord = subparsers.add_parser(
+        'record', help='Record a finished step, run at the end of its job')
+    parserRecord.add_argument('spec', help='The spec written at submission')
+    parserRecord.add_argument(
+        '-s', '--status',
+        help='The exit status of the step, only recorded if 0. Default: 0',
+        type=int,
+        default=0)
+    args = parser.parse_args()
+
+    if args.command == "show":
+        show(args.dir)
+    elif args.command == "invalidate":
+        invalidate(args.dir, args.steps)
+    elif args.command == "evict":
+        evict(args.dir, args.days)
+    else:
+        record(args.spec, args.status)
+
+
+if __name__ == "__main__":
+    main()
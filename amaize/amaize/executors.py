@@ -0,0 +1,430 @@
+"""Backends that run the sbatch commands built by amaize.jobs."""
+
+import asyncio
+import collections
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+# sbatch prints "Submitted batch job <n>", or "<n>[;cluster]" with --parsable
+JOB_NUMBER = re.compile(r"^(?:Submitted batch job )?(\d+)(?:;\S+)?\s*$",
+                        re.MULTILINE)
+# scheduler errors worth retrying, the controller being busy or unreachable
+TRANSIENT = re.compile(
+    r"socket timed out|unable to contact slurm controller|"
+    r"resource temporarily unavailable|try again|connection refused|"
+    r"slurm_persist_conn|transient", re.IGNORECASE)
+ACTIVE = {"PENDING", "RUNNING", "CONFIGURING", "COMPLETING", "REQUEUED",
+          "RESIZING", "SUSPENDED"}
+POLL_BATCH = 500
+ACCOUNTING = ("JobID", "State", "Elapsed", "TotalCPU", "AllocCPUS", "MaxRSS")
+
+
+def parseJobNumber(output):
+    """Return the job number in the output of sbatch.
+
+    Warnings printed around the submission line are ignored.
+    """
+    match = JOB_NUMBER.search(output)
+    if not match:
+        raise ValueError(f"No job number in sbatch output: {output!r}")
+    return match.group(1)
+
+
+def tokens(cmd):
+    """Return an sbatch command as a list of arguments."""
+    return shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+
+
+def seconds(duration):
+    """Convert a slurm [D-][HH:]MM:SS[.mmm] duration to seconds."""
+    days, _, clock = duration.rpartition("-")
+    total = 0.0
+    for part in clock.split(":"):
+        total = total * 60 + float(part or 0)
+    return total + int(days or 0) * 86400
+
+
+def baseJob(jobId):
+    """Return the job number of a job or array task id such as 12_3."""
+    return re.match(r"\d*", jobId).group()
+
+
+class SlurmExecutor:
+    """Submits sbatch commands to the slurm scheduler.
+
+    A submission failing with a transient scheduler error is retried up to
+    retries times, waiting delay seconds and twice as long each time after.
+    """
+
+    def __init__(self, retries=5, delay=1.0):
+        self.retries = retries
+        self.delay = delay
+
+    async def submitAsync(self, cmd):
+        """Run the sbatch command and return its output."""
+        cmd = tokens(cmd)
+        for attempt in range(self.retries + 1):
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+            output = (await process.communicate())[0].decode().strip()
+            if not process.returncode or attempt == self.retries or \
+                    not TRANSIENT.search(output):
+                break
+            print(f"Retrying submission after: {output}")
+            await asyncio.sleep(self.delay * 2 ** attempt)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd,
+                                                output)
+        return output
+
+    def submit(self, cmd):
+        """Run the sbatch command and return its output."""
+        return asyncio.run(self.submitAsync(cmd))
+
+    def poll(self, cmd, jobNums):
+        """Yield (job id, state) lines of a status command, batch by batch."""
+        for start in range(0, len(jobNums), POLL_BATCH):
+            result = subprocess.run(
+                cmd + [",".join(jobNums[start:start + POLL_BATCH])],
+                capture_output=True, text=True)
+            for line in result.stdout.splitlines():
+                jobId, _, state = line.strip().partition("|")
+                if jobId and state:
+                    yield jobId, state.split()[0]
+
+    def states(self, jobNums):
+        """Return a Counter of the task states of each job.
+
+        The queue is polled with one squeue call per POLL_BATCH jobs, and
+        the jobs no longer queued with one sacct call per batch.
+        """
+        jobNums = list(jobNums)
+        states = {jobNum: collections.Counter() for jobNum in jobNums}
+        for jobId, state in self.poll(
+                ["squeue", "-h", "-r", "-o", "%i|%T", "-j"], jobNums):
+            if baseJob(jobId) in states:
+                states[baseJob(jobId)][state] += 1
+        finished = [jobNum for jobNum in jobNums if not states[jobNum]]
+        if finished:
+            for jobId, state in self.poll(
+                    ["sacct", "-n", "-P", "-X", "-o", "JobID,State", "-j"],
+                    finished):
+                # a pending array shows as one 12_[3-9] line in sacct
+                if "[" not in jobId and baseJob(jobId) in finished:
+                    states[baseJob(jobId)][state] += 1
+        return states
+
+    def accounting(self, jobNums):
+        """Return the usage of each finished job or array task from sacct.
+
+        Returns dicts of the job id, state, elapsed and cpu seconds, cpus and
+        peak memory in megabytes. The memory is the largest of the job steps
+        and the rest is taken from the allocation.
+        """
+        jobNums = list(jobNums)
+        usage = {}
+        for start in range(0, len(jobNums), POLL_BATCH):
+            result = subprocess.run(
+                ["sacct", "-n", "-P", "-o", ",".join(ACCOUNTING), "-j",
+                 ",".join(jobNums[start:start + POLL_BATCH])],
+                capture_output=True, text=True)
+            for line in result.stdout.splitlines():
+                fields = dict(zip(ACCOUNTING, line.strip().split("|")))
+                jobId, _, jobStep = fields.get("JobID", "").partition(".")
+                if len(fields) < len(ACCOUNTING) or "[" in jobId or \
+                        not jobId:
+                    continue
+                entry = usage.setdefault(jobId, {"jobId": jobId,
+                                                 "maxRss": 0.0})
+                if fields["MaxRSS"]:
+                    entry["maxRss"] = max(entry["maxRss"],
+                                          megabytes(fields["MaxRSS"]))
+                if not jobStep:
+                    entry.update(state=fields["State"].split()[0],
+                                 elapsed=seconds(fields["Elapsed"]),
+                                 cpuSeconds=seconds(fields["TotalCPU"]),
+                                 cpus=int(fields["AllocCPUS"] or 0))
+        return [entry for entry in usage.values() if
+                entry.get("state") and entry["state"] not in ACTIVE]
+
+    def queue(self, jobNums=()):
+        """Show the states of the jobs submitted, polled in batches."""
+        for jobNum, counts in self.states(jobNums).items():
+            summary = " ".join(f"{state}:{count}" for state, count in
+                               sorted(counts.items()))
+            print(f"{jobNum}\t{summary or 'UNKNOWN'}")
+
+
+def megabytes(memory):
+    """Convert a slurm memory size such as 3000M or 12G to megabytes."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)B?", memory.upper())
+    if not match:
+        raise ValueError(f"Unknown memory size {memory}")
+    return float(match.group(1)) * UNITS[match.group(2) or "M"]
+
+
+def parseSbatch(cmd):
+    """Split an sbatch command into its options, script and arguments.
+
+    Options are taken from the #SBATCH lines of the script and overridden
+    by those given on the command line, like sbatch does.
+    """
+    words = tokens(cmd)
+    if words[0] != "sbatch":
+        raise ValueError(f"Not an sbatch command: {cmd}")
+    options = {}
+    i = 1
+    while i < len(words) and words[i].startswith("-"):
+        option, equals, value = words[i].lstrip("-").partition("=")
+        if not equals and i + 1 < len(words) and \
+                option not in ("parsable", "wait", "requeue"):
+            i += 1
+            value = words[i]
+        options[option] = value
+        i += 1
+    script, args = words[i], words[i + 1:]
+    with open(script) as scriptFile:
+        text = scriptFile.read()
+    headers = {}
+    for option, value in re.findall(r"^#SBATCH\s+--([\w-]+)=(\S+)", text,
+                                    re.MULTILINE):
+        headers[option] = value
+    headers.update(options)
+    return headers, text, args
+
+
+def parseDependency(dependency):
+    """Return (kind, job number) pairs of a slurm dependency option."""
+    after = []
+    for condition in re.split(r"[,?]", dependency or ""):
+        kind, *jobNums = condition.split(":")
+        after.extend((kind, jobNum.split("_")[0]) for jobNum in jobNums)
+    return after
+
+
+class LocalTask:
+    """One job, or one task of a job array, run on this machine."""
+
+    def __init__(self, jobNum, index, name, text, args, options, cpus, mem):
+        self.jobNum = jobNum
+        self.index = index
+        self.name = name
+        self.text = text
+        self.args = args
+        self.options = options
+        self.cpus = cpus
+        self.mem = mem
+        self.after = parseDependency(options.get("dependency"))
+        self.state = "PENDING"
+        self.usage = None
+
+    def path(self, pattern):
+        """Fill in the slurm filename pattern for this task."""
+        jobId = self.jobNum if self.index is None else \
+            f"{self.jobNum}_{self.index}"
+        return (pattern.replace("%A", self.jobNum)
+                .replace("%a", str(self.index or 0))
+                .replace("%j", jobId).replace("%x", self.name))
+
+
+class LocalExecutor:
+    """Runs sbatch commands as processes on this machine.
+
+    The --cpus-per-task and --mem-per-cpu of each job are taken out of the
+    cpus and megabytes of memory available, so jobs only start once their
+    dependencies are satisfied and their resources are free. Jobs that can
+    never run because a dependency failed are cancelled. The cluster only
+    report and sreport summaries are no-ops, as is module unless this
+    machine has one, so tools are found on the PATH.
+    """
+
+    def __init__(self, cpus=None, mem=None):
+        self.cpus = cpus or len(os.sched_getaffinity(0))
+        self.mem = mem or (os.sysconf("SC_PAGE_SIZE") *
+                           os.sysconf("SC_PHYS_PAGES") // 1024 ** 2)
+        self.freeCpus = self.cpus
+        self.freeMem = self.mem
+        self.tasks = []
+        self.nextJob = 1
+        self.condition = threading.Condition()
+        # whether a scheduler is looping, only used holding the condition
+        self.scheduling = False
+        self.scheduler = None
+
+    def submit(self, cmd):
+        """Queue the jobs of the sbatch command and return its job number."""
+        options, text, args = parseSbatch(cmd)
+        cpus = min(int(options.get("cpus-per-task", 1)), self.cpus)
+        if "mem" in options:
+            mem = min(int(megabytes(options["mem"])), self.mem)
+        else:
+            mem = min(int(megabytes(options.get("mem-per-cpu", "1000M")) *
+                          cpus), self.mem)
+        name = options.get("job-name", "sbatch")
+        indices = [None]
+        if "array" in options:
+            first, _, last = options["array"].split("%")[0].partition("-")
+            indices = range(int(first), int(last or first) + 1)
+        with self.condition:
+            jobNum = str(self.nextJob)
+            self.nextJob += 1
+            self.tasks.extend(LocalTask(jobNum, index, name, text, args,
+                                        options, cpus, mem)
+                              for index in indices)
+            if not self.scheduling:
+                self.scheduling = True
+                self.scheduler = threading.Thread(target=self.schedule)
+                self.scheduler.start()
+            self.condition.notify_all()
+        return f"Submitted batch job {jobNum}"
+
+    async def submitAsync(self, cmd):
+        """Queue the jobs of the sbatch command and return its output."""
+        return self.submit(cmd)
+
+    def ready(self, task):
+        """Return True if task can start, False if not yet, None if never."""
+        for kind, jobNum in task.after:
+            others = [other for other in self.tasks
+                      if other.jobNum == jobNum]
+            if kind == "aftercorr" and task.index is not None and \
+                    any(other.index is not None for other in others):
+                others = [other for other in others
+                          if other.index == task.index]
+            states = {other.state for other in others}
+            if kind == "afterany":
+                if states & {"PENDING", "RUNNING"}:
+                    return False
+            elif states & {"FAILED", "CANCELLED"}:
+                return None
+            elif states - {"COMPLETED"}:
+                return False
+        return True
+
+    def schedule(self):
+        """Start tasks as their dependencies and resources allow.
+
+        Once no task is pending or running it clears scheduling before
+        letting go of the condition, so tasks submitted after that start a
+        new scheduler rather than waiting on this one.
+        """
+        with self.condition:
+            while any(task.state in ("PENDING", "RUNNING")
+                      for task in self.tasks):
+                cancelled = False
+                for task in self.tasks:
+                    if task.state != "PENDING":
+                        continue
+                    ready = self.ready(task)
+                    if ready is None:
+                        task.state = "CANCELLED"
+                        cancelled = True
+                        print(f"Cancelled job {task.name}, a dependency "
+                              "failed")
+                    elif ready and task.cpus <= self.freeCpus and \
+                            task.mem <= self.freeMem:
+                        self.freeCpus -= task.cpus
+                        self.freeMem -= task.mem
+                        task.state = "RUNNING"
+                        threading.Thread(target=self.run,
+                                         args=(task,)).start()
+                if not cancelled:
+                    self.condition.wait()
+            self.scheduling = False
+
+    def run(self, task):
+        """Run one task and release its resources when it finishes."""
+        env = dict(os.environ,
+                   SLURM_JOB_ID=task.jobNum,
+                   SLURM_JOB_NAME=task.name,
+                   SLURM_CPUS_PER_TASK=str(task.cpus),
+                   SLURM_MEM_PER_NODE=str(task.mem))
+        env["BASH_FUNC_report%%"] = env["BASH_FUNC_sreport%%"] = "() { :\n}"
+        env.setdefault("BASH_FUNC_module%%", "() { :\n}")
+        if task.index is not None:
+            env.update(SLURM_ARRAY_JOB_ID=task.jobNum,
+                       SLURM_ARRAY_TASK_ID=str(task.index))
+        out = task.path(task.options.get("output", "slurm-%j.out"))
+        err = task.path(task.options.get("error", out))
+        # the submitted script may already be gone, like sbatch run a copy
+        with tempfile.NamedTemporaryFile('w', suffix=".sbatch") as script, \
+                open(out, 'w') as stdout, open(err, 'a') as stderr:
+            script.write(task.text)
+            script.flush()
+            start = time.monotonic()
+            process = subprocess.Popen(
+                ["bash", script.name, *task.args], stdout=stdout,
+                stderr=stderr, env=env)
+            # wait4 also reports the cpu time and peak memory of the script
+            # and the commands it waited for, like sacct does for a job
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = returncode = \
+                os.waitstatus_to_exitcode(status)
+        with self.condition:
+            task.state = "COMPLETED" if returncode == 0 else "FAILED"
+            task.usage = {"elapsed": time.monotonic() - start,
+                          "cpuSeconds": rusage.ru_utime + rusage.ru_stime,
+                          "cpus": task.cpus,
+                          "maxRss": rusage.ru_maxrss / 1024}
+            self.freeCpus += task.cpus
+            self.freeMem += task.mem
+            self.condition.notify_all()
+
+    def wait(self):
+        """Wait for every queued job to finish."""
+        while True:
+            with self.condition:
+                scheduler = self.scheduler
+            if not scheduler:
+                return
+            scheduler.join()
+            with self.condition:
+                if scheduler is self.scheduler:
+                    return
+
+    def states(self, jobNums):
+        """Return a Counter of the task states of each job."""
+        with self.condition:
+            states = {jobNum: collections.Counter() for jobNum in jobNums}
+            for task in self.tasks:
+                if task.jobNum in states:
+                    states[task.jobNum][task.state] += 1
+        return states
+
+    def accounting(self, jobNums):
+        """Return the usage of each finished job or array task, like sacct.
+
+        Stands in for sacct with what each task measured of its own run.
+        """
+        with self.condition:
+            return [dict(task.usage, state=task.state, jobId=(
+                task.jobNum if task.index is None else
+                f"{task.jobNum}_{task.index}"))
+                for task in self.tasks
+                if task.jobNum in jobNums and task.usage]
+
+    def queue(self, jobNums=()):
+        """Wait for the jobs and print how each of them ended."""
+        self.wait()
+        for task in self.tasks:
+            index = "" if task.index is None else f"_{task.index}"
+            print(f"{task.jobNum}{index}\t{task.name}\t{task.state}")
+
+
+def fromEnvironment():
+    """Return the executor named by AMAIZE_EXECUTOR, slurm by default.
+
+    The local executor takes its cpus and megabytes of memory from
+    AMAIZE_LOCAL_CPUS and AMAIZE_LOCAL_MEM, all of this machine by default.
+    """
+    if os.environ.get("AMAIZE_EXECUTOR", "slurm") == "local":
+        return LocalExecutor(int(os.environ.get("AMAIZE_LOCAL_CPUS", 0)),
+                             int(os.environ.get("AMAIZE_LOCAL_MEM", 0)))
+    return SlurmExecutor()
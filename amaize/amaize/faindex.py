@@ -0,0 +1,140 @@
+"""Build the .fai and .dict of a fasta in one pass.
+
+The contigs are found by scanning the memory mapped fasta for headers,
+and each is handed to a process pool as soon as its end is known. A
+worker reads its contig once, checking the line layout samtools needs
+for the .fai and hashing the upper cased bases for the M5 of the .dict,
+as Picard CreateSequenceDictionary does.
+"""
+
+import argparse
+import hashlib
+import mmap
+import multiprocessing
+import os
+
+# bytes of whole lines a worker reads at once
+CHUNK_LINES = 1 << 18
+UPPER = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz",
+                        b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+WHITESPACE = b" \t\r\n"
+
+
+def contigs(path, fasta):
+    """Yield (path, name, start, end) of the sequence of each contig.
+
+    start is the offset of its first base and end that after its last,
+    trailing blank lines excluded.
+    """
+    if fasta[:1] != b">":
+        raise ValueError(f"{path} has sequence before a header")
+    header = 0
+    while header >= 0:
+        lineEnd = fasta.find(b"\n", header)
+        start = len(fasta) if lineEnd < 0 else lineEnd + 1
+        name = fasta[header + 1:start].split()[0].decode()
+        following = fasta.find(b"\n>", start - 1)
+        header = following + 1 if following >= 0 else -1
+        end = following + 1 if following >= 0 else len(fasta)
+        while end > start and fasta[end - 1] in WHITESPACE:
+            end -= 1
+        yield path, name, start, end
+
+
+def indexContig(job):
+    """Return the .fai entry and the MD5 of the bases of one contig.
+
+    Every line of a contig but its last must have the same length, as
+    samtools requires for random access.
+    """
+    path, name, start, end, md5 = job
+    digest = hashlib.md5()
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as fasta:
+        newline = fasta.find(b"\n", start, end)
+        if newline >= 0:
+            crlf = newline > start and fasta[newline - 1:newline] == b"\r"
+            lineWidth = newline + 1 - start
+        else:
+            crlf = fasta[end:end + 2] == b"\r\n"
+            lineWidth = end - start + 1 + crlf
+        lineBases = lineWidth - 1 - crlf
+        size = end - start
+        lines = size // lineWidth
+        if newline >= 0 and not 0 < size - lines * lineWidth <= lineBases:
+            raise ValueError(f"{path} has uneven line lengths in contig "
+                             f"{name}")
+        chunk = CHUNK_LINES * lineWidth
+        for offset in range(start, end, chunk):
+            block = fasta[offset:min(offset + chunk, end)]
+            whole = len(block) // lineWidth
+            if block.count(b"\n") != whole or \
+                    block[lineWidth - 1::lineWidth][:whole] != b"\n" * whole \
+                    or crlf and block[lineWidth - 2::lineWidth][:whole] != \
+                    b"\r" * whole:
+                raise ValueError(f"{path} has uneven line lengths in contig "
+                                 f"{name}")
+            if md5:
+                digest.update(block.translate(UPPER, WHITESPACE))
+    length = lines * lineBases + size - lines * lineWidth
+    if not size:
+        lineBases = lineWidth = 0
+    return (name, length, start, lineBases, lineWidth), digest.hexdigest()
+
+
+def dictLines(path, entries, digests):
+    """Return the lines of the sequence dictionary of a fasta."""
+    url = f"file:{os.path.abspath(path)}"
+    return ["@HD\tVN:1.6\n"] + [
+        f"@SQ\tSN:{name}\tLN:{length}\tM5:{digest}\tUR:{url}\n"
+        for (name, length, *_), digest in zip(entries, digests)]
+
+
+def index(path, processes=1, dictPath=None, md5=True):
+    """Write the .fai and, with md5, the .dict of a fasta in one pass.
+
+    dictPath defaults to the fasta path with .dict appended, as the Picard
+    step names it. Returns the .fai entries.
+    """
+    results = []
+    if os.path.getsize(path):
+        with open(path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as fasta:
+            jobs = (job + (md5,) for job in contigs(path, fasta))
+            if processes > 1:
+                with multiprocessing.Pool(processes) as pool:
+                    results = list(pool.imap(indexContig, jobs))
+            else:
+                results = [indexContig(job) for job in jobs]
+    entries = [entry for entry, _ in results]
+    with open(f"{path}.fai", 'w') as fai:
+        for entry in entries:
+            fai.write("\t".join(str(field) for field in entry) + "\n")
+    if md5:
+        with open(dictPath or f"{path}.dict", 'w') as sequences:
+            sequences.writelines(dictLines(path, entries,
+                                           [digest for _, digest in results]))
+    return entries
+
+
+def main():
+    """Parse the command line and index a fasta."""
+    parser = argparse.ArgumentParser(
+        description=('Write the samtools .fai and Picard .dict of a fasta in '
+                     'one pass'))
+    parser.add_argument('fasta', help='The fasta file')
+    parser.add_argument(
+        '-d', '--dict',
+        help='The sequence dictionary to write. Default: the fasta + .dict')
+    parser.add_argument(
+        '-p', '--processes',
+        help='Number of contigs hashed at once. Default: all cpus',
+        type=int,
+        default=len(os.sched_getaffinity(0)))
+    args = parser.parse_args()
+    entries = index(args.fasta, args.processes, args.dict)
+    print(f"Indexed {len(entries)} contigs of {args.fasta}")
+
+
+if __name__ == "__main__":
+    main()
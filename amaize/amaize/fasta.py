@@ -0,0 +1,105 @@
+"""Random access to indexed fasta files through a memory map."""
+
+import argparse
+import mmap
+import os
+
+from amaize import faindex
+
+
+def readFai(fai):
+    """Return (name, length, offset, line bases, line width) of each contig."""
+    entries = []
+    with open(fai) as index:
+        for line in index:
+            name, length, offset, lineBases, lineWidth = line.split("\t")[:5]
+            entries.append((name, int(length), int(offset), int(lineBases),
+                            int(lineWidth)))
+    return entries
+
+
+def buildFai(path):
+    """Write the samtools .fai index of a fasta and return its path.
+
+    Every line of a contig but its last must have the same length, as
+    samtools requires for random access.
+    """
+    faindex.index(path, md5=False)
+    return f"{path}.fai"
+
+
+class Fasta:
+    """A fasta file memory mapped for random access through its .fai.
+
+    The index is read once, so contig lengths cost nothing, and bases are
+    only paged in from the map as they are read, so memory stays constant
+    however large the genome. A missing .fai is built first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fai = f"{path}.fai"
+        if not os.path.exists(fai):
+            buildFai(path)
+        self.index = {entry[0]: entry for entry in readFai(fai)}
+        self.lengths = {name: entry[1] for name, entry in self.index.items()}
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmap and close the fasta."""
+        self.map.close()
+        self.file.close()
+
+    def offset(self, contig, position):
+        """Return the file offset of a 0-based position in a contig."""
+        _, _, offset, lineBases, lineWidth = self.index[contig]
+        return (offset + position // lineBases * lineWidth +
+                position % lineBases)
+
+    def lines(self, contig, start=0, end=None):
+        """Yield zero-copy views of the bases from start to end, per line."""
+        length, lineBases = self.index[contig][1], self.index[contig][3]
+        end = length if end is None else min(end, length)
+        view = memoryview(self.map)
+        while start < end:
+            stop = min(end, (start // lineBases + 1) * lineBases)
+            first = self.offset(contig, start)
+            yield view[first:first + stop - start]
+            start = stop
+
+    def fetch(self, contig, start=0, end=None):
+        """Return the bases of a contig from start to end, 0-based half open.
+
+        A range within one line is a zero-copy view of the map, a longer one
+        is joined into bytes without its line breaks.
+        """
+        views = list(self.lines(contig, start, end))
+        if len(views) == 1:
+            return views[0]
+        return b"".join(views)
+
+
+def main():
+    """Parse the command line and print a region of a fasta."""
+    parser = argparse.ArgumentParser(
+        description='Print a region of a fasta, indexing it if needed')
+    parser.add_argument('fasta', help='The fasta file')
+    parser.add_argument('contig', help='The contig to print from')
+    parser.add_argument('start', help='0-based start. Default: 0',
+                        type=int, nargs='?', default=0)
+    parser.add_argument('end', help='End, exclusive. Default: contig end',
+                        type=int, nargs='?')
+    args = parser.parse_args()
+    with Fasta(args.fasta) as fasta:
+        print(bytes(fasta.fetch(args.contig, args.start, args.end)).decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Block reading of plain or gzipped fastq files with NumPy."""
+
+import collections
+import itertools
+import queue
+import threading
+
+import numpy as np
+
+from amaize import bgzf
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def openFastq(path, mode='rb', threads=4):
+    """Open a plain or gzipped fastq as bytes, BGZF on threads."""
+    if path.endswith(".gz"):
+        return bgzf.open(path, mode, threads)
+    return open(path, mode)
+
+
+def blocks(path, size=BLOCK_SIZE, threads=4):
+    """Yield blocks of about size bytes holding only whole fastq records."""
+    with openFastq(path, threads=threads) as fastq:
+        rest = b""
+        while True:
+            chunk = fastq.read(size)
+            if not chunk:
+                break
+            data = rest + chunk
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) ==
+                                      10)
+            whole = len(newlines) // 4 * 4
+            if not whole:
+                rest = data
+                continue
+            cut = newlines[whole - 1] + 1
+            yield data[:cut]
+            rest = data[cut:]
+        if rest.strip():
+            yield rest if rest.endswith(b"\n") else rest + b"\n"
+
+
+def countedBlocks(path, count):
+    """Yield blocks of count whole fastq records, the last may hold fewer.
+
+    Blocks of two mates' fastqs read this way hold the same reads.
+    """
+    with openFastq(path) as fastq:
+        while True:
+            lines = list(itertools.islice(fastq, 4 * count))
+            if not lines:
+                return
+            if not lines[-1].endswith(b"\n"):
+                lines[-1] += b"\n"
+            yield b"".join(lines)
+
+
+def orderedMap(pool, func, iterable, window):
+    """Map func over iterable on the pool in order, keeping window in flight.
+
+    Unlike Pool.imap this only pulls from iterable as results are consumed,
+    so at most window blocks are held in memory at once.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def prefetch(iterable, depth=4):
+    """Yield the items of iterable, read ahead by a background thread.
+
+    At most depth items wait at once. Reading a gzipped fastq this way
+    decompresses it while the caller works on earlier blocks.
+    """
+    items = queue.Queue(depth)
+    done = object()
+
+    def fill():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as error:
+            items.put(error)
+        items.put(done)
+
+    threading.Thread(target=fill, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class Records:
+    """The reads of a block as offsets into its bytes.
+
+    data is the block as a uint8 array. Read i has its bases at
+    data[seqStarts[i]:seqStarts[i] + lengths[i]] and its qualities at the
+    same offsets from qualStarts[i].
+    """
+
+    def __init__(self, block):
+        self.block = block
+        self.data = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(self.data == 10)
+        if len(ends) % 4:
+            raise ValueError("Fastq block does not hold whole records")
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        if len(ends) and not (self.data[starts[::4]] == ord("@")).all():
+            raise ValueError("Fastq record does not start with @")
+        seqEnds = ends[1::4]
+        seqEnds = seqEnds - (self.data[np.maximum(seqEnds - 1, 0)] == 13)
+        self.headerStarts = starts[::4]
+        self.headerEnds = ends[::4]
+        self.seqStarts = starts[1::4]
+        self.qualStarts = starts[3::4]
+        self.recordEnds = ends[3::4] + 1
+        self.lengths = seqEnds - self.seqStarts
+        self.width = int(self.lengths.max()) if len(self.lengths) else 0
+        self.windows = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def valid(self):
+        """Return which cells of the read matrices hold a base."""
+        return np.arange(self.width) < self.lengths[:, None]
+
+    def matrix(self, starts):
+        """Return a row per read of the bytes from starts, padded to width.
+
+        Rows are copied out of a view of every width long window of the
+        block, so cells past the end of a read hold whatever follows it.
+        """
+        if self.windows is None:
+            width = max(self.width, 1)
+            padded = np.concatenate((self.data,
+                                     np.zeros(width, dtype=np.uint8)))
+            self.windows = np.lib.stride_tricks.sliding_window_view(
+                padded, width)
+        return self.windows[starts, :self.width]
+
+    def bases(self):
+        """Return the bases of the reads as a padded matrix."""
+        return self.matrix(self.seqStarts)
+
+    def qualities(self):
+        """Return the phred+33 qualities of the reads as a padded matrix."""
+        return self.matrix(self.qualStarts)
+
+    def select(self, reads, starts, ends):
+        """Return the fastq text of reads cut down to bases starts to ends.
+
+        Each read keeps its header and + lines and the same span of bases
+        and qualities. The spans kept and skipped alternate through the
+        block, so they are marked by repeating True and False over their
+        lengths and the bytes taken out in one step. Line ends are kept as
+        they are, \r\n or \n.
+        """
+        seqStarts = self.seqStarts[reads]
+        qualStarts = self.qualStarts[reads]
+        seqEnds = seqStarts + self.lengths[reads]
+        spans = np.stack((
+            self.headerStarts[reads], self.headerEnds[reads] + 1,
+            seqStarts + starts, seqStarts + ends,
+            seqEnds, qualStarts,
+            qualStarts + starts, qualStarts + ends,
+            qualStarts + self.lengths[reads], self.recordEnds[reads]),
+            axis=1).ravel()
+        lengths = np.diff(spans, prepend=0, append=len(self.data))
+        kept = np.arange(len(lengths)) % 2 == 1
+        return self.data[np.repeat(kept, lengths)].tobytes()
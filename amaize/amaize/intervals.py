@@ -0,0 +1,110 @@
+"""Split a reference genome into balanced interval shards."""
+
+import argparse
+import bisect
+import itertools
+import os
+import re
+
+from amaize.fasta import Fasta
+
+
+def gapSplit(fasta, contig, ideal, window):
+    """Move a split point of a contig into the nearest long run of Ns.
+
+    The longest run of Ns within window bases of the ideal point is split in
+    the middle, so no shard boundary falls inside sequence reads align to.
+    Without a gap nearby the ideal point is kept.
+    """
+    start = max(ideal - window, 0)
+    bases = fasta.fetch(contig, start, ideal + window)
+    gaps = [match.span() for match in re.finditer(rb"[Nn]+", bases)]
+    if not gaps:
+        return ideal
+    gapStart, gapEnd = max(gaps, key=lambda gap: (
+        gap[1] - gap[0], -abs(start + (gap[0] + gap[1]) // 2 - ideal)))
+    return start + (gapStart + gapEnd) // 2
+
+
+def shardGenome(genome, shards, window=100000, minPiece=1000000, gaps=True):
+    """Split the contigs of a genome into shards of about equal length.
+
+    Returns a list of shards, each a list of (contig, start, end) 0-based
+    half open intervals in reference order. Contigs are only cut where a
+    shard boundary falls inside them, never within minPiece of their ends,
+    and with gaps at a run of Ns near the boundary.
+    """
+    with Fasta(genome) as fasta:
+        lengths = list(fasta.lengths.items())
+        ends = list(itertools.accumulate(length for _, length in lengths))
+        target = ends[-1] / shards if lengths else 0
+        cuts = set()
+        for boundary in range(1, shards):
+            point = round(boundary * target)
+            i = bisect.bisect_right(ends, point)
+            if i == len(lengths):
+                continue
+            name, length = lengths[i]
+            position = point - (ends[i] - length)
+            if position < minPiece:
+                cuts.add((i, 0))
+            elif length - position < minPiece:
+                cuts.add((i + 1, 0))
+            else:
+                if gaps:
+                    position = gapSplit(fasta, name, position, window)
+                cuts.add((i, position))
+
+    sharded = [[]]
+    for i, (name, length) in enumerate(lengths):
+        start = 0
+        for _, position in sorted(cut for cut in cuts if cut[0] == i):
+            if position > start:
+                sharded[-1].append((name, start, position))
+                start = position
+            if sharded[-1]:
+                sharded.append([])
+        sharded[-1].append((name, start, length))
+    return [shard for shard in sharded if shard]
+
+
+def writeIntervals(path, intervals):
+    """Write intervals as a GATK .intervals list of contig:start-end lines.
+
+    An existing file with the same intervals is left untouched so steps
+    cached on it are not rerun.
+    """
+    text = "".join(f"{name}:{start + 1}-{end}\n"
+                   for name, start, end in intervals)
+    if os.path.exists(path):
+        with open(path) as existing:
+            if existing.read() == text:
+                return path
+    with open(path, 'w') as out:
+        out.write(text)
+    return path
+
+
+def main():
+    """Parse the command line and write the interval shards of a genome."""
+    parser = argparse.ArgumentParser(
+        description=('Split a reference genome into interval shards of about '
+                     'equal length'))
+    parser.add_argument('genome', help='The path to the genome')
+    parser.add_argument('shards', help='The number of shards', type=int)
+    parser.add_argument(
+        'out', help='Output prefix, writes <out>_shard<i>.intervals')
+    parser.add_argument(
+        '-w', '--window',
+        help=('Distance from each ideal split point searched for a gap. '
+              'Default: 100000'),
+        type=int,
+        default=100000)
+    args = parser.parse_args()
+    for i, shard in enumerate(shardGenome(args.genome, args.shards,
+                                          args.window)):
+        writeIntervals(f"{args.out}_shard{i}.intervals", shard)
+
+
+if __name__ == "__main__":
+    main()
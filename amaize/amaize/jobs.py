@@ -1,61 +1,181 @@
 """Job submitting functions."""
 
+import collections
+import hashlib
 import os
-import subprocess
 import pathlib
-import tempfile
+import shlex
+import time
+
+from amaize import executors, resources, sbatch
+
+executor = executors.fromEnvironment()
+# job numbers submitted by this process, for queue and wait
+submitted = []
+# sbatch calls in flight at once when submitting concurrently
+CONCURRENCY = int(os.environ.get("AMAIZE_SUBMIT_CONCURRENCY", 8))
 
 
 def out(prevJob, logs, task, scriptName, sample, optional):
-    """Produce the base of the cmds not depending on the previous job."""
-    same = (f"--output=%s " % os.path.join(logs, f"{sample}_{task}_out.log") +
-            f"--error=%s " % os.path.join(logs, f"{sample}_{task}_err.log") +
-            f"--job-name={sample}_{task} "
-            "%s" + scriptName)
-    if prevJob and optional:
-        return ("sbatch --dependency=afterany:%s" %
-                ":".join(prevJob) if len(prevJob) > 1 else prevJob +
-                same % optional)
-    elif prevJob:
-        return ("sbatch --dependency=afterany:%s" %
-                ":".join(prevJob) if len(prevJob) > 1 else prevJob +
-                same % "")
-    elif optional:
-        return (f"sbatch " + same % optional)
-    else:
-        return (f"sbatch " + same % "")
+    """Produce the sbatch arguments not depending on the files given."""
+    return (["sbatch", *dependency("afterany", prevJob).split(),
+             f"--output={os.path.join(logs, f'{sample}_{task}_out.log')}",
+             f"--error={os.path.join(logs, f'{sample}_{task}_err.log')}",
+             f"--job-name={sample}_{task}", *shlex.split(optional or ""),
+             scriptName])
+
+
+def recordJob(output):
+    """Print the sbatch output, record and return its job number."""
+    print(output)
+    jobNum = executors.parseJobNumber(output)
+    submitted.append(jobNum)
+    return jobNum
 
 
 def submitJob(cmd):
-    """Submit the job, print the output, return job number."""
-    print(f"Creating job with command:\n\n{cmd}\n")
-    submitted = subprocess.getoutput(cmd)
-    print(submitted)
-    return submitted.split(" ")[-1]
+    """Submit the job, print the output, return job number.
+
+    cmd is a list of sbatch arguments, or a string split like a shell would.
+    """
+    cmd = executors.tokens(cmd)
+    print(f"Creating job with command:\n\n{shlex.join(cmd)}\n")
+    return recordJob(executor.submit(cmd))
+
+
+async def submitJobAsync(cmd, limit):
+    """Submit the job once the limit semaphore allows, like submitJob."""
+    cmd = executors.tokens(cmd)
+    async with limit:
+        print(f"Creating job with command:\n\n{shlex.join(cmd)}\n")
+        return recordJob(await executor.submitAsync(cmd))
+
+
+def setExecutor(newExecutor):
+    """Run the jobs submitted from now on with another executor."""
+    global executor
+    executor = newExecutor
+
+
+def queue():
+    """Show the submitted jobs, waiting for them if they run locally.
+
+    The usage of the jobs already finished is then added to the resources
+    history.
+    """
+    executor.queue(submitted)
+    if resources.mode() != "off":
+        with resources.History() as history:
+            history.collect(executor)
+
+
+def wait(interval=60):
+    """Poll the submitted jobs in batches until none is queued or running.
+
+    Returns the Counter of task states of each job once they have all ended.
+    """
+    last = None
+    while True:
+        states = executor.states(submitted)
+        total = sum((counts for counts in states.values()),
+                    start=collections.Counter())
+        if total != last:
+            print(" ".join(f"{state}:{count}"
+                           for state, count in sorted(total.items())))
+            last = total
+        if not set(total) & executors.ACTIVE:
+            return states
+        time.sleep(interval)
 
 
 def job(prevJob, job, logs, task, scriptName, sample, optional, *files):
     """Template for job cmds."""
-    cmd = ""
-    if prevJob and job:
-        cmd = (out(
-            prevJob, logs, task, scriptName, sample, optional) +
-            " " + " ".join(files))
-    elif job:
-        cmd = (out(0, logs, task, scriptName, sample, optional) +
-               " " + " ".join(files))
-    else:
+    if not job:
         return prevJob
+    return submitJob(out(prevJob, logs, task, scriptName, sample, optional) +
+                     list(files))
 
-    return submitJob(cmd)
+
+def dependency(kind, prevJob):
+    """Return the dependency option on one or more previous jobs."""
+    if not prevJob:
+        return ""
+    if isinstance(prevJob, str):
+        prevJob = (prevJob,)
+    return f"--dependency={kind}:{':'.join(prevJob)} "
+
+
+def arrayScript(script):
+    """Make script take its arguments from a line of an array manifest.
+
+    The manifest is the only argument given to the array job. Task i sets its
+    positional arguments from the tab separated fields of line i + 1, after
+    the leading sample name.
+    """
+    lines = script.splitlines(keepends=True)
+    last = max((i for i, line in enumerate(lines)
+                if line.startswith("#SBATCH")), default=0)
+    return "".join(
+        lines[:last + 1] +
+        ["\nIFS=$'\\t' read -r -a task < "
+         "<(sed -n \"$((SLURM_ARRAY_TASK_ID + 1))p\" \"$1\")\n",
+         "set -- \"${task[@]:1}\"\n"] +
+        lines[last + 1:])
+
+
+def writeManifest(logs, task, tasks):
+    """Write one tab separated line of arguments per array task.
+
+    The manifest is named for the hash of its text, like a stored script,
+    so a later submission of task never rewrites the manifest the tasks of
+    a running array read their arguments from.
+    """
+    text = "".join("\t".join(str(arg) for arg in args) + "\n"
+                   for args in tasks)
+    digest = hashlib.sha256(text.encode()).hexdigest()[:24]
+    path = os.path.join(logs, f"{task}_{digest}_manifest.tsv")
+    if not os.path.exists(path):
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, 'w') as manifest:
+            manifest.write(text)
+        os.replace(temp, path)
+    return path
+
+
+def arrayCommand(prevJob, logs, task, script, tasks, optional=0, limit=0):
+    """Return the sbatch arguments of a job array.
+
+    The array script is submitted from the script store, shared by every
+    job array running the same script, with the manifest of its tasks.
+    """
+    manifest = writeManifest(logs, task, tasks)
+    cmd = ["sbatch", *dependency("aftercorr", prevJob).split(),
+           f"--array=0-{len(tasks) - 1}" + (f"%{limit}" if limit else ""),
+           f"--output={os.path.join(logs, f'{task}_%a_out.log')}",
+           f"--error={os.path.join(logs, f'{task}_%a_err.log')}",
+           f"--job-name={task}", *shlex.split(optional or ""),
+           sbatch.store(arrayScript(script)), manifest]
+    return cmd
+
+
+def arrayJob(prevJob, job, logs, task, script, tasks, optional=0, limit=0):
+    """Submit script once as a job array with one task per argument tuple.
+
+    Each tuple in tasks starts with the sample name followed by the script
+    arguments. Task i of the array starts once task i of every previous array
+    job has succeeded, and at most limit tasks run at once if given.
+    """
+    if not job or not tasks:
+        return prevJob
+    return submitJob(arrayCommand(prevJob, logs, task, script, tasks,
+                                  optional, limit))
 
 
-def tempScript(script):
-    """Write a string as a temp bash file."""
-    scriptfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
-    scriptfile.write(script)
-    scriptfile.close()
-    return scriptfile
+async def arrayJobAsync(prevJob, logs, task, script, tasks, limit,
+                        optional=0, arrayLimit=0):
+    """Submit a job array like arrayJob, once the limit semaphore allows."""
+    return await submitJobAsync(arrayCommand(
+        prevJob, logs, task, script, tasks, optional, arrayLimit), limit)
 
 
 def outDir(*components):
@@ -0,0 +1,332 @@
+"""Declarative pipelines of sbatch steps linked by the files they share."""
+
+import asyncio
+import math
+import os
+import re
+import shlex
+import time
+
+from amaize import cache, jobs, resources, sbatch, timeline
+
+
+def wallTime(script):
+    """Return the #SBATCH --time of the script text in minutes."""
+    match = re.search(r"^#SBATCH\s+--time=(?:(\d+)-)?(\d+):(\d+)", script,
+                      re.MULTILINE)
+    if not match:
+        return 0
+    days, hours, minutes = match.groups()
+    return (int(days or 0) * 24 + int(hours)) * 60 + int(minutes)
+
+
+def formatTime(minutes):
+    """Format minutes as a slurm D-HH:MM time."""
+    return f"{minutes // 1440}-{minutes % 1440 // 60:02d}:{minutes % 60:02d}"
+
+
+def withWallTime(script, minutes):
+    """Return the script text with its #SBATCH --time set to minutes."""
+    return re.sub(r"^(#SBATCH\s+--time=)\S+", rf"\g<1>{formatTime(minutes)}",
+                  script, count=1, flags=re.MULTILINE)
+
+
+class Step:
+    """An sbatch script run on its inputs to make its outputs.
+
+    A step with tasks is submitted as a job array, one task per argument
+    tuple with at most limit running at once, otherwise as a single job run
+    with args. Files the step deletes once done are listed in removes so it
+    waits for every other reader.
+    """
+
+    def __init__(self, name, script, args=(), inputs=(), outputs=(),
+                 removes=(), tasks=None, limit=0, run=True, stdout=None,
+                 stderr=None, optional=""):
+        self.name = name
+        self.script = script
+        self.args = args
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.removes = set(removes)
+        self.tasks = tasks
+        self.limit = limit
+        self.run = run
+        self.stdout = stdout
+        self.stderr = stderr
+        self.optional = optional
+        self.jobNum = 0
+
+    def params(self):
+        """Return the arguments of the step, per task for a job array."""
+        return self.args if self.tasks is None else self.tasks
+
+
+class Pipeline:
+    """Steps whose dependencies are derived from their inputs and outputs.
+
+    With cache set, steps recorded as completed with the same inputs, script
+    and args are skipped and only the steps downstream of a change are
+    submitted. blocks is the number of blocks hashed per fingerprinted file.
+    sizing is one of the resources modes, by default AMAIZE_RESOURCES, and
+    kind the pipeline whose runs in the history size its steps, by default
+    its name. Pipelines named for a sample share a kind across samples.
+    With timeline set, the jobs mark their timeline in the logs.
+    """
+
+    def __init__(self, name, logs, cache=False, blocks=0, sizing=None,
+                 timeline=True, kind=None):
+        self.name = name
+        self.kind = kind or name
+        self.logs = logs
+        self.cache = cache
+        self.blocks = blocks
+        self.sizing = sizing or resources.mode()
+        self.timeline = timeline
+        self.history = None
+        self.submissions = []
+        self.steps = []
+
+    def add(self, name, script, *args, **kwargs):
+        """Add a step running script with args, see Step for kwargs."""
+        step = Step(name, script, args, **kwargs)
+        self.steps.append(step)
+        return step
+
+    def dependencies(self, step):
+        """Return the steps that must finish before step can start.
+
+        Those are the producers of its inputs and, for the files it removes,
+        every other step that reads them.
+        """
+        return [other for other in self.steps if other is not step and (
+            other.outputs & step.inputs or other.inputs & step.removes)]
+
+    def order(self):
+        """Return the steps in dependency order."""
+        ordered, seen = [], set()
+
+        def visit(step, path):
+            if step in path:
+                raise ValueError(f"Pipeline {self.name} has a cycle through "
+                                 f"step {step.name}")
+            if step not in seen:
+                for dependency in self.dependencies(step):
+                    visit(dependency, path | {step})
+                seen.add(step)
+                ordered.append(step)
+
+        for step in self.steps:
+            visit(step, frozenset())
+        return ordered
+
+    def criticalPath(self, run=None):
+        """Return the longest chain of run steps by wall time, and its time.
+
+        Only the steps in run, by default those enabled, take time. The rest
+        still link their neighbours.
+        """
+        if run is None:
+            run = {step for step in self.steps if step.run}
+        finish, previous = {}, {}
+        for step in self.order():
+            before = max(self.dependencies(step), key=finish.get,
+                         default=None)
+            start = finish[before] if before else 0
+            finish[step] = start + (wallTime(step.script) if step in run
+                                    else 0)
+            previous[step] = before
+        step = max(finish, key=finish.get, default=None)
+        total = finish.get(step, 0)
+        path = []
+        while step:
+            if step in run:
+                path.append(step)
+            step = previous[step]
+        return path[::-1], total
+
+    def manifest(self, step):
+        """Return the cache manifest of a step, None if it has no outputs."""
+        if step.outputs:
+            return cache.manifestPath(self.name, step.name, step.outputs)
+
+    def producers(self, step):
+        """Map the inputs of step to the manifests of the steps making them."""
+        return {path: self.manifest(other) for other in self.steps
+                for path in other.outputs & step.inputs}
+
+    def cached(self, step):
+        """Return True if the cache says step need not be rerun."""
+        if not step.outputs:
+            return True
+        intermediates = set().union(*(other.removes for other in self.steps))
+        return cache.valid(self.manifest(step), step.script, step.params(),
+                           step.inputs, step.outputs, self.producers(step),
+                           intermediates, self.blocks)
+
+    def stale(self):
+        """Return the run steps that have to be submitted.
+
+        A step is stale if it is not cached or anything it depends on is
+        stale. A cached step is stale after all if a stale step needs one of
+        its outputs that has since been removed.
+        """
+        if not self.cache:
+            return {step for step in self.steps if step.run}
+        cached = {step for step in self.steps if step.run and
+                  self.cached(step)}
+        stale = set()
+        changed = True
+        while changed:
+            changed = False
+            for step in self.order():
+                if step.run and step not in stale and (
+                        step not in cached or
+                        any(dependency in stale
+                            for dependency in self.dependencies(step))):
+                    stale.add(step)
+                    changed = True
+            for step in list(stale):
+                for dependency in self.dependencies(step):
+                    if dependency.run and dependency not in stale and any(
+                            not os.path.exists(path) for path in
+                            dependency.outputs & step.inputs):
+                        stale.add(dependency)
+                        changed = True
+        return stale
+
+    def inputSizes(self, step):
+        """Return the input bytes of each task of step, or of the step."""
+        if step.tasks is None:
+            return [resources.inputBytes(step.inputs)]
+        return [resources.inputBytes(arg for arg in task[1:]
+                                     if arg in step.inputs)
+                for task in step.tasks]
+
+    def sizingOptions(self, step, sizes):
+        """Return sbatch options right-sizing step, and what it asks for.
+
+        Sizes are suggested from the history for the largest input of the
+        step, and only applied as options in apply mode. The cpus are only
+        changed for scripts that read SLURM_CPUS_PER_TASK.
+        """
+        request = resources.requested(step.script)
+        if self.sizing not in ("suggest", "apply"):
+            return "", request
+        suggestion = self.history.suggest(
+            self.kind, step.name, max(sizes) if all(sizes) else 0, request)
+        if not suggestion:
+            return "", request
+        if "SLURM_CPUS_PER_TASK" not in step.script:
+            suggestion["cpus"] = request["cpus"]
+        print(f"Resources of {self.name}_{step.name}: "
+              f"{suggestion['cpus']} cpus, {suggestion['memory']:.0f}M, "
+              f"{formatTime(suggestion['minutes'])} suggested, "
+              f"{request['cpus']} cpus, {request['memory']:.0f}M, "
+              f"{formatTime(request['minutes'])} requested")
+        if self.sizing != "apply":
+            return "", request
+        memory = suggestion["memory"]
+        if suggestion["memoryOption"] == "mem-per-cpu":
+            memory /= suggestion["cpus"]
+        return (f"--cpus-per-task={suggestion['cpus']} "
+                f"--{suggestion['memoryOption']}={math.ceil(memory)}M "
+                f"--time={formatTime(suggestion['minutes'])} ", suggestion)
+
+    async def submitStep(self, step, submitted, limit):
+        """Submit one step once the stale steps it depends on are submitted.
+
+        submitted maps the stale steps to the tasks submitting them, and
+        limit bounds the sbatch calls in flight.
+        """
+        after = {"afterok": [], "aftercorr": []}
+        for dependency in self.dependencies(step):
+            jobNum = await submitted[dependency] if dependency in submitted \
+                else dependency.jobNum
+            if jobNum:
+                kind = "aftercorr" if step.tasks and dependency.tasks \
+                    else "afterok"
+                after[kind].append(jobNum)
+        options = ",".join(f"{kind}:{':'.join(jobNums)}"
+                           for kind, jobNums in after.items() if jobNums)
+        sizes = self.inputSizes(step)
+        sizing, request = self.sizingOptions(step, sizes)
+        options = (f"--dependency={options} " if options else "") + \
+            sizing + step.optional
+        task = f"{self.name}_{step.name}"
+        spec = cache.writeSpec(
+            self.manifest(step), step.script, step.params(), step.inputs,
+            step.outputs, self.producers(step), self.blocks) \
+            if self.cache and step.outputs else None
+        script = cache.recording(step.script, spec)
+        if self.timeline:
+            script = timeline.instrument(script, self.logs, task)
+
+        if step.tasks is not None:
+            jobNum = await jobs.arrayJobAsync(0, self.logs, task, script,
+                                              step.tasks, limit, options,
+                                              step.limit)
+            jobIds = [f"{jobNum}_{i}" for i in range(len(step.tasks))]
+        else:
+            stdout = step.stdout or os.path.join(self.logs,
+                                                 f"{task}_out.log")
+            stderr = step.stderr or os.path.join(self.logs,
+                                                 f"{task}_err.log")
+            jobNum = await jobs.submitJobAsync(
+                ["sbatch", *shlex.split(options), f"--output={stdout}",
+                 f"--error={stderr}", f"--job-name={task}",
+                 sbatch.store(script), *map(str, step.args)], limit)
+            jobIds = [jobNum]
+        if self.history:
+            self.history.record(self.kind, step.name, jobIds, sizes,
+                                request)
+        self.submissions.append({
+            "step": step.name, "jobNum": jobNum, "submitted": time.time(),
+            "after": [dependency.name
+                      for dependency in self.dependencies(step)],
+            "samples": [str(task[0]) for task in step.tasks]
+            if step.tasks is not None else None,
+            "cpus": request["cpus"]})
+        return jobNum
+
+    async def submitSteps(self, stale):
+        """Submit the stale steps, each as soon as its dependencies are."""
+        limit = asyncio.Semaphore(jobs.CONCURRENCY)
+        submitted = {}
+        for step in self.order():
+            if step in stale:
+                submitted[step] = asyncio.ensure_future(
+                    self.submitStep(step, submitted, limit))
+            elif step.run:
+                print(f"Skipping {self.name}_{step.name}, outputs are cached")
+        for step, jobNum in zip(submitted, await asyncio.gather(
+                *submitted.values())):
+            step.jobNum = jobNum
+
+    def submit(self):
+        """Submit every stale step, independent branches side by side.
+
+        Steps are submitted concurrently, at most jobs.CONCURRENCY sbatch
+        calls at a time, each after those of the steps it depends on. Unless
+        sizing is off the jobs are recorded in the resources history, whose
+        finished jobs' usage is collected first. The submissions are added
+        to the timeline.
+        """
+        stale = self.stale()
+        if self.sizing != "off":
+            self.history = resources.History()
+            self.history.collect(jobs.executor)
+        try:
+            asyncio.run(self.submitSteps(stale))
+        finally:
+            if self.history:
+                self.history.close()
+                self.history = None
+            if self.timeline and self.submissions:
+                timeline.recordSubmissions(self.logs, self.name,
+                                           self.submissions)
+                self.submissions = []
+        path, total = self.criticalPath(stale)
+        print(f"Critical path of {self.name} ({formatTime(total)}): " +
+              " -> ".join(step.name for step in path))
+        return [step.jobNum for step in self.steps if step.jobNum]
@@ -0,0 +1,194 @@
+"""Quality control summaries of fastq files, computed with NumPy.
+
+A summary holds histograms that add up across blocks, files and samples:
+the read lengths, the qualities and bases at each position, the GC
+content of each read and the mean quality of each read. It is saved as
+an npz of the histograms, which merge, and a json of the statistics
+derived from them.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import re
+
+import numpy as np
+
+from amaize import fastq
+
+QUALITIES = 64
+BASES = "ACGTN"
+CODES = np.full(256, BASES.index("N"), dtype=np.uint8)
+for code, base in enumerate(BASES[:4]):
+    CODES[ord(base)] = CODES[ord(base.lower())] = code
+
+
+def emptySummary():
+    """Return the summary of no reads."""
+    return {"reads": np.zeros(1, dtype=np.int64),
+            "lengths": np.zeros(1, dtype=np.int64),
+            "quality": np.zeros((0, QUALITIES), dtype=np.int64),
+            "composition": np.zeros((0, len(BASES)), dtype=np.int64),
+            "gc": np.zeros(101, dtype=np.int64),
+            "meanQuality": np.zeros(QUALITIES, dtype=np.int64)}
+
+
+def blockSummary(block):
+    """Return the summary of the reads of a block of whole records."""
+    return recordsSummary(fastq.Records(block))
+
+
+def recordsSummary(records):
+    """Return the summary of the reads of a parsed block.
+
+    The base and quality of every cell of the read matrices are counted
+    together per position with one bincount, cells past the end of a read
+    going to a last bin that is dropped.
+    """
+    lengths, width = records.lengths, records.width
+    valid = records.valid()
+    quals = np.clip(records.qualities().astype(np.int32) - 33, 0,
+                    QUALITIES - 1)
+    codes = CODES[records.bases()]
+    cells = QUALITIES * len(BASES)
+    joint = np.where(valid, np.arange(width, dtype=np.int32) *
+                     cells + quals * len(BASES) + codes, width * cells)
+    joint = np.bincount(joint.ravel(), minlength=width * cells + 1)[:-1]
+    joint = joint.reshape(width, QUALITIES, len(BASES))
+    read = lengths > 0
+    gc = (((codes == 1) | (codes == 2)) & valid).sum(axis=1)[read]
+    meanQuality = np.where(valid, quals, 0).sum(axis=1)[read] // \
+        lengths[read]
+    return {"reads": np.array([len(lengths)]),
+            "lengths": np.bincount(lengths),
+            "quality": joint.sum(axis=2),
+            "composition": joint.sum(axis=1),
+            "gc": np.bincount(np.rint(100 * gc / lengths[read])
+                              .astype(np.int64), minlength=101),
+            "meanQuality": np.bincount(meanQuality, minlength=QUALITIES)}
+
+
+def pad(histogram, rows):
+    """Return histogram with zero rows added up to rows."""
+    return np.pad(histogram, [(0, rows - len(histogram))] +
+                  [(0, 0)] * (histogram.ndim - 1))
+
+
+def merge(*summaries):
+    """Return the sum of summaries."""
+    merged = emptySummary()
+    for summary in summaries:
+        for key, histogram in summary.items():
+            rows = max(len(merged[key]), len(histogram))
+            merged[key] = pad(merged[key], rows) + pad(histogram, rows)
+    return merged
+
+
+def quantile(histogram, fraction):
+    """Return the value at fraction of each row of a 2D histogram."""
+    cumulative = histogram.cumsum(axis=1)
+    targets = fraction * cumulative[:, -1:]
+    return (cumulative < targets).sum(axis=1)
+
+
+def describe(summary):
+    """Return the statistics derived from a summary, for its json."""
+    lengths = summary["lengths"]
+    reads = int(summary["reads"][0])
+    bases = int((lengths * np.arange(len(lengths))).sum())
+    quality = summary["quality"]
+    covered = np.maximum(quality.sum(axis=1), 1)
+    composition = summary["composition"]
+    nonzero = np.flatnonzero(lengths)
+    return {
+        "reads": reads,
+        "bases": bases,
+        "minLength": int(nonzero[0]) if len(nonzero) else 0,
+        "maxLength": int(nonzero[-1]) if len(nonzero) else 0,
+        "meanLength": round(bases / reads, 2) if reads else 0,
+        "gcPercent": round(float(
+            composition[:, 1:3].sum() / max(composition.sum(), 1) * 100), 2),
+        "meanQualityByPosition": np.round(
+            (quality * np.arange(QUALITIES)).sum(axis=1) / covered,
+            2).tolist(),
+        "lowerQuartileByPosition": quantile(quality, 0.25).tolist(),
+        "medianQualityByPosition": quantile(quality, 0.5).tolist(),
+        "upperQuartileByPosition": quantile(quality, 0.75).tolist(),
+        "nPercentByPosition": np.round(
+            composition[:, 4] / covered * 100, 2).tolist()}
+
+
+def qcFile(path, threads=4, blockSize=fastq.BLOCK_SIZE):
+    """Return the summary of a fastq, counted by a pool of threads.
+
+    The fastq is decompressed by a reader thread, BGZF on threads more,
+    while blocks already read are counted by threads workers, with a
+    bounded number waiting.
+    """
+    summary = emptySummary()
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for block in fastq.prefetch(fastq.blocks(path, blockSize, threads),
+                                    threads):
+            pending.append(pool.submit(blockSummary, block))
+            if len(pending) > 2 * threads:
+                summary = merge(summary, pending.popleft().result())
+        for future in pending:
+            summary = merge(summary, future.result())
+    return summary
+
+
+def summaryPrefix(outDir, path):
+    """Return the output prefix of the summary of a fastq."""
+    name = re.sub(r"\.(fq|fastq)(\.gz)?$", "", os.path.basename(path))
+    return os.path.join(outDir, f"{name}_qc")
+
+
+def save(summary, prefix):
+    """Write the summary as prefix.npz and its statistics as prefix.json."""
+    np.savez_compressed(f"{prefix}.npz", **summary)
+    with open(f"{prefix}.json", 'w') as out:
+        json.dump(describe(summary), out, indent=1)
+
+
+def load(path):
+    """Read a summary from its npz."""
+    with np.load(path) as saved:
+        return {key: saved[key] for key in saved.files}
+
+
+def main():
+    """Parse the command line and summarize or merge fastq qc."""
+    parser = argparse.ArgumentParser(
+        description='Quality control summaries of fastq files')
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    parserRun = subparsers.add_parser(
+        'run', help='Summarize fastq files, one summary per file')
+    parserRun.add_argument('out', help='Output directory of the summaries')
+    parserRun.add_argument('fastqs', help='The fastq files, may be gzipped',
+                           nargs='+')
+    parserRun.add_argument(
+        '-t', '--threads',
+        help='Threads counting the blocks of each file. Default: 4',
+        type=int,
+        default=4)
+    parserMerge = subparsers.add_parser(
+        'merge', help='Merge summaries, for example across samples')
+    parserMerge.add_argument('out', help='Output prefix of the merged summary')
+    parserMerge.add_argument('summaries', help='The npz summaries',
+                             nargs='+')
+    args = parser.parse_args()
+
+    if args.command == "run":
+        os.makedirs(args.out, exist_ok=True)
+        for path in args.fastqs:
+            save(qcFile(path, args.threads), summaryPrefix(args.out, path))
+    else:
+        save(merge(*(load(path) for path in args.summaries)), args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Right-size the resources of pipeline steps from their past usage.
+
+Every job a pipeline submits is recorded in a SQLite history with the
+resources it asked for and the bytes of input it was given. Once finished,
+its elapsed time, cpu time and peak memory are collected from sacct, or
+from the local executor standing in for it. Later runs of a step can then
+ask for what its earlier runs used, scaled up for larger inputs, plus some
+headroom and never more than its script asks for.
+
+AMAIZE_RESOURCES sets what pipelines do: off, record the history (the
+default), suggest sizes or apply them. AMAIZE_RESOURCES_DB moves the
+history from ~/.amaize/resources.sqlite.
+"""
+
+import argparse
+import math
+import os
+import re
+import sqlite3
+import time
+
+from amaize import executors
+
+MODES = ("off", "record", "suggest", "apply")
+# the latest completed runs of a step sized on, and the fewest needed
+HISTORY = 20
+MIN_RUNS = 3
+MEMORY_HEADROOM = 1.25
+TIME_HEADROOM = 1.5
+CPU_HEADROOM = 1.2
+MIN_MEMORY = 500
+MIN_MINUTES = 10
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    jobId TEXT,
+    pipeline TEXT,
+    step TEXT,
+    submitted REAL,
+    inputBytes INTEGER,
+    cpus INTEGER,
+    memory REAL,
+    minutes INTEGER,
+    state TEXT,
+    elapsed REAL,
+    cpuSeconds REAL,
+    maxRss REAL)"""
+
+
+def mode():
+    """Return the AMAIZE_RESOURCES mode, record by default."""
+    value = os.environ.get("AMAIZE_RESOURCES", "record")
+    if value not in MODES:
+        raise ValueError(f"AMAIZE_RESOURCES must be one of {MODES}")
+    return value
+
+
+def defaultPath():
+    """Return the path of the history, AMAIZE_RESOURCES_DB if set."""
+    return os.environ.get("AMAIZE_RESOURCES_DB", os.path.join(
+        os.path.expanduser("~"), ".amaize", "resources.sqlite"))
+
+
+def slurmMinutes(value):
+    """Convert a slurm time limit such as 1-16:00 or 30:00 to minutes."""
+    days, dash, clock = value.rpartition("-")
+    parts = [int(part) for part in clock.split(":")]
+    if dash:
+        hours, minutes, seconds = parts + [0] * (3 - len(parts))
+    elif len(parts) == 3:
+        hours, minutes, seconds = parts
+    else:
+        hours, minutes, seconds = [0] + (parts + [0])[:2]
+    return int(days or 0) * 1440 + hours * 60 + minutes + \
+        math.ceil(seconds / 60)
+
+
+def requested(script):
+    """Return the cpus, memory in megabytes and minutes a script asks for.
+
+    Values a script leaves to the cluster default are 0. memoryOption is
+    the #SBATCH option the memory was asked with.
+    """
+    headers = dict(re.findall(r"^#SBATCH\s+--([\w-]+)=(\S+)", script,
+                              re.MULTILINE))
+    cpus = int(headers.get("cpus-per-task", 1))
+    if "mem" in headers:
+        memory, memoryOption = executors.megabytes(headers["mem"]), "mem"
+    else:
+        memory = executors.megabytes(headers.get("mem-per-cpu", "0")) * cpus
+        memoryOption = "mem-per-cpu"
+    minutes = slurmMinutes(headers["time"]) if "time" in headers else 0
+    return {"cpus": cpus, "memory": memory, "minutes": minutes,
+            "memoryOption": memoryOption}
+
+
+def inputBytes(paths):
+    """Return the total size of the paths that are existing files.
+
+    Inputs made by steps that have not run yet count as nothing, 0 meaning
+    the size is unknown.
+    """
+    return sum(os.path.getsize(path) for path in paths
+               if isinstance(path, str) and os.path.isfile(path))
+
+
+def scaled(runs, key, size):
+    """Return the most any run used of key, scaled up to an input of size.
+
+    Runs on smaller inputs are scaled up in proportion, but never down, so
+    the fixed costs of a step are kept.
+    """
+    return max(run[key] * (max(1, size / run["inputBytes"])
+                           if size and run["inputBytes"] else 1)
+               for run in runs)
+
+
+class History:
+    """The SQLite history of the jobs submitted and what they used."""
+
+    def __init__(self, path=None):
+        path = path or defaultPath()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the history."""
+        self.db.close()
+
+    def record(self, pipeline, step, jobIds, sizes, request):
+        """Record the jobs or array tasks submitted for a step.
+
+        sizes are the input bytes of each, request what was asked for. A
+        pending job with a reused id, such as those the local executor
+        numbers from 1 each run, is marked LOST.
+        """
+        with self.db:
+            self.db.executemany(
+                "UPDATE jobs SET state = 'LOST' WHERE jobId = ? AND "
+                "state IS NULL", [(jobId,) for jobId in jobIds])
+            self.db.executemany(
+                "INSERT INTO jobs (jobId, pipeline, step, "
+                "submitted, inputBytes, cpus, memory, minutes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(jobId, pipeline, step, time.time(), size, request["cpus"],
+                  request["memory"], request["minutes"])
+                 for jobId, size in zip(jobIds, sizes)])
+
+    def pending(self):
+        """Return the job numbers whose usage has not been collected."""
+        return sorted({executors.baseJob(row["jobId"]) for row in
+                       self.db.execute("SELECT jobId FROM jobs "
+                                       "WHERE state IS NULL")})
+
+    def collect(self, executor):
+        """Fill in the usage of finished jobs, returning how many there were.
+
+        The executor's accounting is asked for every pending job at once.
+        """
+        jobNums = self.pending()
+        if not jobNums:
+            return 0
+        usage = executor.accounting(jobNums)
+        with self.db:
+            self.db.executemany(
+                "UPDATE jobs SET state = ?, elapsed = ?, cpuSeconds = ?, "
+                "maxRss = ? WHERE jobId = ? AND state IS NULL",
+                [(entry["state"], entry["elapsed"], entry["cpuSeconds"],
+                  entry["maxRss"], entry["jobId"]) for entry in usage])
+        return len(usage)
+
+    def runs(self, pipeline, step):
+        """Return the latest completed runs of a step of a pipeline."""
+        return self.db.execute(
+            "SELECT * FROM jobs WHERE pipeline = ? AND step = ? AND "
+            "state = 'COMPLETED' AND elapsed > 0 ORDER BY submitted DESC "
+            "LIMIT ?", (pipeline, step, HISTORY)).fetchall()
+
+    def suggest(self, pipeline, step, size, request):
+        """Return the cpus, memory and minutes a run of step should ask for.
+
+        Sized on the latest runs of the step in the pipeline for an input of
+        size bytes, with headroom, and capped at request. None until the
+        step has run MIN_RUNS times.
+        """
+        runs = self.runs(pipeline, step)
+        if len(runs) < MIN_RUNS:
+            return None
+        suggestion = dict(request)
+        cpus = max(run["cpuSeconds"] / run["elapsed"] for run in runs)
+        suggestion["cpus"] = max(1, math.ceil(cpus * CPU_HEADROOM))
+        suggestion["memory"] = max(MIN_MEMORY, math.ceil(
+            scaled(runs, "maxRss", size) * MEMORY_HEADROOM))
+        suggestion["minutes"] = max(MIN_MINUTES, math.ceil(
+            scaled(runs, "elapsed", size) / 60 * TIME_HEADROOM))
+        for key in ("cpus", "memory", "minutes"):
+            if request[key]:
+                suggestion[key] = min(suggestion[key], request[key])
+        return suggestion
+
+    def steps(self):
+        """Return the steps in the history with their counts of runs."""
+        return self.db.execute(
+            "SELECT pipeline, step, COUNT(*) AS jobs, "
+            "SUM(state = 'COMPLETED') AS completed, MAX(maxRss) AS maxRss, "
+            "MAX(elapsed) AS elapsed, MAX(memory) AS memory, "
+            "MAX(minutes) AS minutes FROM jobs "
+            "GROUP BY pipeline, step ORDER BY pipeline, step").fetchall()
+
+
+def main():
+    """Parse the command line and collect or show the usage history."""
+    parser = argparse.ArgumentParser(
+        description='Usage history of the jobs pipelines submitted')
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    subparsers.add_parser(
+        'collect', help='Collect the usage of finished jobs from sacct')
+    subparsers.add_parser(
+        'show', help='Show the usage and requests of each step')
+    parser.add_argument(
+        '-d', '--database', help='The history. Default: AMAIZE_RESOURCES_DB '
+        'or ~/.amaize/resources.sqlite')
+    args = parser.parse_args()
+
+    with History(args.database) as history:
+        if args.command == "collect":
+            print(f"Collected the usage of "
+                  f"{history.collect(executors.fromEnvironment())} jobs")
+            return
+        print("pipeline\tstep\tjobs\tcompleted\tmaxRss(M)\trequested(M)"
+              "\telapsed(m)\trequested(m)")
+        for row in history.steps():
+            print(f"{row['pipeline']}\t{row['step']}\t{row['jobs']}\t"
+                  f"{row['completed'] or 0}\t{row['maxRss'] or 0:.0f}\t"
+                  f"{row['memory'] or 0:.0f}\t"
+                  f"{(row['elapsed'] or 0) / 60:.1f}\t{row['minutes'] or 0}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,77 @@
-"""sbatch scripts."""
+"""The registry of sbatch scripts and the store they are submitted from.
 
+Each script is a template of its commands and the resources it asks for.
+Rendering fills in the #SBATCH headers and, where the commands use
+{cpus}, the threads they run, from the resources of the template with
+any overrides. Overrides are given per call, or per template in the json
+file AMAIZE_SBATCH_OVERRIDES names, such as {"trim_pe": {"cpus": 8}}.
 
-def fastqcScript():
-    """Return the fastqc script text."""
-    return """\
+A rendered script is stored once under the hash of its text, in
+AMAIZE_SCRIPTS or ~/.amaize/scripts, and every job and array task running
+the same text is submitted with that one file.
+"""
+
+import hashlib
+import json
+import os
+
+HEADER = """\
 #!/usr/bin/bash
 
 #SBATCH --nodes=1
 #SBATCH --ntasks=1
-#SBATCH --cpus-per-task=3
-#SBATCH --mem-per-cpu=500M
-#SBATCH --time=0-00:30
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem-per-cpu={memPerCpu}
+#SBATCH --time={time}
 
-# $1 is output directory of untreated fastqc reports
-# $2 is untreated fasta file or files
-
-module load fastqc/0.11.5
-fastqc -t 3 --noextract -o "$@"
+"""
+FOOTER = """\
 source .bashrc
 sreport
 """
+# paths of the scripts this process has stored or found stored
+stored = set()
 
 
-def trimPEScript():
-    """Return the fastqc script text."""
-    return """\
-#!/usr/bin/bash
+class Template:
+    """The commands of an sbatch script and the resources they ask for."""
 
-#SBATCH --nodes=1
-#SBATCH --ntasks=1
-#SBATCH --cpus-per-task=16
-#SBATCH --mem-per-cpu=1000M
-#SBATCH --time=0-03:00
+    def __init__(self, commands, cpus=1, memPerCpu="1000M", time="0-00:30"):
+        self.commands = commands
+        self.resources = {"cpus": cpus, "memPerCpu": memPerCpu, "time": time}
+
+    def render(self, **overrides):
+        """Return the script text with the resources overridden."""
+        unknown = set(overrides) - set(self.resources)
+        if unknown:
+            raise ValueError(f"Unknown resources {', '.join(sorted(unknown))}"
+                             f", expected {', '.join(self.resources)}")
+        resources = dict(self.resources, **overrides)
+        return HEADER.format(**resources) + \
+            self.commands.format(**resources) + FOOTER
 
+
+TEMPLATES = {
+    "fastqc": Template("""\
+# $1 is output directory of untreated fastqc reports
+# $2 is untreated fasta file or files
+
+module load fastqc/0.11.5
+fastqc -t {cpus} --noextract -o "$@"
+""", cpus=3, memPerCpu="500M"),
+    "qc": Template("""\
+# $1 is output directory of the qc summaries
+# $2 is fasta file or files
+
+python -m amaize.qc run -t {cpus} "$@"
+""", cpus=4),
+    "qc_merge": Template("""\
+# $1 is output prefix of the merged summary
+# $2 is summary npz file or files
+
+python -m amaize.qc merge "$@"
+""", time="0-00:05"),
+    "trimmomatic_pe": Template("""\
 # $1 is forward
 # $2 is reverse
 # $3 is output paired forward
@@ -41,135 +80,126 @@ def trimPEScript():
 # $6 is output unpaired reverse
 
 module load trimmomatic/0.36
-java -jar $EBROOTTRIMMOMATIC/trimmomatic-0.36.jar \
-    -threads 16
-    PE \
-    $1 $2 \
-    $3 $4 \
-    $5 $6 \
-    # ILLUMINACLIP:<find out>(fastqc?) \
-    LEADING:3 \
-    TRAILING:3 \
-    SLIDINGWINDOW:4:15 \
+# ILLUMINACLIP:<find out>(fastqc?)
+java -jar $EBROOTTRIMMOMATIC/trimmomatic-0.36.jar \\
+    PE \\
+    -threads {cpus} \\
+    $1 $2 \\
+    $3 $4 \\
+    $5 $6 \\
+    LEADING:3 \\
+    TRAILING:3 \\
+    SLIDINGWINDOW:4:15 \\
     MINLEN:36
-source .bashrc
-sreport
-"""
-
-
-def trimSEScript():
-    """Return the fastqc script text."""
-    return """\
-#!/usr/bin/bash
-
-#SBATCH --nodes=1
-#SBATCH --ntasks=1
-#SBATCH --cpus-per-task=16
-#SBATCH --mem-per-cpu=1000M
-#SBATCH --time=0-03:00
-
+""", cpus=16, time="0-03:00"),
+    "trimmomatic_se": Template("""\
 # $1 is input reads
 # $2 is output reads
 
 module load trimmomatic/0.36
-java -jar $EBROOTTRIMMOMATIC/trimmomatic-0.36.jar \
-    -threads 16
-    SE \
-    $1 \
-    $2 \
-    # ILLUMINACLIP:<find out>(fastqc?) \
-    LEADING:3 \
-    TRAILING:3 \
-    SLIDINGWINDOW:4:15 \
+# ILLUMINACLIP:<find out>(fastqc?)
+java -jar $EBROOTTRIMMOMATIC/trimmomatic-0.36.jar \\
+    SE \\
+    -threads {cpus} \\
+    $1 \\
+    $2 \\
+    LEADING:3 \\
+    TRAILING:3 \\
+    SLIDINGWINDOW:4:15 \\
     MINLEN:36
-source .bashrc
-sreport
-"""
-
+""", cpus=16, time="0-03:00"),
+    "trim_pe": Template("""\
+# $1 is forward
+# $2 is reverse
+# $3 is output paired forward
+# $4 is output unpaired forward
+# $5 is output paired reverse
+# $6 is output unpaired reverse
 
-def faidxScript():
-    """Return the faidx script text."""
-    return """\
-#!/usr/bin/bash
+python -m amaize.trim PE -p {cpus} "$@"
+""", cpus=16, time="0-03:00"),
+    "trim_se": Template("""\
+# $1 is input reads
+# $2 is output reads
 
-#SBATCH --nodes=1 
-#SBATCH --ntasks=1 
-#SBATCH --cpus-per-task=1
-#SBATCH --mem-per-cpu=4000M
-#SBATCH --time=0-00:05
+python -m amaize.trim SE -p {cpus} "$@"
+""", cpus=16, time="0-03:00"),
+    "faidx": Template("""\
+# $1 is the reference genome
 
 module load samtools/1.9
 samtools faidx $1
-source .bashrc
-sreport
-"""
-
-
-def sortVcfScript():
-    """Return the sort vcf scritp."""
-    return """\
-#!/usr/bin/bash
-
-#SBATCH --nodes=1 
-#SBATCH --ntasks=1 
-#SBATCH --cpus-per-task=1
-#SBATCH --mem-per-cpu=12000M
-#SBATCH --time=0-00:30
+""", memPerCpu="4000M", time="0-00:05"),
+    "index_fasta": Template("""\
+# $1 is the reference genome
 
+python -m amaize.faindex -p {cpus} $1
+""", cpus=8),
+    "sort_vcf": Template("""\
 # $1 is vcf file
-# $2 is output/input sorted vcf file
-# $3 is reference genome
-# $4 is output sorted vcf file with updated dict
-
-module load picard/2.18.9
-java -jar $EBROOTPICARD/picard.jar SortVcf \
-    I=$1 \
-    O=$2 \
-    SEQUENCE_DICTIONARY=$3
-java -jar $EBROOTPICARD/picard.jar UpdateVcfSequenceDictionary \
-    I=$2 \
-    O=$4 \
-    SEQUENCE_DICTIONARY=$3
-rm $2
-source .bashrc
-sreport
-"""
-
-
-def picardIndexScript():
-    """Return the picard index script."""
-    return """\
-#!/usr/bin/bash
-
-#SBATCH --nodes=1 
-#SBATCH --ntasks=1 
-#SBATCH --cpus-per-task=1
-#SBATCH --mem-per-cpu=4000M
-#SBATCH --time=0-00:05
+# $2 is reference genome
+# $3 is output sorted vcf file with updated dict
 
+python -m amaize.vcf sort -m 1000 $1 $2 $3
+""", memPerCpu="2000M"),
+    "picard_index": Template("""\
 # $1 is the reference genome
 
 module load picard/2.18.9
-java -jar $EBROOTPICARD/picard.jar CreateSequenceDictionary \
+java -jar $EBROOTPICARD/picard.jar CreateSequenceDictionary \\
     REFERENCE=$1 OUTPUT=$1.dict
-source .bashrc
-sreport
-"""
-
-
-def bwaIndexScript():
-    """Return the bwa index script."""
-    return """\
-#!/usr/bin/bash
-
-#SBATCH --nodes=1 
-#SBATCH --ntasks=1 
-#SBATCH --cpus-per-task=1
-#SBATCH --mem-per-cpu=4000M
-#SBATCH --time=0-01:00
+""", memPerCpu="4000M", time="0-00:05"),
+    "bwa_index": Template("""\
+# $1 is the reference genome
 
 module load bwa/0.7.17
 bwa index $1
-source .bashrc
-sreport
-"""
+""", memPerCpu="4000M", time="0-01:00"),
+}
+
+
+def overrides(name):
+    """Return the resource overrides of a template from its json file."""
+    path = os.environ.get("AMAIZE_SBATCH_OVERRIDES")
+    if not path:
+        return {}
+    with open(path) as settings:
+        return json.load(settings).get(name, {})
+
+
+def render(name, **resources):
+    """Return the text of a registered script.
+
+    resources override those of the template and of the overrides file.
+    """
+    if name not in TEMPLATES:
+        raise ValueError(f"No sbatch script {name}, expected one of "
+                         f"{', '.join(TEMPLATES)}")
+    return TEMPLATES[name].render(**dict(overrides(name), **resources))
+
+
+def scriptsDir():
+    """Return the directory of the store, AMAIZE_SCRIPTS if set."""
+    return os.environ.get("AMAIZE_SCRIPTS", os.path.join(
+        os.path.expanduser("~"), ".amaize", "scripts"))
+
+
+def store(script):
+    """Return the path of the stored script text, storing it if new.
+
+    The file is named for the hash of the text, so it is never changed or
+    removed while jobs are queued on it. It is written to a temp name and
+    renamed, so concurrent writers of the same text do not clash.
+    """
+    digest = hashlib.sha256(script.encode()).hexdigest()[:24]
+    path = os.path.join(scriptsDir(), f"{digest}.sh")
+    if path in stored:
+        return path
+    if not os.path.exists(path):
+        os.makedirs(scriptsDir(), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, 'w') as scriptFile:
+            scriptFile.write(script)
+        os.replace(temp, path)
+    stored.add(path)
+    return path
@@ -0,0 +1,300 @@
+"""Timelines of the jobs pipelines ran, and where each sample's time went.
+
+A pipeline records when it submitted each step, and the script of every job
+marks when it started and ended with the cpu time and bytes read and
+written of its commands by then, taken from /proc, in a file of its own in
+the timeline directory of the pipeline's logs. Together they split the time
+of each task into waiting on the steps it depends on, waiting in the queue
+and running, which export as a Chrome trace to view in Perfetto or
+chrome://tracing, and summarize as the critical path of each sample.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+MARK_FIELDS = ("event", "time", "jobNum", "cpuTicks", "read", "written",
+               "diskRead", "diskWritten")
+
+MARK = """
+amaize_marks={marks}_${{SLURM_ARRAY_TASK_ID:-0}}.tsv
+amaize_mark() {{
+    printf '%s\\t%s\\t%s\\t%s\\n' "$1" "$(date +%s.%N)" \\
+        "${{SLURM_ARRAY_JOB_ID:-${{SLURM_JOB_ID:-}}}}" "$(awk -v OFS='\\t' \\
+        'NR == FNR {{cpu = $14 + $15 + $16 + $17; next}} {{io[$1] = $2}}
+        END {{print cpu, io["rchar:"], io["wchar:"], io["read_bytes:"],
+        io["write_bytes:"]}}' /proc/$$/stat /proc/$$/io 2> /dev/null)" \\
+        >> "$amaize_marks"
+}}
+: > "$amaize_marks"
+amaize_mark start
+trap 'amaize_mark end' EXIT
+"""
+
+
+def directory(logs):
+    """Return the timeline directory of a pipeline's logs."""
+    return os.path.join(logs, "timeline")
+
+
+def instrument(script, logs, task):
+    """Return script marking its start and end in the timeline of logs.
+
+    The marks go after the #SBATCH headers, so they time everything the
+    job runs, in a file named for task and the array task id.
+    """
+    os.makedirs(directory(logs), exist_ok=True)
+    lines = script.splitlines(keepends=True)
+    last = max((i for i, line in enumerate(lines)
+                if line.startswith("#SBATCH")), default=0)
+    return "".join(lines[:last + 1] + [MARK.format(
+        marks=os.path.join(os.path.abspath(directory(logs)), task))] +
+        lines[last + 1:])
+
+
+def recordSubmissions(logs, pipeline, submissions):
+    """Append the steps a pipeline submitted to its timeline.
+
+    Each submission has the step name, job number, submission time, the
+    names of the steps it depends on and the sample of each array task.
+    """
+    with open(os.path.join(directory(logs), f"{pipeline}.jsonl"),
+              'a') as out:
+        for submission in submissions:
+            out.write(json.dumps(submission) + "\n")
+
+
+def readMarks(path):
+    """Return the start and end marks of a task by event, with numbers."""
+    marks = {}
+    with open(path) as lines:
+        for line in lines:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                continue
+            mark = dict(zip(MARK_FIELDS, fields))
+            for key in MARK_FIELDS[3:]:
+                mark[key] = int(mark.get(key) or 0)
+            mark["time"] = float(mark["time"])
+            marks[mark["event"]] = mark
+    return marks
+
+
+def load(logs):
+    """Return the tasks of the latest submission of each pipeline step.
+
+    A task has its pipeline, step, sample, job id, the steps it depends on,
+    when it was submitted, started and ended, and its cpu seconds and bytes
+    read and written. Those not yet started or ended have no start or end.
+    Marks left by an earlier job of the same step are ignored.
+    """
+    tasks = []
+    for path in sorted(glob.glob(os.path.join(directory(logs), "*.jsonl"))):
+        pipeline = os.path.basename(path)[:-len(".jsonl")]
+        with open(path) as lines:
+            latest = {submission["step"]: submission for submission in
+                      map(json.loads, lines)}
+        for submission in latest.values():
+            samples = submission["samples"] or [pipeline]
+            for index, sample in enumerate(samples):
+                marks = os.path.join(
+                    directory(logs),
+                    f"{pipeline}_{submission['step']}_{index}.tsv")
+                task = {"pipeline": pipeline, "step": submission["step"],
+                        "sample": sample,
+                        "array": bool(submission["samples"]),
+                        "jobId": submission["jobNum"] + (
+                            f"_{index}" if submission["samples"] else ""),
+                        "after": submission["after"],
+                        "submitted": submission["submitted"],
+                        "cpus": submission["cpus"]}
+                events = readMarks(marks) if os.path.exists(marks) else {}
+                if any(mark["jobNum"] != submission["jobNum"]
+                       for mark in events.values()):
+                    events = {}
+                if "start" in events:
+                    task["start"] = events["start"]["time"]
+                if "start" in events and "end" in events:
+                    task["end"] = events["end"]["time"]
+                    task["cpuSeconds"] = (events["end"]["cpuTicks"] -
+                                          events["start"]["cpuTicks"]) / \
+                        CLOCK_TICKS
+                    for key in MARK_FIELDS[4:]:
+                        task[key] = events["end"][key] - \
+                            events["start"][key]
+                tasks.append(task)
+    return tasks
+
+
+def upstream(task, tasks):
+    """Return the tasks of the steps task depends on, for its sample.
+
+    An array task depends on the task of its sample in a dependency that is
+    an array too, and on the whole of one that is not.
+    """
+    return [other for other in tasks
+            if other["pipeline"] == task["pipeline"] and
+            other["step"] in task["after"] and
+            (not (task["array"] and other["array"]) or
+             other["sample"] == task["sample"])]
+
+
+def phases(task, tasks):
+    """Return when task was waiting on its dependencies, queued and ran.
+
+    Each phase is a start and end time, None if it has not begun. Waiting
+    ends when the last task it depends on does, or when it was submitted.
+    """
+    ready = max([task["submitted"]] + [other.get("end", time.time())
+                                       for other in upstream(task, tasks)])
+    now = time.time()
+    start = task.get("start")
+    return {"waiting": (task["submitted"], min(ready, start or now)),
+            "queued": (min(ready, start or now), start or now),
+            "running": (start, task.get("end", now)) if start else None}
+
+
+def trace(tasks):
+    """Return the tasks as a Chrome trace, a process per sample.
+
+    Each step is a thread of the processes of its samples, its tasks spans
+    waiting on dependencies, queued and running, timed from the first
+    submission. Running spans hold the task's usage.
+    """
+    origin = min((task["submitted"] for task in tasks), default=0)
+    pids, tids, events = {}, {}, []
+    for task in tasks:
+        process = f"{task['pipeline']} {task['sample']}" \
+            if task["array"] else task["pipeline"]
+        if process not in pids:
+            pids[process] = len(pids) + 1
+            events.append({"ph": "M", "name": "process_name",
+                           "pid": pids[process], "tid": 0,
+                           "args": {"name": process}})
+        pid = pids[process]
+        if (pid, task["step"]) not in tids:
+            tids[pid, task["step"]] = len(tids) + 1
+            events.append({"ph": "M", "name": "thread_name", "pid": pid,
+                           "tid": tids[pid, task["step"]],
+                           "args": {"name": task["step"]}})
+        for phase, span in phases(task, tasks).items():
+            if not span or span[1] <= span[0]:
+                continue
+            event = {"ph": "X", "cat": phase, "pid": pid,
+                     "tid": tids[pid, task["step"]],
+                     "name": task["step"] if phase == "running" else phase,
+                     "ts": round((span[0] - origin) * 1e6),
+                     "dur": round((span[1] - span[0]) * 1e6),
+                     "args": {"jobId": task["jobId"]}}
+            if phase == "running" and "end" in task:
+                event["args"].update(
+                    {key: task[key] for key in
+                     ("cpus", "cpuSeconds") + MARK_FIELDS[4:]})
+            events.append(event)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def criticalPath(sample, tasks):
+    """Return the chain of tasks that finished a sample last.
+
+    It runs from the task of the sample that ended last back through the
+    task it depended on that ended last. The sample's tasks are its array
+    tasks and the single jobs of its pipelines.
+    """
+    own = [task for task in tasks if task["sample"] == sample or
+           not task["array"] and any(other["sample"] == sample and
+                                     other["pipeline"] == task["pipeline"]
+                                     for other in tasks)]
+    path = []
+    task = max(own, key=lambda task: task.get("end", time.time()),
+               default=None)
+    while task:
+        path.append(task)
+        task = max(upstream(task, own),
+                   key=lambda task: task.get("end", time.time()),
+                   default=None)
+    return path[::-1]
+
+
+def formatSeconds(seconds):
+    """Format seconds as H:MM:SS."""
+    seconds = round(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def summary(tasks):
+    """Return a table of the critical path of each sample.
+
+    For each task it shows the time queued after its dependencies ended
+    and spent running, the share of its cpus used and the megabytes read
+    and written. A task using little of its cpus while moving many bytes
+    is bound by I/O.
+    """
+    lines = []
+    arrays = {task["pipeline"] for task in tasks if task["array"]}
+    samples = sorted({task["sample"] for task in tasks if task["array"]} |
+                     {task["pipeline"] for task in tasks} - arrays)
+    for sample in samples:
+        path = criticalPath(sample, tasks)
+        if not path:
+            continue
+        spans = [phases(task, tasks) for task in path]
+        queued = sum(span["queued"][1] - span["queued"][0] for span in spans)
+        running = sum(span["running"][1] - span["running"][0]
+                      for span in spans if span["running"])
+        wall = (path[-1].get("end") or time.time()) - path[0]["submitted"]
+        lines.append(f"Critical path of {sample} ({formatSeconds(wall)}): "
+                     f"{formatSeconds(queued)} queued, "
+                     f"{formatSeconds(running)} running")
+        lines.append("step\tjobId\tqueued\trunning\tcpu(%)\tread(M)"
+                     "\twritten(M)\tio(M/s)")
+        for task, span in zip(path, spans):
+            ran = span["running"][1] - span["running"][0] \
+                if span["running"] else 0
+            if "end" not in task:
+                usage = "\t".join(["-"] * 4)
+            else:
+                megabytes = [task[key] / 1e6 for key in ("read", "written")]
+                usage = (f"{100 * task['cpuSeconds'] / task['cpus'] / ran:.0f}"
+                         if ran else "-") + "".join(
+                    f"\t{value:.1f}" for value in megabytes) + \
+                    (f"\t{sum(megabytes) / ran:.1f}" if ran else "\t-")
+            lines.append(
+                f"{task['step']}\t{task['jobId']}\t"
+                f"{formatSeconds(span['queued'][1] - span['queued'][0])}\t"
+                f"{formatSeconds(ran) if span['running'] else '-'}\t{usage}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def main():
+    """Parse the command line and export or summarize a timeline."""
+    parser = argparse.ArgumentParser(
+        description='Timelines of the jobs pipelines submitted')
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    traceParser = subparsers.add_parser(
+        'trace', help='Export a Chrome trace for Perfetto or chrome://tracing')
+    summaryParser = subparsers.add_parser(
+        'summary', help='Show the critical path of each sample')
+    for subparser in (traceParser, summaryParser):
+        subparser.add_argument(
+            'logs', help='The logs directory of the pipelines')
+    traceParser.add_argument(
+        'out', help='The trace json to write')
+    args = parser.parse_args()
+
+    tasks = load(args.logs)
+    if args.command == "trace":
+        with open(args.out, 'w') as out:
+            json.dump(trace(tasks), out)
+        print(f"Wrote {len(tasks)} tasks to {args.out}")
+        return
+    print(summary(tasks), end="")
+
+
+if __name__ == "__main__":
+    main()
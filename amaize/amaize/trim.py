@@ -0,0 +1,306 @@
+"""Quality trimming of fastq reads, as the Trimmomatic step configures it.
+
+The reads are trimmed with LEADING:3 TRAILING:3 SLIDINGWINDOW:4:15
+MINLEN:36 by default, each operation applied to what the previous one
+left, computed for a block of reads at a time on its quality matrix.
+Outputs are written as BGZF.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from amaize import bgzf, fastq, qc
+
+BLOCK_READS = 16384
+
+
+class Settings:
+    """The trimming operations and their thresholds."""
+
+    def __init__(self, leading=3, trailing=3, window=4, quality=15,
+                 minLength=36, level=6):
+        self.leading = leading
+        self.trailing = trailing
+        self.window = window
+        self.quality = quality
+        self.minLength = minLength
+        self.level = level
+
+
+def lastTrue(matrix):
+    """Return one past the last True column of each row, 0 if none."""
+    return np.where(matrix.any(axis=1),
+                    matrix.shape[1] - matrix[:, ::-1].argmax(axis=1), 0)
+
+
+def trimBounds(records, settings):
+    """Return the first and past the last base kept of each read.
+
+    LEADING and TRAILING drop bases below their quality from either end.
+    SLIDINGWINDOW then scans windows from the start of what is left and at
+    the first window whose mean quality is below the threshold cuts the
+    read at the end of that window. Cut or not, the read is then trimmed
+    back to its last base of at least the threshold quality. A read whose
+    first window fails, or that is shorter than a window when it reaches
+    SLIDINGWINDOW, is dropped, as Trimmomatic does. A read the window cuts
+    shorter than a window is kept if it is as long as MINLEN, as are all
+    reads kept.
+    """
+    if not records.width:
+        starts = np.zeros(len(records), dtype=np.int64)
+        return starts, starts, starts > 0
+    quals = np.where(records.valid(),
+                     records.qualities().astype(np.int16) - 33, -1)
+    width = quals.shape[1]
+    columns = np.arange(width)
+
+    leading = quals >= settings.leading
+    starts = leading.argmax(axis=1)
+    ends = np.where(leading.any(axis=1), lastTrue(
+        (quals >= settings.trailing) & (columns >= starts[:, None])), 0)
+    ends = np.maximum(ends, starts)
+
+    window = settings.window
+    short = ends - starts < window
+    if width >= window:
+        count = width - window + 1
+        windows = quals[:, :count].copy()
+        for offset in range(1, window):
+            windows += quals[:, offset:offset + count]
+        positions = np.arange(count)
+        failing = ((positions >= starts[:, None]) &
+                   (positions + window <= ends[:, None]) &
+                   (windows < settings.quality * window))
+        failed = failing.any(axis=1)
+        cuts = np.where(failed, failing.argmax(axis=1) + window - 1, ends)
+        good = lastTrue((quals >= settings.quality) &
+                        (columns < cuts[:, None]) &
+                        (columns >= starts[:, None]))
+        ends = np.maximum(good, starts)
+        ends[failed & (cuts - window + 1 == starts)] = 0
+    ends[short] = 0
+    ends = np.maximum(ends, starts)
+    return starts, ends, ends - starts >= max(settings.minLength, 1)
+
+
+def trimmedMember(records, bounds, reads, settings, summaries):
+    """Return the BGZF blocks of reads trimmed to bounds.
+
+    If summaries is a list the qc summary of the trimmed reads is added.
+    """
+    starts, ends, _ = bounds
+    text = records.select(reads, starts[reads], ends[reads])
+    if summaries is not None:
+        summaries.append(qc.blockSummary(text))
+    return bgzf.compress(text, settings.level)
+
+
+def trimSingleBlock(job):
+    """Trim a block of single end reads into BGZF blocks of those kept.
+
+    With summarize the qc summaries of the block before and after trimming
+    are returned as well, otherwise None.
+    """
+    block, settings, summarize = job
+    records = fastq.Records(block)
+    bounds = trimBounds(records, settings)
+    reads = np.flatnonzero(bounds[2])
+    summaries = [qc.recordsSummary(records)] if summarize else None
+    member = trimmedMember(records, bounds, reads, settings, summaries)
+    return member, len(records), len(reads), summaries
+
+
+def trimPairBlock(job):
+    """Trim a block of read pairs into BGZF blocks of the four outputs.
+
+    Pairs where both reads are kept go to the paired outputs, pairs where
+    only one is kept put it in its unpaired output. With summarize the qc
+    summaries of both mates and then of the four outputs are returned as
+    well, otherwise None.
+    """
+    forwardBlock, reverseBlock, settings, summarize = job
+    outs, counts = [], []
+    mates = [fastq.Records(forwardBlock), fastq.Records(reverseBlock)]
+    if len(mates[0]) != len(mates[1]):
+        raise ValueError("The forward and reverse fastqs hold different "
+                         "numbers of reads")
+    summaries = [qc.recordsSummary(records) for records in mates] \
+        if summarize else None
+    bounds = [trimBounds(records, settings) for records in mates]
+    both = bounds[0][2] & bounds[1][2]
+    for records, mateBounds in zip(mates, bounds):
+        for reads in (np.flatnonzero(both),
+                      np.flatnonzero(mateBounds[2] & ~both)):
+            outs.append(trimmedMember(records, mateBounds, reads, settings,
+                                      summaries))
+            counts.append(len(reads))
+    return outs, len(both), counts[0], counts[1], counts[3], summaries
+
+
+def saveSummaries(summaries, rawQc, trimmedQc, raws, trimmed):
+    """Save the summaries of the raw and trimmed fastqs to their qc dirs."""
+    raws, trimmed = list(raws), list(trimmed)
+    for outDir, paths, fastqSummaries in (
+            (rawQc, raws, summaries[:len(raws)]),
+            (trimmedQc, trimmed, summaries[len(raws):])):
+        if not outDir:
+            continue
+        os.makedirs(outDir, exist_ok=True)
+        for path, summary in zip(paths, fastqSummaries):
+            qc.save(summary, qc.summaryPrefix(outDir, path))
+
+
+def addSummaries(totals, summaries):
+    """Return the running totals with the summaries of a block merged in."""
+    if summaries is None:
+        return totals
+    if totals is None:
+        return summaries
+    return [qc.merge(total, summary)
+            for total, summary in zip(totals, summaries)]
+
+
+def trimSingle(reads, out, settings, processes=1, rawQc=None,
+               trimmedQc=None):
+    """Trim single end reads into out on a pool of processes.
+
+    If rawQc or trimmedQc are given the qc summaries of the reads before or
+    after trimming are saved there, counted from the same blocks.
+    """
+    summarize = bool(rawQc or trimmedQc)
+    with multiprocessing.Pool(processes) as pool, open(out, 'wb') as trimmed:
+        total = kept = 0
+        summaries = None
+        jobs = ((block, settings, summarize) for block in fastq.prefetch(
+            fastq.countedBlocks(reads, BLOCK_READS)))
+        for member, count, survived, blockSummaries in fastq.orderedMap(
+                pool, trimSingleBlock, jobs, 2 * processes):
+            trimmed.write(member)
+            total += count
+            kept += survived
+            summaries = addSummaries(summaries, blockSummaries)
+        trimmed.write(bgzf.EOF)
+    if summarize:
+        saveSummaries(summaries or [qc.emptySummary()] * 2, rawQc,
+                      trimmedQc, [reads], [out])
+    print(f"Input Reads: {total} Surviving: {kept} "
+          f"Dropped: {total - kept}")
+    return total
+
+
+def trimPaired(forward, reverse, outs, settings, processes=1, rawQc=None,
+               trimmedQc=None):
+    """Trim read pairs into the paired and unpaired outs of each mate.
+
+    outs are the forward paired, forward unpaired, reverse paired and
+    reverse unpaired fastqs, as Trimmomatic orders them. If rawQc or
+    trimmedQc are given the qc summaries of the mates before or of the outs
+    after trimming are saved there, counted from the same blocks.
+    """
+    summarize = bool(rawQc or trimmedQc)
+    with multiprocessing.Pool(processes) as pool:
+        files = [open(out, 'wb') for out in outs]
+        try:
+            total = both = forwardOnly = reverseOnly = 0
+            summaries = None
+            jobs = ((forwardBlock, reverseBlock, settings, summarize)
+                    for forwardBlock, reverseBlock in zip(
+                        fastq.prefetch(fastq.countedBlocks(forward,
+                                                           BLOCK_READS)),
+                        fastq.prefetch(fastq.countedBlocks(reverse,
+                                                           BLOCK_READS))))
+            for members, count, paired, forwardKept, reverseKept, \
+                    blockSummaries in fastq.orderedMap(
+                        pool, trimPairBlock, jobs, 2 * processes):
+                for out, member in zip(files, members):
+                    out.write(member)
+                total += count
+                both += paired
+                forwardOnly += forwardKept
+                reverseOnly += reverseKept
+                summaries = addSummaries(summaries, blockSummaries)
+            for out in files:
+                out.write(bgzf.EOF)
+        finally:
+            for out in files:
+                out.close()
+    if summarize:
+        saveSummaries(summaries or [qc.emptySummary()] * 6, rawQc,
+                      trimmedQc, [forward, reverse], outs)
+    print(f"Input Read Pairs: {total} Both Surviving: {both} "
+          f"Forward Only Surviving: {forwardOnly} "
+          f"Reverse Only Surviving: {reverseOnly} "
+          f"Dropped: {total - both - forwardOnly - reverseOnly}")
+    return total
+
+
+def main():
+    """Parse the command line and trim single or paired end reads."""
+    parser = argparse.ArgumentParser(
+        description=('Quality trim fastq reads like Trimmomatic LEADING, '
+                     'TRAILING, SLIDINGWINDOW and MINLEN'))
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    parserPE = subparsers.add_parser('PE', help='Trim paired end reads')
+    parserPE.add_argument('forward', help='The forward reads')
+    parserPE.add_argument('reverse', help='The reverse reads')
+    parserPE.add_argument(
+        'outs', nargs=4,
+        help=('The forward paired, forward unpaired, reverse paired and '
+              'reverse unpaired outputs'))
+    parserSE = subparsers.add_parser('SE', help='Trim single end reads')
+    parserSE.add_argument('reads', help='The reads')
+    parserSE.add_argument('out', help='The trimmed reads')
+    for subparser in (parserPE, parserSE):
+        subparser.add_argument(
+            '-p', '--processes',
+            help='Number of blocks trimmed at once. Default: all cpus',
+            type=int,
+            default=len(os.sched_getaffinity(0)))
+        subparser.add_argument(
+            '--leading', help='LEADING quality. Default: 3', type=int,
+            default=3)
+        subparser.add_argument(
+            '--trailing', help='TRAILING quality. Default: 3', type=int,
+            default=3)
+        subparser.add_argument(
+            '--window', help='SLIDINGWINDOW size. Default: 4', type=int,
+            default=4)
+        subparser.add_argument(
+            '--quality', help='SLIDINGWINDOW quality. Default: 15',
+            type=int, default=15)
+        subparser.add_argument(
+            '--minlen', help='MINLEN. Default: 36', type=int, default=36)
+        subparser.add_argument(
+            '--level', help='Gzip level of the outputs. Default: 6',
+            type=int, default=6)
+        subparser.add_argument(
+            '--raw_qc',
+            help=('Also save qc summaries of the reads before trimming to '
+                  'this directory'))
+        subparser.add_argument(
+            '--trimmed_qc',
+            help=('Also save qc summaries of the trimmed reads to this '
+                  'directory'))
+    args = parser.parse_args()
+
+    settings = Settings(args.leading, args.trailing, args.window,
+                        args.quality, args.minlen, args.level)
+    start = time.perf_counter()
+    if args.command == "PE":
+        reads = trimPaired(args.forward, args.reverse, args.outs, settings,
+                           args.processes, args.raw_qc, args.trimmed_qc)
+    else:
+        reads = trimSingle(args.reads, args.out, settings, args.processes,
+                           args.raw_qc, args.trimmed_qc)
+    seconds = time.perf_counter() - start
+    print(f"Trimmed {reads} reads in {seconds:.1f} s "
+          f"({reads / max(seconds, 1e-9):.0f} reads/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""Streaming tools for vcf files."""
+
+import argparse
+import collections
+import contextlib
+import heapq
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+
+from amaize import bgzf, fasta
+
+# bytes charged per held record on top of its length, for the line object,
+# its sort key and the list slot
+RECORD_OVERHEAD = 200
+
+MASK_NAME = "snps_near_indels"
+FILTER_NAME = "basic_snp_filter"
+# the terms of the hard filter in order, as GATK evaluates the expression
+HARD_FILTER = (("QD", np.less, 2.0), ("FS", np.greater, 60.0),
+               ("MQ", np.less, 40.0), ("ReadPosRankSum", np.less, -8.0),
+               ("SOR", np.greater, 4.0))
+
+
+def openVcf(path, mode='rb'):
+    """Open a plain or gzipped vcf as bytes, BGZF on threads."""
+    if path.endswith(".gz"):
+        return bgzf.open(path, mode)
+    return open(path, mode)
+
+
+def readDict(path):
+    """Return (name, length, fields) of each sequence of a .dict file."""
+    contigs = []
+    with open(path) as sequences:
+        for line in sequences:
+            if line.startswith("@SQ"):
+                fields = dict(field.split(":", 1)
+                              for field in line.rstrip("\n").split("\t")[1:])
+                contigs.append((fields.pop("SN"), int(fields.pop("LN")),
+                                fields))
+    return contigs
+
+
+def readFai(path):
+    """Return (name, length, fields) of each sequence of a .fai file."""
+    return [(name, length, {}) for name, length, *_ in fasta.readFai(path)]
+
+
+def contigOrder(reference):
+    """Return the contigs of a reference from its .dict, else its .fai.
+
+    reference is the genome or its .dict or .fai. The .dict is looked for
+    both next to the genome, as picard names it, and in place of its
+    extension.
+    """
+    if reference.endswith(".dict"):
+        return readDict(reference)
+    if reference.endswith(".fai"):
+        return readFai(reference)
+    for path in (f"{reference}.dict",
+                 f"{os.path.splitext(reference)[0]}.dict"):
+        if os.path.exists(path):
+            return readDict(path)
+    return readFai(f"{reference}.fai")
+
+
+def contigLines(contigs):
+    """Return the ##contig header lines of the contigs."""
+    names = {"M5": "md5", "AS": "assembly", "UR": "URL", "SP": "species"}
+    lines = []
+    for name, length, fields in contigs:
+        extra = "".join(f",{names[tag]}={value}"
+                        for tag, value in fields.items() if tag in names)
+        lines.append(f"##contig=<ID={name},length={length}{extra}>\n"
+                     .encode())
+    return lines
+
+
+def readMeta(vcf):
+    """Read the ## lines of the header of vcf and its #CHROM line."""
+    meta = []
+    line = vcf.readline()
+    while line.startswith(b"##"):
+        meta.append(line)
+        line = vcf.readline()
+    if not line.startswith(b"#CHROM"):
+        raise ValueError("The vcf has no #CHROM header line")
+    return meta, line
+
+
+def readHeader(vcf, contigs):
+    """Read the header of vcf, swapping its contig lines for contigs."""
+    meta, chrom = readMeta(vcf)
+    return [line for line in meta if not line.startswith(b"##contig=")] + \
+        contigLines(contigs) + [chrom]
+
+
+def sortKey(rank):
+    """Return a function giving the (contig rank, position) of a record."""
+    def key(line):
+        chrom, pos, _ = line.split(b"\t", 2)
+        try:
+            return rank[chrom], int(pos)
+        except KeyError:
+            raise ValueError(f"Contig {chrom.decode()} is not in the "
+                             "reference dictionary") from None
+    return key
+
+
+def spill(records, key, directory):
+    """Sort records and write them as a run, returning its path."""
+    records.sort(key=key)
+    with tempfile.NamedTemporaryFile('wb', dir=directory, suffix=".vcf",
+                                     delete=False) as run:
+        run.writelines(records)
+    return run.name
+
+
+def sortVcf(vcf, out, reference, memory=1000, tmp=None):
+    """Sort vcf by the contig order of reference into out.
+
+    Records are held up to about memory megabytes at a time, spilled to
+    sorted runs in tmp and merged, so any size of vcf sorts in bounded
+    memory. The ##contig header lines are replaced with those of the
+    reference in the same pass. Records of equal position keep their order.
+    """
+    contigs = contigOrder(reference)
+    key = sortKey({name.encode(): i for i, (name, *_) in enumerate(contigs)})
+    ceiling = memory * 1024 * 1024
+    with openVcf(vcf) as records, \
+            tempfile.TemporaryDirectory(dir=tmp) as directory:
+        header = readHeader(records, contigs)
+        runs, held, size = [], [], 0
+        for line in records:
+            if not line.strip():
+                continue
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            held.append(line)
+            size += len(line) + RECORD_OVERHEAD
+            if size >= ceiling:
+                runs.append(spill(held, key, directory))
+                held, size = [], 0
+        held.sort(key=key)
+
+        files = [open(run, 'rb') for run in runs]
+        try:
+            with openVcf(out, 'wb') as sortedVcf:
+                sortedVcf.writelines(header)
+                sortedVcf.writelines(heapq.merge(*files, held, key=key))
+        finally:
+            for run in files:
+                run.close()
+    return len(runs)
+
+
+def indelIndex(path, extension=3):
+    """Return the sorted starts and running ends of the indels per contig.
+
+    Each indel spans its ref allele widened by extension bases on both
+    sides. Ends are the running maximum so a position is masked if the last
+    span starting at or before it ends at or after it.
+    """
+    spans = collections.defaultdict(list)
+    with openVcf(path) as indels:
+        for line in indels:
+            if line.startswith(b"#"):
+                continue
+            contig, pos, _, ref, _ = line.split(b"\t", 4)
+            spans[contig].append((int(pos) - extension,
+                                  int(pos) + len(ref) - 1 + extension))
+    index = {}
+    for contig, intervals in spans.items():
+        intervals = np.array(sorted(intervals), dtype=np.int64)
+        index[contig] = (intervals[:, 0],
+                         np.maximum.accumulate(intervals[:, 1]))
+    return index
+
+
+def masked(index, contig, positions):
+    """Return which positions of a contig fall in an indel span."""
+    if contig not in index:
+        return np.zeros(len(positions), dtype=bool)
+    starts, ends = index[contig]
+    last = np.searchsorted(starts, positions, side='right') - 1
+    return (last >= 0) & (ends[np.maximum(last, 0)] >= positions)
+
+
+def infoColumns(infos, keys):
+    """Return a row of floats per key from INFO fields, NaN if missing."""
+    rows = {key.encode(): row for row, key in enumerate(keys)}
+    columns = np.full((len(keys), len(infos)), np.nan)
+    for i, info in enumerate(infos):
+        for field in info.split(b";"):
+            key, _, value = field.partition(b"=")
+            if key in rows:
+                try:
+                    columns[rows[key], i] = float(value)
+                except ValueError:
+                    pass
+    return columns
+
+
+def hardFiltered(columns):
+    """Return which records fail the hard filter, given their INFO columns.
+
+    Like GATK evaluating the expression, the terms are or-ed from left to
+    right and a missing annotation ends the evaluation without filtering.
+    """
+    failed = np.zeros(columns.shape[1], dtype=bool)
+    present = np.ones(columns.shape[1], dtype=bool)
+    for values, (_, compare, threshold) in zip(columns, HARD_FILTER):
+        failed |= present & compare(values, threshold)
+        present &= ~np.isnan(values)
+    return failed
+
+
+def filterLines():
+    """Return the ##FILTER header lines of the SNP filter."""
+    expression = " || ".join(
+        f"{key} {'<' if compare is np.less else '>'} {threshold}"
+        for key, compare, threshold in HARD_FILTER)
+    return [f'##FILTER=<ID={FILTER_NAME},Description="{expression}">\n'
+            .encode(),
+            f'##FILTER=<ID={MASK_NAME},Description="Overlaps a user-input '
+            'mask">\n'.encode()]
+
+
+def filterChunk(lines, index):
+    """Return the lines of SNP records with their FILTER column set."""
+    records = [line.rstrip(b"\r\n").split(b"\t") for line in lines]
+    contigs = np.array([fields[0] for fields in records])
+    positions = np.array([int(fields[1]) for fields in records])
+    near = np.zeros(len(records), dtype=bool)
+    for contig in np.unique(contigs):
+        rows = contigs == contig
+        near[rows] = masked(index, contig, positions[rows])
+    failed = hardFiltered(infoColumns([fields[7] for fields in records],
+                                      [key for key, *_ in HARD_FILTER]))
+    for fields, isNear, isFailed in zip(records, near, failed):
+        filters = set() if fields[6] in (b".", b"PASS") else \
+            set(fields[6].split(b";"))
+        if isNear:
+            filters.add(MASK_NAME.encode())
+        if isFailed:
+            filters.add(FILTER_NAME.encode())
+        fields[6] = b";".join(sorted(filters)) or b"PASS"
+    return [b"\t".join(fields) + b"\n" for fields in records]
+
+
+def filterSnps(snps, indels, out, extension=3, chunk=65536):
+    """Filter SNPs near indels or failing the hard filter into out.
+
+    The indels are indexed once, then the SNPs are streamed in chunks whose
+    INFO annotations are compared as arrays. Filtered SNPs are kept with
+    the names of the filters they failed, the rest pass.
+    """
+    index = indelIndex(indels, extension)
+    with openVcf(snps) as records, openVcf(out, 'wb') as filtered:
+        meta, chrom = readMeta(records)
+        names = {line.split(b",")[0] for line in filterLines()}
+        meta = [line for line in meta
+                if line.split(b",")[0] not in names]
+        filtered.writelines(meta + filterLines() + [chrom])
+        lines = []
+        for line in records:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk:
+                filtered.writelines(filterChunk(lines, index))
+                lines = []
+        if lines:
+            filtered.writelines(filterChunk(lines, index))
+
+
+def homozygousAlt(genotype):
+    """Return True if a GT value is homozygous for an alternate allele."""
+    alleles = set(genotype.replace(b"|", b"/").split(b"/"))
+    return len(alleles) == 1 and not alleles & {b"0", b"."}
+
+
+def carriesAlt(genotype):
+    """Return True if a GT value has an alternate allele."""
+    return bool(set(genotype.replace(b"|", b"/").split(b"/")) -
+                {b"0", b"."})
+
+
+def firstGenotype(fields):
+    """Return the GT of the first sample of a split record, else None."""
+    if len(fields) < 10:
+        return None
+    keys = fields[8].split(b":")
+    values = fields[9].rstrip(b"\r\n").split(b":")
+    if b"GT" not in keys or keys.index(b"GT") >= len(values):
+        return None
+    return values[keys.index(b"GT")]
+
+
+def variantType(ref, alts):
+    """Return b"SNP" or b"INDEL" for a record whose alleles are all one kind.
+
+    Records mixing kinds, multi base substitutions and symbolic alleles are
+    neither, as with SelectVariants.
+    """
+    alts = [alt for alt in alts.split(b",") if alt != b"*"]
+    if not alts or any(alt.startswith(b"<") or b"[" in alt or b"]" in alt
+                       for alt in alts):
+        return None
+    if len(ref) == 1 and all(len(alt) == 1 for alt in alts):
+        return b"SNP"
+    if all(len(alt) != len(ref) for alt in alts):
+        return b"INDEL"
+    return None
+
+
+@contextlib.contextmanager
+def bgzipped(path):
+    """Open path for writing as BGZF, and tabix index it once closed."""
+    with bgzf.open(path, 'wb') as out:
+        yield out
+    subprocess.run(["tabix", "-f", "-p", "vcf", path], check=True)
+
+
+def splitVariants(vcf, snps, indels, sample=None, bgzip=False):
+    """Split the records of vcf into homozygous alternate SNPs and indels.
+
+    The vcf is read once and both outputs written together. The SNP
+    genotype is that of the first sample. Given a sample, such as a line of
+    a jointly genotyped cohort, only its genotypes are kept and only the
+    indels it carries. With bgzip both outputs are bgzipped and tabix
+    indexed.
+    """
+    output = bgzipped if bgzip else (lambda path: openVcf(path, 'wb'))
+    with openVcf(vcf) as records, output(snps) as snpOut, \
+            output(indels) as indelOut:
+        meta, chrom = readMeta(records)
+        column = None
+        if sample:
+            names = chrom.rstrip(b"\r\n").split(b"\t")
+            column = names.index(sample.encode())
+            chrom = b"\t".join(names[:9] + [names[column]]) + b"\n"
+        snpOut.writelines(meta + [chrom])
+        indelOut.writelines(meta + [chrom])
+        for line in records:
+            if column:
+                fields = line.rstrip(b"\r\n").split(b"\t")
+                line = b"\t".join(fields[:9] + fields[column:column + 1]) \
+                    + b"\n"
+            fields = line.split(b"\t", 10)
+            kind = variantType(fields[3], fields[4]) if len(fields) > 4 \
+                else None
+            if kind == b"INDEL":
+                genotype = firstGenotype(fields)
+                if not column or genotype and carriesAlt(genotype):
+                    indelOut.write(line)
+            elif kind == b"SNP":
+                genotype = firstGenotype(fields)
+                if genotype and homozygousAlt(genotype):
+                    snpOut.write(line)
+
+
+def main():
+    """Parse the command line and run a vcf tool."""
+    parser = argparse.ArgumentParser(description='Streaming vcf tools')
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    parserSort = subparsers.add_parser(
+        'sort', help=('Sort a vcf by the contig order of a reference and '
+                      'update its contig header lines'))
+    parserSort.add_argument('vcf', help='The vcf to sort, may be gzipped')
+    parserSort.add_argument('reference',
+                            help='The reference genome, its .dict or .fai')
+    parserSort.add_argument('out', help='The sorted vcf, gzipped if .gz')
+    parserSort.add_argument(
+        '-m', '--memory',
+        help='Megabytes of records held before spilling a run. Default: 1000',
+        type=int,
+        default=1000)
+    parserSort.add_argument(
+        '-t', '--tmp',
+        help='Directory for the spilled runs. Default: the system temp dir')
+    parserFilter = subparsers.add_parser(
+        'filter', help=('Filter SNPs near indels or with poor annotations, '
+                        'as the GATK VariantFiltration step did'))
+    parserFilter.add_argument('snps', help='The SNP vcf')
+    parserFilter.add_argument('indels', help='The indel vcf to mask with')
+    parserFilter.add_argument('out', help='The filtered SNP vcf')
+    parserFilter.add_argument(
+        '-e', '--mask_extension',
+        help='Bases beyond each indel that SNPs are masked. Default: 3',
+        type=int,
+        default=3)
+    parserSplit = subparsers.add_parser(
+        'split', help=('Split a vcf into its homozygous alternate SNPs and '
+                       'its indels in one pass'))
+    parserSplit.add_argument('vcf', help='The vcf to split')
+    parserSplit.add_argument('snps', help='The SNP vcf to write')
+    parserSplit.add_argument('indels', help='The indel vcf to write')
+    parserSplit.add_argument(
+        '-s', '--sample',
+        help=('The sample of a multi-sample vcf to take, whose genotypes '
+              'select SNPs and indels. Default: the first, keeping every '
+              'indel'))
+    parserSplit.add_argument(
+        '-z', '--bgzip',
+        help='Write the outputs bgzipped and tabix indexed',
+        action='store_true')
+    args = parser.parse_args()
+
+    if args.command == "sort":
+        sortVcf(args.vcf, args.out, args.reference, args.memory, args.tmp)
+    elif args.command == "filter":
+        filterSnps(args.snps, args.indels, args.out, args.mask_extension)
+    elif args.command == "split":
+        splitVariants(args.vcf, args.snps, args.indels, args.sample,
+                      args.bgzip)
+
+
+if __name__ == "__main__":
+    main()
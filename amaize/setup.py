@@ -8,6 +8,7 @@ setup(
     description='maize-project modules',
     license='MIT',
     packages=find_packages(),
+    install_requires=['numpy'],
     author='Max Hargreaves',
     author_email='whargrea@uoguelph.ca',
     keywords=['na'],
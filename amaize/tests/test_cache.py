@@ -0,0 +1,78 @@
+"""Caching of pipeline steps run with the local executor."""
+
+import os
+
+import pytest
+
+from amaize import cache, executors, jobs
+from amaize.pipeline import Pipeline
+
+SCRIPT = """\
+#!/usr/bin/bash
+
+#SBATCH --cpus-per-task=1
+#SBATCH --mem-per-cpu=100M
+#SBATCH --time=0-00:01
+
+# $1 is the output
+{commands}
+report
+"""
+
+
+@pytest.fixture
+def executor(tmp_path, monkeypatch):
+    """Run jobs on a local executor, amaize importable from their scripts."""
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(
+        filter(None, (package, os.environ.get("PYTHONPATH")))))
+    monkeypatch.setenv("AMAIZE_SCRIPTS", str(tmp_path / "scripts"))
+    local = executors.LocalExecutor(cpus=2, mem=1000)
+    monkeypatch.setattr(jobs, "executor", local)
+    monkeypatch.setattr(jobs, "submitted", [])
+    return local
+
+
+def pipeline(tmp_path, commands, cached=True):
+    """Return a pipeline writing a.txt with commands and then b.txt."""
+    a, b = str(tmp_path / "a.txt"), str(tmp_path / "b.txt")
+    steps = Pipeline("t", jobs.outDir(str(tmp_path), "logs"), cache=cached,
+                     sizing="off", timeline=False)
+    steps.add("a", SCRIPT.format(commands=commands), a, outputs=[a])
+    steps.add("b", SCRIPT.format(commands='cp $1 $2'), a, b, inputs=[a],
+              outputs=[b])
+    return steps
+
+
+def states(executor):
+    """Wait for the jobs and return the name and state of each in order."""
+    executor.wait()
+    return [(task.name, task.state) for task in executor.tasks]
+
+
+def test_step_is_cached(tmp_path, executor, capsys):
+    pipeline(tmp_path, 'echo a > $1').submit()
+    assert states(executor) == [("t_a", "COMPLETED"), ("t_b", "COMPLETED")]
+    assert cache.manifests(str(tmp_path))
+
+    pipeline(tmp_path, 'echo a > $1').submit()
+    assert states(executor) == [("t_a", "COMPLETED"), ("t_b", "COMPLETED")]
+    assert "Skipping t_a, outputs are cached" in capsys.readouterr().out
+
+
+def test_failed_step_is_not_cached(tmp_path, executor, capsys):
+    failed = [("t_a", "FAILED"), ("t_b", "CANCELLED")]
+    pipeline(tmp_path, 'echo a > $1\nfalse').submit()
+    assert states(executor) == failed
+    assert os.path.exists(tmp_path / "a.txt")
+    assert not os.path.exists(tmp_path / "b.txt")
+    assert not cache.manifests(str(tmp_path))
+
+    pipeline(tmp_path, 'echo a > $1\nfalse').submit()
+    assert states(executor) == failed * 2
+    assert "outputs are cached" not in capsys.readouterr().out
+
+
+def test_failed_step_fails_its_job_uncached(tmp_path, executor):
+    pipeline(tmp_path, 'echo a > $1\nfalse', cached=False).submit()
+    assert states(executor) == [("t_a", "FAILED"), ("t_b", "CANCELLED")]
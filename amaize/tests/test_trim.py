@@ -0,0 +1,84 @@
+"""Trimming bounds against a read by read model of the Trimmomatic step."""
+
+import numpy as np
+import pytest
+
+from amaize import fastq, trim
+
+# no window fails but the read ends in a base below the window quality
+TAIL = [29, 0, 31, 29, 16, 32, 7, 33, 41, 19, 27, 12, 20, 19, 36, 11, 35, 39,
+        38, 32, 34, 3, 5, 34, 24, 32, 19, 30, 3, 21, 40, 21, 20, 2, 39, 34, 31,
+        10, 36, 31, 31, 17, 13]
+READS = [
+    TAIL,
+    [30] * 20 + [2, 2, 2],
+    [10, 12, 14, 20] + [30] * 40,
+    [30, 30, 2, 2] + [30] * 40,
+    [40, 40, 40],
+    [2, 2, 40, 40, 40, 2],
+    [2] * 10,
+    [30] * 45 + [10, 10, 10, 10] + [30] * 10,
+    [40, 40, 40, 10, 10, 10, 10, 10],
+]
+
+
+def reference(quals, settings):
+    """Return the bounds kept of one read, as Trimmomatic 0.36, or None."""
+    start = next((i for i, qual in enumerate(quals)
+                  if qual >= settings.leading), None)
+    if start is None:
+        return None
+    end = next(i + 1 for i in range(len(quals) - 1, -1, -1)
+               if quals[i] >= settings.trailing)
+    kept = quals[start:end]
+    window = settings.window
+    required = settings.quality * window
+    if len(kept) < window or sum(kept[:window]) < required:
+        return None
+    length = len(kept)
+    for i in range(1, len(kept) - window + 1):
+        if sum(kept[i:i + window]) < required:
+            length = i + window - 1
+            break
+    while length > 1 and kept[length - 1] < settings.quality:
+        length -= 1
+    if length < settings.minLength:
+        return None
+    return start, start + length
+
+
+def block(reads, newline=b"\n"):
+    """Return the fastq text of reads given as lists of qualities."""
+    return b"".join(newline.join((
+        f"@r{i}".encode(), b"A" * len(quals), b"+",
+        bytes(qual + 33 for qual in quals))) + newline
+        for i, quals in enumerate(reads))
+
+
+def bounds(reads, settings, newline=b"\n"):
+    """Return the bounds trimBounds keeps of each read, None if dropped."""
+    starts, ends, kept = trim.trimBounds(
+        fastq.Records(block(reads, newline)), settings)
+    return [(int(start), int(end)) if keep else None
+            for start, end, keep in zip(starts, ends, kept)]
+
+
+@pytest.mark.parametrize("minLength", [1, 36])
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n"])
+def test_trim_bounds_match_reference(minLength, newline):
+    random = np.random.default_rng(1)
+    reads = READS + [random.integers(0, 42, size).tolist()
+                     for size in random.integers(1, 80, 2000)]
+    settings = trim.Settings(minLength=minLength)
+    assert bounds(reads, settings, newline) == \
+        [reference(quals, settings) for quals in reads]
+
+
+def test_trailing_low_base_is_trimmed():
+    assert bounds([TAIL], trim.Settings()) == [(0, 42)]
+
+
+def test_first_window_and_short_reads_are_dropped():
+    settings = trim.Settings(minLength=1)
+    assert bounds([[10, 12, 14, 20] + [30] * 40, [40, 40, 40]],
+                  settings) == [None, None]
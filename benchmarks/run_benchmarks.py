@@ -0,0 +1,460 @@
+"""Benchmark the python hot paths on synthetic filltag, fastq and vcf data.
+
+The inputs are generated from a seed at a chosen scale, so every run of
+the same scale times the same data. Each benchmark runs in an interpreter
+of its own, timed around the call, with the peak RSS of that process or its
+largest worker taken from os.wait4. The results are written as json, which
+compare checks against those of another commit.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import types
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "filltag_to_fastq", "scripts"))
+sys.path.insert(0, os.path.join(HERE, "..", "amaize"))
+
+from amaize import bgzf, qc, trim, vcf  # noqa: E402
+
+# records of each input at scale 1
+FILLTAG_READS = 200000
+FASTQ_READS = 200000
+VCF_RECORDS = 500000
+# B73 RefGen_v4 chromosome lengths
+MAIZE_CONTIGS = (("1", 307041717), ("2", 244442276), ("3", 235667834),
+                 ("4", 246994605), ("5", 223902240), ("6", 174033170),
+                 ("7", 182381542), ("8", 181122637), ("9", 159769782),
+                 ("10", 150982314))
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+CHUNK = 50000
+
+
+def readBases(rng, reads, length):
+    """Return a matrix of random bases with a sprinkle of Ns."""
+    bases = BASES[rng.integers(0, 4, (reads, length))]
+    bases[rng.random((reads, length)) < 0.001] = ord("N")
+    return bases
+
+
+def readQualities(rng, reads, length):
+    """Return a matrix of phred+33 qualities shaped like Illumina reads.
+
+    Qualities fall from the high 30s towards the 3' end, and a fifth of the
+    reads drop to low qualities from a random point on, for trimming.
+    """
+    position = np.arange(length) / length
+    mean = 37 - 10 * position ** 2
+    quals = rng.normal(mean, 3, (reads, length))
+    drop = rng.random(reads) < 0.2
+    dropAt = rng.integers(length // 3, length, reads)
+    quals[drop[:, None] & (np.arange(length) >= dropAt[:, None])] -= 25
+    return np.clip(np.rint(quals), 2, 41).astype(np.uint8) + 33
+
+
+def column(byte, rows):
+    """Return a column of one repeated byte, to stack with read matrices."""
+    return np.full((rows, 1), ord(byte), dtype=np.uint8)
+
+
+def fastqChunk(rng, first, reads, length, mate):
+    """Return reads numbered from first as fixed width fastq records."""
+    names = np.frombuffer("".join(
+        f"@SYN.{i:010d}/{mate}" for i in range(first, first + reads))
+        .encode(), dtype=np.uint8).reshape(reads, -1)
+    newline = column("\n", reads)
+    return np.hstack([
+        names, newline, readBases(rng, reads, length), newline,
+        column("+", reads), newline,
+        readQualities(rng, reads, length), newline]).tobytes()
+
+
+def syntheticFastq(path, reads, length, seed, mate):
+    """Write a BGZF fastq of reads with realistic quality profiles."""
+    rng = np.random.default_rng(seed)
+    with bgzf.open(path, 'wb') as out:
+        for first in range(0, reads, CHUNK):
+            out.write(fastqChunk(rng, first, min(CHUNK, reads - first),
+                                 length, mate))
+
+
+def syntheticFilltag(path, reads, length, unpaired, seed):
+    """Write a filltag with a fraction of unpaired reads among the pairs."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'wb') as out:
+        out.write(b"# synthetic filltag\n# id quals seqs\n")
+        for first in range(0, reads, CHUNK):
+            count = min(CHUNK, reads - first)
+            seqs = readBases(rng, 2 * count, length)
+            quals = readQualities(rng, 2 * count, length)
+            single = rng.random(count) < unpaired
+            lines = []
+            for i in range(count):
+                q1, s1 = quals[2 * i].tobytes(), seqs[2 * i].tobytes()
+                if single[i]:
+                    lines.append(b"%d\t%s\t%s\n" % (first + i, q1, s1))
+                else:
+                    lines.append(b"%d\t%s\t%s\t%s\t%s\n" % (
+                        first + i, q1, quals[2 * i + 1].tobytes(), s1,
+                        seqs[2 * i + 1].tobytes()))
+            out.write(b"".join(lines))
+
+
+def vcfHeader():
+    """Return the header of the synthetic single sample vcfs."""
+    lines = ["##fileformat=VCFv4.2\n"]
+    lines += [f"##contig=<ID={name},length={length}>\n"
+              for name, length in MAIZE_CONTIGS]
+    lines += [f'##INFO=<ID={key},Number=1,Type=Float,Description="{key}">\n'
+              for key in ("QD", "FS", "MQ", "ReadPosRankSum", "SOR")]
+    lines += ['##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">'
+              '\n', "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT"
+              "\tSAMPLE\n"]
+    return "".join(lines).encode()
+
+
+def vcfRecords(rng, records):
+    """Return sorted SNP and indel records spread over the maize contigs.
+
+    A sixth are indels, most genotypes homozygous alternate and the INFO
+    annotations drawn so some records fail the hard filter.
+    """
+    lengths = np.array([length for _, length in MAIZE_CONTIGS])
+    contigs = np.sort(rng.choice(len(lengths), records,
+                                 p=lengths / lengths.sum()))
+    positions = np.sort(rng.integers(1, lengths[contigs]) +
+                        contigs * lengths.max())
+    positions -= contigs * lengths.max()
+    indel = rng.random(records) < 1 / 6
+    refs = BASES[rng.integers(0, 4, records)]
+    alts = BASES[(np.searchsorted(BASES, refs) +
+                  rng.integers(1, 4, records)) % 4]
+    homozygous = rng.random(records) < 0.8
+    qd, fs = rng.gamma(4, 5, records), rng.exponential(10, records)
+    mq, rank = rng.normal(58, 6, records), rng.normal(0, 3, records)
+    sor = rng.exponential(1.2, records)
+    lines = []
+    for i in range(records):
+        ref, alt = chr(refs[i]), chr(alts[i])
+        if indel[i]:
+            ref, alt = (ref + "AG", ref) if i % 2 else (ref, ref + "TC")
+        lines.append(
+            f"{MAIZE_CONTIGS[contigs[i]][0]}\t{positions[i]}\t.\t{ref}\t"
+            f"{alt}\t{qd[i] * 10:.1f}\t.\tQD={qd[i]:.2f};FS={fs[i]:.3f};"
+            f"MQ={mq[i]:.2f};ReadPosRankSum={rank[i]:.3f};SOR={sor[i]:.3f}"
+            f"\tGT\t{'1/1' if homozygous[i] else '0/1'}\n".encode())
+    return lines, indel
+
+
+def syntheticVcfs(directory, records, seed):
+    """Write the calls, shuffled calls, SNPs and indels vcfs and a .fai."""
+    rng = np.random.default_rng(seed)
+    lines, indel = vcfRecords(rng, records)
+    header = vcfHeader()
+    with open(os.path.join(directory, "maize.fa.fai"), 'w') as fai:
+        for name, length in MAIZE_CONTIGS:
+            fai.write(f"{name}\t{length}\t0\t60\t61\n")
+    outputs = {
+        "calls.vcf.gz": lines,
+        "unsorted.vcf.gz": [lines[i] for i in rng.permutation(records)],
+        "snps.vcf.gz": [line for line, isIndel in zip(lines, indel)
+                        if not isIndel],
+        "indels.vcf.gz": [line for line, isIndel in zip(lines, indel)
+                          if isIndel]}
+    for name, records in outputs.items():
+        with bgzf.open(os.path.join(directory, name), 'wb') as out:
+            out.write(header)
+            out.writelines(records)
+    return len(outputs["snps.vcf.gz"])
+
+
+def generate(directory, scale, seed):
+    """Generate the inputs at scale into directory, unless already there.
+
+    inputs.json records the scale, seed and number of records of a finished
+    set of inputs, and is returned.
+    """
+    stamp = os.path.join(directory, "inputs.json")
+    if os.path.exists(stamp):
+        with open(stamp) as inputs:
+            settings = json.load(inputs)
+        if settings["scale"] == scale and settings["seed"] == seed:
+            return settings
+    os.makedirs(os.path.join(directory, "out"), exist_ok=True)
+    records = {"filltag": int(FILLTAG_READS * scale),
+               "fastq": int(FASTQ_READS * scale),
+               "vcf": int(VCF_RECORDS * scale)}
+    syntheticFilltag(os.path.join(directory, "reads.filltag"),
+                     records["filltag"], 100, 0.2, seed)
+    for mate in (1, 2):
+        syntheticFastq(os.path.join(directory, f"reads_{mate}.fq.gz"),
+                       records["fastq"], 150, seed + mate, mate)
+    records["snps"] = syntheticVcfs(directory, records["vcf"], seed)
+    settings = {"scale": scale, "seed": seed, "records": records}
+    with open(stamp, 'w') as inputs:
+        json.dump(settings, inputs)
+    return settings
+
+
+def filltagParse(directory, processes):
+    """Parse the filltag into fastq blocks in memory, on one process."""
+    from filltag_to_fastq import parseFilltag, readChunks, skipHeader
+    with open(os.path.join(directory, "reads.filltag"), 'rb') as filltag:
+        skipHeader(filltag)
+        for count, chunk in readChunks(filltag, 16 * 1024 * 1024):
+            parseFilltag("bench", count, chunk)
+    return "filltag"
+
+
+def filltagConvert(directory, processes):
+    """Stream the filltag to BGZF fastq as filltag_to_fastq.py --stream."""
+    import filltag_to_fastq
+    filltag_to_fastq.streamReadsAndCompress(types.SimpleNamespace(
+        filltag=os.path.join(directory, "reads.filltag"),
+        out=os.path.join(directory, "out"), prefix="bench",
+        processes=processes, chunk_size=16 * 1024 * 1024, level=6))
+    return "filltag"
+
+
+def fastqQc(directory, processes):
+    """Summarize the forward reads as qc run does."""
+    qc.qcFile(os.path.join(directory, "reads_1.fq.gz"), processes)
+    return "fastq"
+
+
+def fastqTrim(directory, processes):
+    """Trim and qc the read pairs as qc_and_trim.py --single-pass does."""
+    out = os.path.join(directory, "out")
+    trim.trimPaired(os.path.join(directory, "reads_1.fq.gz"),
+                    os.path.join(directory, "reads_2.fq.gz"),
+                    [os.path.join(out, f"trimmed_{i}.fq.gz")
+                     for i in range(4)],
+                    trim.Settings(), processes, out, out)
+    return "fastq"
+
+
+def vcfSort(directory, processes):
+    """Sort the shuffled calls by the contig order of the .fai."""
+    vcf.sortVcf(os.path.join(directory, "unsorted.vcf.gz"),
+                os.path.join(directory, "out", "sorted.vcf.gz"),
+                os.path.join(directory, "maize.fa.fai"), tmp=directory)
+    return "vcf"
+
+
+def vcfFilter(directory, processes):
+    """Filter the SNPs near indels and on the hard thresholds."""
+    vcf.filterSnps(os.path.join(directory, "snps.vcf.gz"),
+                   os.path.join(directory, "indels.vcf.gz"),
+                   os.path.join(directory, "out", "filtered.vcf.gz"))
+    return "snps"
+
+
+def vcfSplit(directory, processes):
+    """Split the calls into homozygous alternate SNPs and indels."""
+    vcf.splitVariants(os.path.join(directory, "calls.vcf.gz"),
+                      os.path.join(directory, "out", "split_snps.vcf.gz"),
+                      os.path.join(directory, "out", "split_indels.vcf.gz"))
+    return "vcf"
+
+
+# each benchmark returns the kind of record it is counted in
+BENCHMARKS = {"filltag.parse": filltagParse,
+              "filltag.convert": filltagConvert,
+              "fastq.qc": fastqQc,
+              "fastq.trim": fastqTrim,
+              "vcf.sort": vcfSort,
+              "vcf.filter": vcfFilter,
+              "vcf.split": vcfSplit}
+
+
+def peakRss():
+    """Return the peak RSS of this process or its workers, in megabytes.
+
+    The high water mark of this process is read from /proc, as the maxrss
+    of a new interpreter starts from that of the process that spawned it.
+    """
+    with open("/proc/self/status") as status:
+        hwm = next(int(line.split()[1]) for line in status
+                   if line.startswith("VmHWM:"))
+    return max(hwm, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) \
+        / 1024
+
+
+def runOne(name, directory, processes):
+    """Run one benchmark in this process, printing what it measured."""
+    start = time.perf_counter()
+    kind = BENCHMARKS[name](directory, processes)
+    print(json.dumps({"kind": kind, "seconds": time.perf_counter() - start,
+                      "peakRss": peakRss()}))
+
+
+def measure(name, directory, processes):
+    """Run one benchmark in a new interpreter and return its measurements.
+
+    The cpu seconds are those of the interpreter and all its workers.
+    """
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "one", name, directory,
+         "-p", str(processes)], stdout=subprocess.PIPE)
+    output = child.stdout.read()
+    child.stdout.close()
+    _, status, usage = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode:
+        raise RuntimeError(f"Benchmark {name} failed with exit code "
+                           f"{child.returncode}")
+    result = json.loads(output.decode().splitlines()[-1])
+    result["cpuSeconds"] = usage.ru_utime + usage.ru_stime
+    return result
+
+
+def commit():
+    """Return the commit of the repository, marked if it has changes."""
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain",
+                                "--untracked-files=no"], cwd=HERE,
+                               capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return head + ("-dirty" if dirty.strip() else "")
+
+
+def run(args):
+    """Generate the inputs, time the benchmarks and write the results."""
+    inputs = generate(args.workdir, args.scale, args.seed)
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        runs = [measure(name, args.workdir, args.processes)
+                for _ in range(args.repeats)]
+        records = inputs["records"][runs[0]["kind"]]
+        seconds = min(result["seconds"] for result in runs)
+        results[name] = {
+            "records": records, "kind": runs[0]["kind"],
+            "seconds": seconds, "recordsPerSecond": records / seconds,
+            "cpuSeconds": min(result["cpuSeconds"] for result in runs),
+            "peakRss": max(result["peakRss"] for result in runs)}
+        print(f"{name:16} {seconds:8.3f} s {records / seconds:12.0f} "
+              f"{runs[0]['kind']} records/s {results[name]['peakRss']:8.0f} "
+              "MB peak RSS")
+    out = args.out or f"benchmarks_{commit()}.json"
+    with open(out, 'w') as report:
+        json.dump({"commit": commit(), "date": time.strftime("%F %T"),
+                   "machine": {"platform": platform.platform(),
+                               "python": platform.python_version(),
+                               "numpy": np.__version__,
+                               "cpus": len(os.sched_getaffinity(0))},
+                   "scale": args.scale, "seed": args.seed,
+                   "processes": args.processes, "repeats": args.repeats,
+                   "results": results}, report, indent=2)
+    print(f"Results written to {out}")
+
+
+def compare(args):
+    """Compare two result files, failing if anything slowed or grew."""
+    with open(args.old) as old, open(args.new) as new:
+        before, after = json.load(old), json.load(new)
+    if before["scale"] != after["scale"]:
+        print(f"Warning: scales differ, {before['scale']} and "
+              f"{after['scale']}")
+    regressed = False
+    print(f"benchmark\t{before['commit']}\t{after['commit']}\tspeed\t"
+          "peak RSS")
+    for name, result in after["results"].items():
+        if name not in before["results"]:
+            continue
+        previous = before["results"][name]
+        speed = result["recordsPerSecond"] / previous["recordsPerSecond"]
+        memory = result["peakRss"] / previous["peakRss"]
+        flag = ""
+        if speed < 1 - args.threshold or memory > 1 + args.threshold:
+            regressed, flag = True, "\tREGRESSED"
+        print(f"{name}\t{previous['recordsPerSecond']:.0f}/s\t"
+              f"{result['recordsPerSecond']:.0f}/s\t{speed:.2f}x\t"
+              f"{memory:.2f}x{flag}")
+    if regressed:
+        sys.exit(1)
+
+
+def main():
+    """Parse the command line and run or compare the benchmarks."""
+    parser = argparse.ArgumentParser(
+        description=('Benchmarks of the filltag conversion, fastq qc and '
+                     'trimming and vcf tools on synthetic data'))
+    subparsers = parser.add_subparsers(help='sub-command [-h, --help]',
+                                       dest="command", required=True)
+    runParser = subparsers.add_parser(
+        'run', help='Time the benchmarks and write their results as json')
+    runParser.add_argument(
+        'benchmarks', nargs='*',
+        help=f'The benchmarks to run, of {", ".join(BENCHMARKS)}. Default: '
+        'all')
+    runParser.add_argument(
+        '-w', '--workdir',
+        help=('Directory of the synthetic inputs, kept and reused for the '
+              'same scale and seed. Default: benchmark_data'),
+        default="benchmark_data")
+    runParser.add_argument(
+        '-s', '--scale',
+        help=(f'Multiple of {FILLTAG_READS} filltag reads, {FASTQ_READS} '
+              f'read pairs and {VCF_RECORDS} vcf records. Default: 1'),
+        type=float,
+        default=1.0)
+    runParser.add_argument(
+        '--seed',
+        help='Seed of the synthetic inputs. Default: 1',
+        type=int,
+        default=1)
+    runParser.add_argument(
+        '-r', '--repeats',
+        help='Number of timed repeats, the fastest is reported. Default: 3',
+        type=int,
+        default=3)
+    runParser.add_argument(
+        '-o', '--out',
+        help='The results json. Default: benchmarks_<commit>.json')
+    compareParser = subparsers.add_parser(
+        'compare', help='Compare the results of two commits')
+    compareParser.add_argument('old', help='The earlier results json')
+    compareParser.add_argument('new', help='The later results json')
+    compareParser.add_argument(
+        '-t', '--threshold',
+        help=('Fraction of throughput lost or peak RSS gained counted as a '
+              'regression. Default: 0.1'),
+        type=float,
+        default=0.1)
+    oneParser = subparsers.add_parser(
+        'one', help='Run one benchmark in this process, as run does')
+    oneParser.add_argument('name', choices=list(BENCHMARKS))
+    oneParser.add_argument('workdir')
+    for subparser in (runParser, oneParser):
+        subparser.add_argument(
+            '-p', '--processes',
+            help='Processes or threads of each benchmark. Default: all cpus',
+            type=int,
+            default=len(os.sched_getaffinity(0)))
+    args = parser.parse_args()
+
+    if args.command == "run":
+        unknown = set(args.benchmarks) - set(BENCHMARKS)
+        if unknown:
+            parser.error(f"Unknown benchmarks {', '.join(sorted(unknown))}")
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+    else:
+        runOne(args.name, args.workdir, args.processes)
+
+
+if __name__ == "__main__":
+    main()
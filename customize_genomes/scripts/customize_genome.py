@@ -1,175 +1,313 @@
-"""Takes a path to a genome and indexes it."""
-
-import argparse
-import subprocess
-import os
-import pathlib
-import jobs
-
-
-def parseCmdLine():
-    """Parse the command line options."""
-    parser = argparse.ArgumentParser(
-        description=('Performs the various steps needed to for a single pass '
-                     'genome customization'))
-    parser.add_argument(
-        'genome',
-        help='The path to the genome file')
-    parser.add_argument(
-        'vcf',
-        help='The path to the genome\'s vcf file')
-    parser.add_argument(
-        'prefix',
-        help='Base name to give intermediate files')
-    parser.add_argument(
-        'new',
-        help='Name to give new genome')
-    parser.add_argument(
-        'reads1',
-        help='Path to read fasta pair 1')
-    parser.add_argument(
-        'reads2',
-        help='Path to read fasta pair 2')
-    parser.add_argument(
-        'intermediate',
-        help='Output directory for intermediate steps',
-        nargs='?',
-        default="scratch/maxh/intermediate/untreated_alignments")
-    parser.add_argument(
-        'results',
-        help='Output directory for intermediate steps',
-        nargs='?',
-        default="scratch/maxh/results/untreated_alignments")
-    parser.add_argument(
-        'logs',
-        help='Logs output directory',
-        nargs='?',
-        default=os.path.join(os.path.dirname(os.path.dirname(
-            os.path.realpath(__file__))), "logs"))
-    parser.add_argument(
-        '-b', '--bwa',
-        help='Don\'t perform BWA alignment',
-        action='store_false')
-    parser.add_argument(
-        '-s', '--sort_bam',
-        help=('Don\'t sort the output alignment sam'
-              'by genomic position and output bam'),
-        action='store_false')
-    parser.add_argument(
-        '-f', '--flagstat',
-        help='Don\'t calculate the alignment statistics',
-        action='store_false')
-    parser.add_argument(
-        '-m', '--mark_duplicates',
-        help='Don\'t mark duplicate reads in sorted bam file',
-        action='store_false')
-    parser.add_argument(
-        '-r', '--base_recalibrate',
-        help='Don\'t recalibrate the base scores of the aligned reads',
-        action='store_false')
-    parser.add_argument(
-        '-c', '--caller_haplotype',
-        help='Don\'t use the haplotype caller to call variants',
-        action='store_false')
-    parser.add_argument(
-        '-d', '--select_snps',
-        help='Don\'t select SNPS from the haplotype caller vcf',
-        action='store_false')
-    parser.add_argument(
-        '-i', '--select_indels',
-        help='Don\'t select INDELS from the haplotype caller vcf',
-        action='store_false')
-    parser.add_argument(
-        '-v', '--variant_filter',
-        help='Don\'t filter out SNPs near INDELS',
-        action='store_false')
-    parser.add_argument(
-        '-a', '--alternate_ref_make',
-        help='Don\'t modify the current reference with the filtered SNPs',
-        action='store_false')
-    return parser.parse_args()
-
-
-def customizeGenomePipeline(args):
-    """Run the genome customization pipeline."""
-    logs, scriptDir = jobs.baseDirs(args.logs, args.prefix,
-                                    os.path.realpath(__file__))
-
-    intermediateOutDir = os.path.join(args.intermediate, args.prefix)
-    pathlib.Path(intermediateOutDir).mkdir(parents=True, exist_ok=True)
-    intermediateOut = os.path.join(intermediateOutDir, args.prefix)
-
-    resultsOutDir = os.path.join(args.results, args.prefix)
-    pathlib.Path(resultsOutDir).mkdir(parents=True, exist_ok=True)
-    resultsOut = os.path.join(resultsOutDir, args.new)
-
-    variantsOutDir = os.path.join(resultsOutDir, "variants.sbatch")
-    pathlib.Path(variantsOutDir).mkdir(parents=True, exist_ok=True)
-    variantsOut = os.path.join(variantsOutDir, args.prefix)
-
-    statsOutDir = os.path.join(resultsOutDir, "stats.sbatch")
-    pathlib.Path(statsOutDir).mkdir(parents=True, exist_ok=True)
-    statsOut = os.path.join(statsOutDir, args.prefix)
-
-    prevJob = 0
-    if args.bwa:
-        cmd = (f"sbatch " +
-               f"--output={intermediateOut}_bwa.sam " +
-               f"--error={logs}_bwa_align_err.log " +
-               f"--job-name={args.prefix}_bwa_align" +
-               os.path.join(scriptDir, "bwa_mem.sbatch") +
-               f" {args.genome} {args.reads1} {args.reads2}")
-        prevJob = jobs.submitJob(cmd)
-    prevJob = jobs.genericJob(prevJob, args.sort_bam, "sort_bam",
-                              logs, scriptDir, args.prefix,
-                              intermediateOut)
-    if prevJob and args.flagstat:
-        cmd = (f"sbatch --dependency=afterany:{prevJob}" +
-               f"--output={statsOut}_alignment_metrics.txt " +
-               f"--error={logs}_flagstats_err.log " +
-               f"--job-name={args.prefix}_flagstat" +
-               os.path.join(scriptDir, "flagstat.sbatch") +
-               intermediateOut)
-        prevJob = jobs.submitJob(cmd)
-    elif args.flagstat:
-        cmd = (f"sbatch " +
-               f"--output={statsOut}_alignment_metrics.txt " +
-               f"--error={logs}_flagstats_err.log " +
-               f"--job-name={args.prefix}_flagstat" +
-               os.path.join(scriptDir, "flagstat.sbatch") +
-               intermediateOut)
-        prevJob = jobs.submitJob(cmd)
-    prevJob = jobs.genericJob(prevJob, args.mark_duplicates,
-                              "mark_duplicates.sbatch", logs, scriptDir, args.prefix,
-                              intermediateOut)
-    prevJob = jobs.genericJob(prevJob, args.base_recalibrate,
-                              "base_recalibrator.sbatch", logs, scriptDir,
-                              args.prefix, intermediateOut, args.genome,
-                              args.vcf)
-    prevJob = jobs.genericJob(prevJob, args.caller_haplotype,
-                              "haplotype_caller.sbatch", logs, scriptDir,
-                              args.prefix, variantsOut, args.genome)
-    prevJob = jobs.genericJob(prevJob, args.select_snps, "select_snps.sbatch",
-                              logs, scriptDir, args.prefix, variantsOut,
-                              args.genome)
-    prevJob = jobs.genericJob(prevJob, args.select_indels, "select_indels.sbatch",
-                              logs, scriptDir, args.prefix, variantsOut,
-                              args.genome)
-    prevJob = jobs.genericJob(prevJob, args.filter_snps, "filter_snps.sbatch",
-                              logs, scriptDir, args.prefix, variantsOut,
-                              args.genome)
-    prevJob = jobs.genericJob(prevJob, args.alternate_ref_make,
-                              "make_alternate_ref.sbatch", logs, scriptDir,
-                              args.prefix, args.genome, variantsOut,
-                              resultsOut)
-
-    subprocess.run("squeue -u maxh")
-
-
-def main():
-    """Initiaties the logic of the program."""
-    customizeGenomePipeline(parseCmdLine())
-
-
-if __name__ == "__main__":
-    main()
+"""Takes a path to a genome and indexes it."""
+
+import argparse
+import math
+import os
+
+from amaize import intervals, jobs, pipeline
+
+
+def parseCmdLine():
+    """Parse the command line options."""
+    parser = argparse.ArgumentParser(
+        description=('Performs the various steps needed to for a single pass '
+                     'genome customization'))
+    parser.add_argument(
+        'genome',
+        help='The path to the genome file')
+    parser.add_argument(
+        'vcf',
+        help='The path to the genome\'s vcf file')
+    parser.add_argument(
+        'prefix',
+        help='Base name to give intermediate files')
+    parser.add_argument(
+        'new',
+        help='Name to give new genome')
+    parser.add_argument(
+        'reads1',
+        help='Path to read fasta pair 1')
+    parser.add_argument(
+        'reads2',
+        help='Path to read fasta pair 2')
+    parser.add_argument(
+        'intermediate',
+        help='Output directory for intermediate steps',
+        nargs='?',
+        default="scratch/maxh/intermediate/untreated_alignments")
+    parser.add_argument(
+        'results',
+        help='Output directory for intermediate steps',
+        nargs='?',
+        default="scratch/maxh/results/untreated_alignments")
+    parser.add_argument(
+        'logs',
+        help='Logs output directory',
+        nargs='?',
+        default=os.path.join(os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__))), "logs"))
+    parser.add_argument(
+        '-u', '--fused_align',
+        help=('Align, sort and mark duplicates in one streaming job instead '
+              'of the BWA, sort, flagstat and mark duplicates steps. '
+              'Duplicate statistics are those of samtools markdup, in '
+              '_markdup_stats.txt, rather than Picard metrics'),
+        action='store_true')
+    parser.add_argument(
+        '-b', '--bwa',
+        help='Don\'t perform BWA alignment',
+        action='store_false')
+    parser.add_argument(
+        '-s', '--sort_bam',
+        help=('Don\'t sort the output alignment sam'
+              'by genomic position and output bam'),
+        action='store_false')
+    parser.add_argument(
+        '-f', '--flagstat',
+        help='Don\'t calculate the alignment statistics',
+        action='store_false')
+    parser.add_argument(
+        '-m', '--mark_duplicates',
+        help='Don\'t mark duplicate reads in sorted bam file',
+        action='store_false')
+    parser.add_argument(
+        '-r', '--base_recalibrate',
+        help='Don\'t recalibrate the base scores of the aligned reads',
+        action='store_false')
+    parser.add_argument(
+        '-c', '--caller_haplotype',
+        help='Don\'t use the haplotype caller to call variants',
+        action='store_false')
+    parser.add_argument(
+        '-d', '--split_variants',
+        help=('Don\'t split the haplotype caller vcf into homozygous SNPs '
+              'and INDELS'),
+        action='store_false')
+    parser.add_argument(
+        '-v', '--variant_filter',
+        help='Don\'t filter out SNPs near INDELS',
+        action='store_false')
+    parser.add_argument(
+        '-a', '--alternate_ref_make',
+        help='Don\'t modify the current reference with the filtered SNPs',
+        action='store_false')
+    parser.add_argument(
+        '-n', '--shards',
+        help=('Recalibrate and call variants in this many interval shards of '
+              'the genome in parallel. Default: 0, one job each'),
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--cohort',
+        help=('Call a gvcf of the line and add it to the cohort kept in this '
+              'directory, then take the variants of the line from the joint '
+              'genotypes of the cohort. Lines already in the cohort are not '
+              'called again'))
+    parser.add_argument(
+        '--force',
+        help=('Ignore the cache of completed steps and submit every enabled '
+              'step'),
+        action='store_true')
+    parser.add_argument(
+        '--hash_blocks',
+        help=('Number of blocks hashed per file when checking whether '
+              'steps are cached. Default: 0, only size and mtime are used'),
+        type=int,
+        default=0)
+    return parser.parse_args()
+
+
+def script(scriptDir, name):
+    """Return the text of an sbatch script in the script directory."""
+    with open(os.path.join(scriptDir, f"{name}.sbatch")) as sbatchScript:
+        return sbatchScript.read()
+
+
+def shardScript(scriptDir, name, shards):
+    """Return the text of a shard script asking for its share of the time.
+
+    A shard covers about 1 / shards of the genome, so it asks for twice
+    that share of the time of the whole genome, at least half an hour, to
+    leave room for the loading of the reference every shard repeats.
+    """
+    text = script(scriptDir, name)
+    return pipeline.withWallTime(
+        text, max(30, math.ceil(2 * pipeline.wallTime(text) / shards)))
+
+
+def callVariantsSharded(args, steps, scriptDir, intermediateOut,
+                        variantsOut):
+    """Add base recalibration and variant calling scattered over shards.
+
+    Each shard is a balanced set of genome intervals run as one task of a
+    job array. The per shard recalibration tables are gathered before
+    calling and the per shard vcfs, or gvcfs in cohort mode, are gathered
+    in reference order after.
+    """
+    extension = ".g.vcf" if args.cohort else ".vcf"
+    marked = f"{intermediateOut}_marked.bam"
+    recal = f"{intermediateOut}_recal.table"
+    shards = [intervals.writeIntervals(
+        f"{intermediateOut}_shard{i}.intervals", shard) for i, shard in
+        enumerate(intervals.shardGenome(args.genome, args.shards))]
+    names = [f"{args.prefix}_shard{i}" for i in range(len(shards))]
+    tables = [f"{intermediateOut}_shard{i}_recal.table"
+              for i in range(len(shards))]
+    vcfs = [f"{variantsOut}_shard{i}{extension}"
+            for i in range(len(shards))]
+
+    steps.add("base_recalibrator_shards",
+              shardScript(scriptDir, "base_recalibrator_shard", len(shards)),
+              tasks=[(name, intermediateOut, args.genome, args.vcf, shard,
+                      table)
+                     for name, shard, table in zip(names, shards, tables)],
+              inputs=[marked, args.genome, args.vcf, *shards],
+              outputs=tables, run=args.base_recalibrate)
+    steps.add("gather_recal_tables", script(scriptDir, "gather_recal_tables"),
+              recal, *tables, inputs=tables, outputs=[recal], removes=tables,
+              run=args.base_recalibrate)
+    steps.add("haplotype_caller_shards",
+              shardScript(scriptDir, "haplotype_caller_gvcf_shard"
+                          if args.cohort else "haplotype_caller_shard",
+                          len(shards)),
+              tasks=[(name, intermediateOut, args.genome, shard, vcf)
+                     for name, shard, vcf in zip(names, shards, vcfs)],
+              inputs=[marked, recal, args.genome, *shards], outputs=vcfs,
+              run=args.caller_haplotype)
+    steps.add("gather_vcfs", script(scriptDir, "gather_vcfs"),
+              f"{variantsOut}{extension}", *vcfs, inputs=vcfs,
+              outputs=[f"{variantsOut}{extension}"], removes=vcfs,
+              run=args.caller_haplotype)
+
+
+def cohortSamples(cohort):
+    """Return the samples already in a cohort, creating it if new."""
+    os.makedirs(cohort, exist_ok=True)
+    # appending nothing leaves the mtime the cache fingerprints alone
+    with open(os.path.join(cohort, "samples.tsv"), 'a+') as samples:
+        samples.seek(0)
+        return [line.split("\t")[0] for line in samples if line.strip()]
+
+
+def addToCohort(args, steps, scriptDir, variantsOut):
+    """Add the gvcf of the line to the cohort and genotype it jointly.
+
+    The gvcf is merged once into the combined gvcf the cohort keeps, so a
+    new line never calls the others again. The variants of the line are
+    split from the joint genotypes of the whole cohort.
+    """
+    samples = cohortSamples(args.cohort)
+    print(f"Cohort {args.cohort} has {len(samples)} lines" +
+          (f": {', '.join(samples)}" if samples else ""))
+    gvcf = f"{variantsOut}.g.vcf"
+    added = os.path.join(args.cohort, f"{args.prefix}.added")
+    joint = os.path.join(args.cohort, "cohort.vcf")
+    steps.add("add_to_cohort", script(scriptDir, "add_to_cohort"),
+              args.cohort, args.prefix, gvcf, args.genome, added,
+              inputs=[gvcf, args.genome], outputs=[added],
+              run=args.caller_haplotype)
+    steps.add("genotype_cohort", script(scriptDir, "genotype_cohort"),
+              args.cohort, args.genome,
+              inputs=[added, os.path.join(args.cohort, "samples.tsv"),
+                      args.genome],
+              outputs=[joint], run=args.caller_haplotype)
+    steps.add("split_variants", script(scriptDir, "split_cohort_variants"),
+              joint, variantsOut, args.prefix, inputs=[joint],
+              outputs=[f"{variantsOut}_snps.vcf",
+                       f"{variantsOut}_indels.vcf"],
+              run=args.split_variants)
+
+
+def customizeGenomePipeline(args):
+    """Run the genome customization pipeline."""
+    logs = jobs.outDir(args.logs, args.prefix)
+    scriptDir = os.path.dirname(os.path.realpath(__file__))
+    intermediateOut = os.path.join(
+        jobs.outDir(args.intermediate, args.prefix), args.prefix)
+    resultsOutDir = jobs.outDir(args.results, args.prefix)
+    resultsOut = os.path.join(resultsOutDir, args.new)
+    variantsOut = os.path.join(jobs.outDir(resultsOutDir, "variants"),
+                               args.prefix)
+    statsOut = os.path.join(jobs.outDir(resultsOutDir, "stats"), args.prefix)
+
+    sam = f"{intermediateOut}_bwa.sam"
+    sorted_ = (f"{intermediateOut}_sorted.bam",
+               f"{intermediateOut}_sorted.bai")
+    marked = f"{intermediateOut}_marked.bam"
+    markedOut = (marked, f"{intermediateOut}_marked.bai",
+                 f"{intermediateOut}_marked_dups_metrics.txt")
+    stats = f"{statsOut}_alignment_metrics.txt"
+    recal = f"{intermediateOut}_recal.table"
+    vcf = f"{variantsOut}.vcf"
+    snps = f"{variantsOut}_snps.vcf"
+    indels = f"{variantsOut}_indels.vcf"
+    filtered = f"{variantsOut}_snps_filtered.vcf"
+
+    steps = pipeline.Pipeline(args.prefix, logs, cache=not args.force,
+                              blocks=args.hash_blocks,
+                              kind="customize_genome")
+    if args.fused_align:
+        steps.add("fused_align", script(scriptDir, "fused_align"),
+                  intermediateOut, args.genome, args.reads1, args.reads2,
+                  args.prefix, stats,
+                  inputs=[args.genome, args.reads1, args.reads2],
+                  outputs=[*markedOut[:2],
+                           f"{intermediateOut}_markdup_stats.txt", stats])
+    else:
+        steps.add("bwa_align", script(scriptDir, "bwa_mem"),
+                  args.genome, args.reads1, args.reads2, args.prefix,
+                  inputs=[args.genome, args.reads1, args.reads2],
+                  outputs=[sam], stdout=sam, run=args.bwa)
+        steps.add("sort_bam", script(scriptDir, "sort_bam"), intermediateOut,
+                  inputs=[sam], outputs=sorted_, removes=[sam],
+                  run=args.sort_bam)
+        steps.add("flagstat", script(scriptDir, "flagstat"), intermediateOut,
+                  inputs=sorted_, outputs=[stats], stdout=stats,
+                  run=args.flagstat)
+        steps.add("mark_duplicates", script(scriptDir, "mark_duplicates"),
+                  intermediateOut, inputs=sorted_, outputs=markedOut,
+                  run=args.mark_duplicates)
+        steps.add("remove_sorted_bam", script(scriptDir, "remove"), *sorted_,
+                  removes=sorted_, run=args.mark_duplicates)
+    if args.shards:
+        callVariantsSharded(args, steps, scriptDir, intermediateOut,
+                            variantsOut)
+    else:
+        steps.add("base_recalibrator", script(scriptDir, "base_recalibrator"),
+                  intermediateOut, args.genome, args.vcf,
+                  inputs=[marked, args.genome, args.vcf], outputs=[recal],
+                  run=args.base_recalibrate)
+        steps.add("haplotype_caller",
+                  script(scriptDir, "haplotype_caller_gvcf" if args.cohort
+                         else "haplotype_caller"),
+                  intermediateOut, args.genome, variantsOut,
+                  inputs=[marked, recal, args.genome],
+                  outputs=[f"{variantsOut}.g.vcf" if args.cohort else vcf],
+                  run=args.caller_haplotype)
+    if args.cohort:
+        addToCohort(args, steps, scriptDir, variantsOut)
+    else:
+        steps.add("split_variants", script(scriptDir, "split_variants"),
+                  variantsOut, inputs=[vcf], outputs=[snps, indels],
+                  run=args.split_variants)
+    steps.add("filter_snps", script(scriptDir, "filter_snps"), variantsOut,
+              inputs=[snps, indels], outputs=[filtered],
+              run=args.variant_filter)
+    steps.add("make_alternate_ref", script(scriptDir, "make_alternate_ref"),
+              args.genome, variantsOut, resultsOut,
+              inputs=[args.genome, filtered],
+              outputs=[f"{resultsOut}.fasta", f"{resultsOut}.fasta.fai",
+                       f"{resultsOut}.fasta.dict"],
+              run=args.alternate_ref_make)
+    steps.submit()
+
+    jobs.queue()
+
+
+def main():
+    """Initiaties the logic of the program."""
+    customizeGenomePipeline(parseCmdLine())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,15 @@
-## Decompress the filltags useful for genome customization
+## Convert the gzipped filltags useful for genome customization to fastq
 kind=untreated
 
 for sample in `cat samples.txt`; 
 do
     mkdir -p logs/${sample}
     sbatch \
-        --output=logs/$sample/${sample}_decompress_out.log \
-        --error=logs/$sample/${sample}_decompress_err.log \
-        --job-name=${sample}_decompress \
-        scripts/decompress.sbatch \
-            /scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt.gz;
-    sbatch \
-        --dependency=afterany:$SLURM_JOB_ID
         --output=logs/$sample/${sample}_filltag_to_fastq_out.log \
         --error=logs/$sample/${sample}_filltag_to_fastq_err.log \
         --job-name=${sample}_filltag_to_fastq \
         scripts/filltag_to_fastq.sbatch \
-            /scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt \
+            /scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt.gz \
             /scratch/maxh/data/${kind}_reads/raw_fastq \
             ${sample}
 done
@@ -27,18 +20,11 @@ for sample in `cat samples.txt`;
 do
     mkdir -p logs/${sample}
     sbatch \
-        --output=logs/$sample/${sample}_decompress_out.log \
-        --error=logs/$sample/${sample}_decompress_err.log \
-        --job-name=${sample}_decompress \
-        scripts/decompress.sbatch \
-            /scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt.gz;
-    sbatch \
-        --dependency=afterany:$SLURM_JOB_ID
         --output=logs/$sample/${sample}_filltag_to_fastq_out.log \
         --error=logs/$sample/${sample}_filltag_to_fastq_err.log \
         --job-name=${sample}_filltag_to_fastq \
         scripts/filltag_to_fastq.sbatch \
-            /scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt \
+            /scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt.gz \
             /scratch/maxh/data/${kind}_reads/raw_fastq \
             ${sample}
 done
\ No newline at end of file
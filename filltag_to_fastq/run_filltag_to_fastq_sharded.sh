@@ -0,0 +1,30 @@
+## Convert the gzipped filltags to fastq as job arrays of line aligned shards
+shards=16
+
+for kind in untreated bisulfite;
+do
+    for sample in `cat samples.txt`; 
+    do
+        mkdir -p logs/${sample}
+        filltag=/scratch/maxh/data/${kind}_reads/filltag/${sample}_filltags.txt.gz
+        out=/scratch/maxh/data/${kind}_reads/raw_fastq
+        plan=$(sbatch --parsable \
+            --output=logs/$sample/${sample}_filltag_plan_out.log \
+            --error=logs/$sample/${sample}_filltag_plan_err.log \
+            --job-name=${sample}_filltag_plan \
+            scripts/filltag_plan.sbatch $filltag $out $sample $shards)
+        convert=$(sbatch --parsable \
+            --dependency=afterok:$plan \
+            --array=0-$((shards - 1)) \
+            --output=logs/$sample/${sample}_filltag_shard_%a_out.log \
+            --error=logs/$sample/${sample}_filltag_shard_%a_err.log \
+            --job-name=${sample}_filltag_shard \
+            scripts/filltag_shard.sbatch $filltag $out $sample)
+        sbatch \
+            --dependency=afterok:$convert \
+            --output=logs/$sample/${sample}_filltag_gather_out.log \
+            --error=logs/$sample/${sample}_filltag_gather_err.log \
+            --job-name=${sample}_filltag_gather \
+            scripts/filltag_gather.sbatch $filltag $out $sample
+    done
+done
\ No newline at end of file
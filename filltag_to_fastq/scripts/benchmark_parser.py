@@ -0,0 +1,129 @@
+"""Compare the batch filltag parser with the original line by line loop."""
+
+import argparse
+import io
+import random
+import re
+import time
+
+from filltag_to_fastq import parseFilltag
+
+
+def lineLoop(prefix, lines):
+    """Convert filltag lines the way the converter originally did."""
+    read1, read2, unpaired = io.StringIO(), io.StringIO(), io.StringIO()
+    count = 1
+    for line in io.StringIO(lines.decode()):
+        line.rstrip()
+        reads = re.compile(r"\s+").split(line)
+        count += 1
+        if (len(reads) == 4):
+            unpaired.write(
+                f"@ID:{prefix}.{count}\n{reads[2]}\n+\n{reads[1]}\n")
+        else:
+            read1.write(
+                f"@ID:{prefix}.{count}\n{reads[3]}\n+\n{reads[1]}\n")
+            read2.write(
+                f"@ID:{prefix}.{count}\n{reads[4]}\n+\n{reads[2]}\n")
+        count += 1
+    return tuple(out.getvalue().encode()
+                 for out in (read1, read2, unpaired))
+
+
+def batchParse(prefix, lines, batch):
+    """Convert filltag lines with the batch parser, batch bytes at a time."""
+    read1, read2, unpaired = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    count, start = 2, 0
+    while start < len(lines):
+        end = lines.find(b"\n", start + batch) + 1 or len(lines)
+        for out, block in zip((read1, read2, unpaired),
+                              parseFilltag(prefix, count, lines[start:end])):
+            out.write(block)
+        count += 2 * lines.count(b"\n", start, end)
+        start = end
+    return tuple(out.getvalue() for out in (read1, read2, unpaired))
+
+
+def syntheticFilltag(reads, length, fraction, seed):
+    """Make filltag lines with the given fraction of unpaired reads."""
+    rng = random.Random(seed)
+    bases = [rng.choice("ACGT") * length for _ in range(64)]
+    quals = ["".join(rng.choice("#+5?AFJ") for _ in range(length))
+             for _ in range(64)]
+    lines = []
+    for i in range(reads):
+        if rng.random() < fraction:
+            lines.append(f"{i}\t{rng.choice(quals)}\t{rng.choice(bases)}\n")
+        else:
+            lines.append(f"{i}\t{rng.choice(quals)}\t{rng.choice(quals)}\t"
+                         f"{rng.choice(bases)}\t{rng.choice(bases)}\n")
+    return "".join(lines).encode()
+
+
+def best(func, repeats, *args):
+    """Return the result and fastest wall time of repeated calls."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    """Time both parsers on the same lines and check they agree."""
+    parser = argparse.ArgumentParser(
+        description=('Micro-benchmark of the batch filltag parser against '
+                     'the original per line regex loop'))
+    parser.add_argument(
+        '-f', '--filltag',
+        help=('Plain filltag file to read instead of synthetic reads. The '
+              'two header lines are skipped'))
+    parser.add_argument(
+        '-n', '--reads',
+        help='Number of synthetic reads. Default: 200000',
+        type=int,
+        default=200000)
+    parser.add_argument(
+        '-l', '--length',
+        help='Synthetic read length. Default: 100',
+        type=int,
+        default=100)
+    parser.add_argument(
+        '-u', '--unpaired',
+        help='Fraction of synthetic reads that are unpaired. Default: 0.2',
+        type=float,
+        default=0.2)
+    parser.add_argument(
+        '-b', '--batch',
+        help='Bytes per batch for the batch parser. Default: 16 MiB',
+        type=int,
+        default=16 * 1024 * 1024)
+    parser.add_argument(
+        '-r', '--repeats',
+        help='Number of timed repeats, the fastest is reported. Default: 3',
+        type=int,
+        default=3)
+    args = parser.parse_args()
+
+    if args.filltag:
+        with open(args.filltag, 'rb') as filltag:
+            filltag.readline()
+            filltag.readline()
+            lines = filltag.read()
+    else:
+        lines = syntheticFilltag(args.reads, args.length, args.unpaired, 1)
+    reads = lines.count(b"\n")
+
+    old, oldTime = best(lineLoop, args.repeats, "bench", lines)
+    new, newTime = best(batchParse, args.repeats, "bench", lines, args.batch)
+    if old != new:
+        raise SystemExit("Batch parser output differs from the line loop")
+    print(f"{reads} filltag lines, {len(lines) / 1e6:.1f} MB")
+    print(f"line loop:    {oldTime:8.3f} s {reads / oldTime:12.0f} reads/s")
+    print(f"batch parser: {newTime:8.3f} s {reads / newTime:12.0f} reads/s")
+    print(f"speedup:      {oldTime / newTime:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
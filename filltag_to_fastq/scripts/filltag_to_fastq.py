@@ -1,11 +1,18 @@
 """Convert filltag format reads to fastq format."""
 
 import argparse
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+import multiprocessing
 import os
 import pathlib
-import subprocess
-import contextlib
-import re
+
+import numpy as np
+
+from amaize import bgzf
 
 
 def silentremove(*filenames):
@@ -22,34 +29,276 @@ def formatReadsAndCompress(args):
     r2 = os.path.join(args.out, f"{args.prefix}_R2.fq")
     up = os.path.join(args.out, f"{args.prefix}_unpaired.fq")
     silentremove(r1, r2, up)
-    with open(args.filltag, 'r') as filltag, \
-            open(r1, 'a') as read1, \
-            open(r2, 'a') as read2, \
-            open(up, 'a') as unpaired:
-        filltag.readline()
-        filltag.readline()
-        count = 1
-        for line in filltag:
-            line.rstrip()
-            reads = re.compile(r"\s+").split(line)
-            count += 1
-            if (len(reads) == 4):
-                unpaired.write(
-                    f"@ID:{args.prefix}.{count}\n{reads[2]}\n+\n{reads[1]}\n")
-            else:
-                read1.write(
-                    f"@ID:{args.prefix}.{count}\n{reads[3]}\n+\n{reads[1]}\n")
-                read2.write(
-                    f"@ID:{args.prefix}.{count}\n{reads[4]}\n+\n{reads[2]}\n")
-            count += 1
-
-    subprocess.run(["pigz", "-p", "16", args.filltag])
-    subprocess.run(["pigz", "-p", "16", r1])
-    subprocess.run(["pigz", "-p", "16", r2])
-    subprocess.run(["pigz", "-p", "16", up])
+    with open(args.filltag, 'rb') as filltag, \
+            open(r1, 'wb') as read1, \
+            open(r2, 'wb') as read2, \
+            open(up, 'wb') as unpaired:
+        skipHeader(filltag)
+        for count, lines in readChunks(filltag, args.chunk_size):
+            for out, block in zip((read1, read2, unpaired),
+                                  parseFilltag(args.prefix, count, lines)):
+                out.write(block)
+
+    for path in (args.filltag, r1, r2, up):
+        bgzf.compressFile(path, f"{path}.gz", 16)
     silentremove(r1, r2, up, args.filltag)
 
 
+def openFilltag(path):
+    """Open a plain or gzipped filltag file for binary reading."""
+    if path.endswith(".gz"):
+        return bgzf.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def skipHeader(filltag):
+    """Move past the two header lines at the top of a filltag."""
+    filltag.readline()
+    filltag.readline()
+
+
+def readChunks(filltag, chunkSize, count=2, size=-1):
+    """Yield (first read count, lines) chunks split on line boundaries.
+
+    Reads size bytes from the current position, or to the end of the file if
+    size is negative. The first line read is numbered count.
+    """
+    tail = b""
+    while size:
+        block = filltag.read(chunkSize if size < 0 else min(chunkSize, size))
+        if not block:
+            break
+        size -= len(block) if size > 0 else 0
+        block = tail + block
+        end = block.rfind(b"\n") + 1
+        tail = block[end:]
+        if end:
+            yield count, block[:end]
+            count += 2 * block.count(b"\n", 0, end)
+    if tail:
+        yield count, tail + b"\n"
+
+
+def fastqBlock(prefix, counts, fields, seqs, quals):
+    """Join the reads at the seqs and quals field indices into one block."""
+    if not len(counts):
+        return b""
+    block = [b"+"] * (4 * len(counts))
+    block[0::4] = map(f"@ID:{prefix}.%d".encode().__mod__, counts.tolist())
+    block[1::4] = map(fields.__getitem__, seqs.tolist())
+    block[3::4] = map(fields.__getitem__, quals.tolist())
+    return b"\n".join(block) + b"\n"
+
+
+def parseFilltag(prefix, count, lines):
+    """Convert a block of whole filltag lines to R1, R2 and unpaired fastq.
+
+    The fields of every line are located at once with numpy: a line with three
+    fields is an unpaired read and one with five a pair, any other count
+    raising a ValueError. Reads are numbered from count in steps of two, like
+    the original line by line loop, so line n has read number 2n. Bytes up to
+    and including space count as whitespace, which never occur in reads or
+    quality strings.
+    """
+    data = np.frombuffer(lines, dtype=np.uint8)
+    white = data <= 32
+    starts = np.flatnonzero(white[:-1] & ~white[1:]) + 1
+    if len(data) and not white[0]:
+        starts = np.insert(starts, 0, 0)
+    fieldsBefore = np.searchsorted(starts, np.flatnonzero(data == 10))
+    nFields = np.diff(fieldsBefore, prepend=0)
+    first = fieldsBefore - nFields
+    counts = count + 2 * np.arange(len(nFields))
+    fields = lines.split()
+
+    malformed = np.flatnonzero((nFields != 0) & (nFields != 3) &
+                               (nFields != 5))
+    if len(malformed):
+        line = int(counts[malformed[0]]) // 2
+        raise ValueError(f"Line {line} has {nFields[malformed[0]]} fields, "
+                         "expected 3 or 5")
+    single = nFields == 3
+    paired = nFields == 5
+    return (fastqBlock(prefix, counts[paired], fields,
+                       first[paired] + 3, first[paired] + 1),
+            fastqBlock(prefix, counts[paired], fields,
+                       first[paired] + 4, first[paired] + 2),
+            fastqBlock(prefix, counts[single], fields,
+                       first[single] + 2, first[single] + 1))
+
+
+def formatChunk(job):
+    """Convert a chunk of filltag lines to three runs of BGZF fastq blocks."""
+    prefix, count, lines, level = job
+    return tuple(bgzf.compress(block, level)
+                 for block in parseFilltag(prefix, count, lines))
+
+
+def orderedMap(pool, func, iterable, window):
+    """Map func over iterable on the pool in order, keeping window in flight.
+
+    Unlike Pool.imap this only pulls from iterable as results are consumed, so
+    at most window chunks are held in memory at once.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def writeFastq(filltag, outs, args, count=2, size=-1):
+    """Convert filltag lines to the three BGZF fastq outs on a pool."""
+    with multiprocessing.Pool(args.processes) as pool, \
+            open(outs[0], 'wb') as read1, \
+            open(outs[1], 'wb') as read2, \
+            open(outs[2], 'wb') as unpaired:
+        jobs = ((args.prefix, count, lines, args.level) for count, lines in
+                readChunks(filltag, args.chunk_size, count, size))
+        # chunks come back in file order so the BGZF blocks concatenate into
+        # the same fastq the serial converter writes
+        for members in orderedMap(pool, formatChunk, jobs,
+                                  2 * args.processes):
+            for out, member in zip((read1, read2, unpaired), members):
+                out.write(member)
+        for out in (read1, read2, unpaired):
+            out.write(bgzf.EOF)
+
+
+def fastqOuts(args, shard=None):
+    """Return the R1, R2 and unpaired output paths, of a shard if given."""
+    name = args.prefix if shard is None else f"{args.prefix}_shard{shard}"
+    return [os.path.join(args.out, f"{name}_{end}.fq.gz")
+            for end in ("R1", "R2", "unpaired")]
+
+
+def shardManifest(args):
+    """Return the path of the shard manifest."""
+    return os.path.join(args.out, f"{args.prefix}_shards.json")
+
+
+def streamReadsAndCompress(args):
+    """Convert the filltag reads straight to gzipped fastq on a pool."""
+    pathlib.Path(args.out).mkdir(parents=True, exist_ok=True)
+    with openFilltag(args.filltag) as filltag:
+        skipHeader(filltag)
+        writeFastq(filltag, fastqOuts(args), args)
+
+
+def decompress(args, path):
+    """Decompress the gzipped filltag to path, counting its lines.
+
+    Returns (offset, lines before it) checkpoints at every chunk, so lines
+    can be counted up to any offset by reading less than a chunk.
+    """
+    checkpoints = [(0, 0)]
+    with bgzf.open(args.filltag, 'rb', args.processes) as compressed, \
+            open(path, 'wb') as filltag:
+        while True:
+            block = compressed.read(args.chunk_size)
+            if not block:
+                break
+            filltag.write(block)
+            offset, lines = checkpoints[-1]
+            checkpoints.append((offset + len(block),
+                                lines + block.count(b"\n")))
+    return checkpoints
+
+
+def countLines(job):
+    """Return the lines ending in size bytes of the file at path from start."""
+    path, start, size, chunkSize = job
+    lines = 0
+    with open(path, 'rb') as filltag:
+        filltag.seek(start)
+        while size > 0:
+            block = filltag.read(min(chunkSize, size))
+            if not block:
+                break
+            lines += block.count(b"\n")
+            size -= len(block)
+    return lines
+
+
+def planShards(args):
+    """Split the filltag into line aligned byte ranges for a job array.
+
+    A gzipped filltag is first decompressed into the output directory, since
+    only a plain file can be seeked into. Each shard records the count its
+    first read would have in a single pass so the ids are unchanged. The
+    lines before each shard are counted in parallel, in a plain filltag
+    over the shards before it and in a decompressed one only from the last
+    checkpoint decompressing it counted to.
+    """
+    pathlib.Path(args.out).mkdir(parents=True, exist_ok=True)
+    filltagPath = args.filltag
+    checkpoints = None
+    if filltagPath.endswith(".gz"):
+        filltagPath = os.path.join(args.out, f"{args.prefix}_filltags.txt")
+        checkpoints = decompress(args, filltagPath)
+
+    with open(filltagPath, 'rb') as filltag:
+        skipHeader(filltag)
+        bounds = [filltag.tell()]
+        size = os.fstat(filltag.fileno()).st_size
+        for i in range(1, args.plan):
+            target = bounds[0] + i * (size - bounds[0]) // args.plan
+            filltag.seek(max(target - 1, bounds[-1]))
+            filltag.readline()
+            bounds.append(min(filltag.tell(), size))
+        bounds.append(size)
+
+    with multiprocessing.Pool(args.processes) as pool:
+        if checkpoints is None:
+            before = list(itertools.accumulate(pool.map(countLines, [
+                (filltagPath, start, end - start, args.chunk_size)
+                for start, end in zip(bounds, bounds[1:-1])]), initial=0))
+        else:
+            offsets = [offset for offset, _ in checkpoints]
+            marks = [checkpoints[bisect.bisect_right(offsets, start) - 1]
+                     for start in bounds[:-1]]
+            before = [lines + rest for (_, lines), rest in zip(
+                marks, pool.map(countLines, [
+                    (filltagPath, offset, start - offset, args.chunk_size)
+                    for (offset, _), start in zip(marks, bounds)]))]
+    shards = [{"start": start, "size": end - start,
+               "count": 2 + 2 * (lines - before[0])}
+              for start, end, lines in zip(bounds, bounds[1:], before)]
+
+    with open(shardManifest(args), 'w') as manifest:
+        json.dump({"filltag": filltagPath,
+                   "temporary": filltagPath != args.filltag,
+                   "shards": shards}, manifest, indent=1)
+
+
+def convertShard(args):
+    """Convert one planned shard of the filltag to gzipped fastq."""
+    with open(shardManifest(args)) as manifest:
+        plan = json.load(manifest)
+    shard = plan["shards"][args.shard]
+    with open(plan["filltag"], 'rb') as filltag:
+        filltag.seek(shard["start"])
+        writeFastq(filltag, fastqOuts(args, args.shard), args, shard["count"],
+                   shard["size"])
+
+
+def gatherShards(args):
+    """Concatenate the BGZF shard outputs in order and clean up."""
+    with open(shardManifest(args)) as manifest:
+        plan = json.load(manifest)
+    shards = [fastqOuts(args, shard) for shard in range(len(plan["shards"]))]
+    for end, out in enumerate(fastqOuts(args)):
+        bgzf.concatenate([outs[end] for outs in shards], out,
+                         args.chunk_size)
+    for outs in shards:
+        silentremove(*outs)
+    if plan["temporary"]:
+        silentremove(plan["filltag"])
+    silentremove(shardManifest(args))
+
+
 def main():
     """Parse the cmd line and pass arguments to formatter/compresser."""
     parser = argparse.ArgumentParser(
@@ -57,7 +306,55 @@ def main():
     parser.add_argument('filltag', help='The path to the filltag file')
     parser.add_argument('out', help='The output directory')
     parser.add_argument('prefix', help='Prefix for the fasta file')
-    formatReadsAndCompress(parser.parse_args())
+    parser.add_argument(
+        '-s', '--stream',
+        help=('Read the plain or gzipped filltag in chunks and write gzipped '
+              'fastq directly, without uncompressed intermediate files'),
+        action='store_true')
+    parser.add_argument(
+        '--plan',
+        help=('Plan this many line aligned shards of the filltag for a job '
+              'array, decompressing it into the output directory if gzipped'),
+        type=int)
+    parser.add_argument(
+        '--shard',
+        help=('Convert this planned shard, usually $SLURM_ARRAY_TASK_ID, to '
+              'gzipped fastq'),
+        type=int)
+    parser.add_argument(
+        '--gather',
+        help='Concatenate the converted shards into the final gzipped fastq',
+        action='store_true')
+    parser.add_argument(
+        '-p', '--processes',
+        help=('Number of processes used in stream and shard mode. Default: '
+              'all cpus'),
+        type=int,
+        default=len(os.sched_getaffinity(0)))
+    parser.add_argument(
+        '--chunk_size',
+        help='Bytes of filltag parsed per batch',
+        type=int,
+        default=16 * 1024 * 1024)
+    parser.add_argument(
+        '--level',
+        help=('Gzip compression level used in stream and shard mode. '
+              'Default: 6'),
+        type=int,
+        default=6)
+    args = parser.parse_args()
+    if args.plan is not None and args.plan < 1:
+        parser.error("--plan must be at least 1")
+    if args.plan is not None:
+        planShards(args)
+    elif args.shard is not None:
+        convertShard(args)
+    elif args.gather:
+        gatherShards(args)
+    elif args.stream:
+        streamReadsAndCompress(args)
+    else:
+        formatReadsAndCompress(args)
 
 
 if __name__ == "__main__":
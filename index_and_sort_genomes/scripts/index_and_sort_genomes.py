@@ -1,82 +1,104 @@
-"""Takes a path to a genome and indexes it."""
-
-import argparse
-import os
-
-from amaize import jobs, sbatch
-
-
-def parserCmdLine():
-    """Parse the command line options."""
-    parser = argparse.ArgumentParser(
-        description=('Performs the various indexing operations needed for a '
-                     'genome in the customization pipeline'))
-    parser.add_argument(
-        'genome_path',
-        help='The path to the genome')
-    parser.add_argument(
-        'vcf',
-        help='The path to the vcf file')
-    parser.add_argument(
-        'logs',
-        help='Logs output directory',
-        nargs='?',
-        default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                             "logs"))
-    parser.add_argument(
-        '-b', '--bwa_index',
-        help='Perform BWA indexing',
-        action='store_true')
-    parser.add_argument(
-        '-p', '--picard',
-        help='Perform Picard CreateSequenceDictionary indexing',
-        action='store_true')
-    parser.add_argument(
-        '-f', '--faidx',
-        help='Perform Samtools faidx indexing',
-        action='store_true')
-    parser.add_argument(
-        '-s', '--sort_vcf',
-        help='Sort the vcf',
-        action='store_true')
-    return parser.parse_args()
-
-
-def index(args):
-    """Indexes the given genome with the specified indexers."""
-    genome = os.path.basename(args.genome_path).split(".")[0]
-    logs = jobs.outDir(args.logs, genome)
-    vcf = args.vcf.split(".")
-
-    bwa = jobs.tempScript(sbatch.bwaIndexScript())
-    jobs.job(0, args.bwa_index, logs, f"{genome}_bwa_index", bwa.name, genome,
-             0, args.prefix, args.genome_path)
-    os.unlink(bwa.name)
-
-    pic = jobs.tempScript(sbatch.picardIndexScript())
-    jobs.job(0, args.picard, logs, f"{genome}_picard_index", pic.name, genome,
-             0, args.prefix, args.genome_path)
-    os.unlink(pic.name)
-
-    fai = jobs.tempScript(sbatch.faidxScript())
-    jobs.job(0, args.faidx, logs, f"{genome}_faidx", fai.name, genome, 0,
-             args.prefix, args.genome_path)
-    os.unlink(fai.name)
-
-    vcf = jobs.tempScript(sbatch.sortVcfScript())
-    jobs.job(0, args.sort_vcf, logs, f"{genome}_sort_vcf", vcf.name, genome, 0,
-             args.prefix, args.vcf,
-             (vcf[0] + '_sorted.' + vcf[1]), args.genome_path,
-             (vcf[0] + '_sorted_updated.' + vcf[1]))
-    os.unlink(bwa.name)
-
-    os.system("squeue -u maxh")
-
-
-def main():
-    """Parse the command line arguments and pass on to indexing function."""
-    index(parserCmdLine())
-
-
-if __name__ == "__main__":
-    main()
+"""Takes a path to a genome and indexes it."""
+
+import argparse
+import os
+
+from amaize import jobs, sbatch
+from amaize.pipeline import Pipeline
+
+
+def parserCmdLine():
+    """Parse the command line options."""
+    parser = argparse.ArgumentParser(
+        description=('Performs the various indexing operations needed for a '
+                     'genome in the customization pipeline'))
+    parser.add_argument(
+        'genome_path',
+        help='The path to the genome')
+    parser.add_argument(
+        'vcf',
+        help='The path to the vcf file')
+    parser.add_argument(
+        'logs',
+        help='Logs output directory',
+        nargs='?',
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             "logs"))
+    parser.add_argument(
+        '-b', '--bwa_index',
+        help='Perform BWA indexing',
+        action='store_true')
+    parser.add_argument(
+        '-p', '--picard',
+        help='Perform Picard CreateSequenceDictionary indexing',
+        action='store_true')
+    parser.add_argument(
+        '-f', '--faidx',
+        help='Perform Samtools faidx indexing',
+        action='store_true')
+    parser.add_argument(
+        '--external',
+        help=('Index with Picard and Samtools jobs rather than writing the '
+              '.dict and .fai together in one pass'),
+        action='store_true')
+    parser.add_argument(
+        '-s', '--sort_vcf',
+        help='Sort the vcf',
+        action='store_true')
+    parser.add_argument(
+        '--force',
+        help=('Ignore the cache of completed steps and submit every enabled '
+              'step'),
+        action='store_true')
+    parser.add_argument(
+        '--hash_blocks',
+        help=('Number of blocks hashed per file when checking whether '
+              'steps are cached. Default: 0, only size and mtime are used'),
+        type=int,
+        default=0)
+    return parser.parse_args()
+
+
+def index(args):
+    """Indexes the given genome with the specified indexers."""
+    genome = os.path.basename(args.genome_path).split(".")[0]
+    logs = jobs.outDir(args.logs, genome)
+    vcf = args.vcf.split(".")
+    updatedVcf = vcf[0] + '_sorted_updated.' + vcf[1]
+    genomeDict = f"{args.genome_path}.dict"
+
+    steps = Pipeline(genome, logs, cache=not args.force,
+                     blocks=args.hash_blocks, kind="index_and_sort_genomes")
+    steps.add("bwa_index", sbatch.render("bwa_index"), args.genome_path,
+              inputs=[args.genome_path],
+              outputs=[args.genome_path + ext
+                       for ext in (".amb", ".ann", ".bwt", ".pac", ".sa")],
+              run=args.bwa_index)
+    if args.external:
+        steps.add("picard_index", sbatch.render("picard_index"),
+                  args.genome_path, inputs=[args.genome_path],
+                  outputs=[genomeDict], run=args.picard)
+        steps.add("faidx", sbatch.render("faidx"), args.genome_path,
+                  inputs=[args.genome_path],
+                  outputs=[f"{args.genome_path}.fai"], run=args.faidx)
+    else:
+        steps.add("index_fasta", sbatch.render("index_fasta"),
+                  args.genome_path, inputs=[args.genome_path],
+                  outputs=[genomeDict, f"{args.genome_path}.fai"],
+                  run=args.picard or args.faidx)
+    steps.add("sort_vcf", sbatch.render("sort_vcf"), args.vcf,
+              args.genome_path, updatedVcf,
+              inputs=[args.vcf, args.genome_path, genomeDict],
+              outputs=[updatedVcf], run=args.sort_vcf)
+    steps.submit()
+
+    jobs.queue()
+
+
+def main():
+    """Parse the command line arguments and pass on to indexing function."""
+    index(parserCmdLine())
+
+
+if __name__ == "__main__":
+    main()
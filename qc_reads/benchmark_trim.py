@@ -0,0 +1,118 @@
+"""Compare the amaize trimmer with Trimmomatic on the same reads."""
+
+import argparse
+import gzip
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from amaize import trim
+
+
+def syntheticFastq(path, reads, length, seed):
+    """Write gzipped reads whose qualities fall off towards their ends."""
+    rng = random.Random(seed)
+    bases = ["".join(rng.choice("ACGT") for _ in range(length))
+             for _ in range(64)]
+    quals = []
+    for _ in range(64):
+        drop = rng.randrange(length // 2, length + length // 2)
+        quals.append("".join(
+            chr(33 + max(2, min(41, int(rng.gauss(
+                38 if i < drop else 10, 4))))) for i in range(length)))
+    with gzip.open(path, 'wt', compresslevel=1) as out:
+        for i in range(reads):
+            out.write(f"@bench.{i}\n{rng.choice(bases)}\n+\n"
+                      f"{rng.choice(quals)}\n")
+
+
+def timed(func, *args):
+    """Return the result and wall time of a call."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def trimmomatic(jar, threads, forward, reverse, outs):
+    """Trim the reads with the settings of the Trimmomatic step."""
+    subprocess.run(["java", "-jar", jar, "PE", "-threads", str(threads),
+                    forward, reverse, *outs, "LEADING:3", "TRAILING:3",
+                    "SLIDINGWINDOW:4:15", "MINLEN:36"],
+                   check=True, capture_output=True)
+
+
+def countReads(path):
+    """Return the number of reads of a gzipped fastq."""
+    with gzip.open(path, 'rb') as fastq:
+        return sum(1 for _ in fastq) // 4
+
+
+def main():
+    """Time both trimmers on the same read pairs and compare their counts."""
+    parser = argparse.ArgumentParser(
+        description=('Benchmark the amaize trimmer against the Trimmomatic '
+                     'job it replaces, in reads per second'))
+    parser.add_argument(
+        '-f', '--forward',
+        help='Forward reads to trim instead of synthetic reads')
+    parser.add_argument(
+        '-r', '--reverse',
+        help='Reverse reads to trim instead of synthetic reads',
+        required=('-f' in sys.argv or '--forward' in sys.argv))
+    parser.add_argument(
+        '-n', '--reads',
+        help='Number of synthetic read pairs. Default: 200000',
+        type=int,
+        default=200000)
+    parser.add_argument(
+        '-l', '--length',
+        help='Synthetic read length. Default: 150',
+        type=int,
+        default=150)
+    parser.add_argument(
+        '-p', '--processes',
+        help='Processes and Trimmomatic threads. Default: all cpus',
+        type=int,
+        default=len(os.sched_getaffinity(0)))
+    parser.add_argument(
+        '-j', '--jar',
+        help=('The Trimmomatic jar. Default: trimmomatic-0.36.jar in '
+              '$EBROOTTRIMMOMATIC, skipped if missing'),
+        default=os.path.join(os.environ.get("EBROOTTRIMMOMATIC", ""),
+                             "trimmomatic-0.36.jar"))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        forward, reverse = args.forward, args.reverse
+        if not forward:
+            forward = os.path.join(tmp, "bench_1.fq.gz")
+            reverse = os.path.join(tmp, "bench_2.fq.gz")
+            syntheticFastq(forward, args.reads, args.length, 1)
+            syntheticFastq(reverse, args.reads, args.length, 2)
+        native = [os.path.join(tmp, f"native_{i}.fq.gz") for i in range(4)]
+        reads, nativeTime = timed(trim.trimPaired, forward, reverse, native,
+                                  trim.Settings(), args.processes)
+        print(f"{reads} read pairs, {args.processes} processes")
+        print(f"amaize:      {nativeTime:8.3f} s "
+              f"{reads / nativeTime:12.0f} reads/s")
+        if not os.path.exists(args.jar) or not shutil.which("java"):
+            print(f"Trimmomatic not run, {args.jar} or java not found")
+            return
+        old = [os.path.join(tmp, f"trimmomatic_{i}.fq.gz") for i in range(4)]
+        _, oldTime = timed(trimmomatic, args.jar, args.processes, forward,
+                           reverse, old)
+        print(f"trimmomatic: {oldTime:8.3f} s {reads / oldTime:12.0f} reads/s")
+        print(f"speedup:     {oldTime / nativeTime:8.2f}x")
+        for ours, theirs in zip(native, old):
+            counts = countReads(ours), countReads(theirs)
+            if counts[0] != counts[1]:
+                print(f"Read counts differ: {os.path.basename(ours)} "
+                      f"{counts[0]}, {os.path.basename(theirs)} {counts[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-"""Runs fastqc and trimmomatic jobs."""
+"""Runs quality control and trimmomatic jobs."""
 
 import argparse
 import itertools
@@ -6,6 +6,7 @@ import os
 import sys
 
 from amaize import jobs, sbatch
+from amaize.pipeline import Pipeline
 
 
 def baseParser(parser):
@@ -28,6 +29,12 @@ def baseParser(parser):
         'the rest of the name. Defuault: underscore, \"_\"',
         nargs="?",
         default='_')
+    parser.add_argument(
+        '-l', '--array_limit',
+        help=('The most samples of each step run at once. Default: no '
+              'limit'),
+        type=int,
+        default=0)
     parser.add_argument(
         '-q', '--fastqc_raw',
         help=('Perform fastqc on raw reads.'),
@@ -36,10 +43,27 @@ def baseParser(parser):
         '-t', '--trim',
         help='Trim reads with trimmomatic.',
         action='store_true')
+    parser.add_argument(
+        '--trimmomatic',
+        help=('Trim with Trimmomatic instead of the amaize trimmer, which '
+              'applies the same settings.'),
+        action='store_true')
     parser.add_argument(
         '-w', '--fastqc_trimmed',
         help=('Perform fastqc on trimmed reads.'),
         action='store_true')
+    parser.add_argument(
+        '--fastqc',
+        help=('Make FastQC reports instead of the amaize qc summaries, '
+              'which are also merged across samples.'),
+        action='store_true')
+    parser.add_argument(
+        '--single-pass',
+        help=('Trim and summarize the raw and trimmed reads of each sample '
+              'in one job, reading the raw reads once. Requires the amaize '
+              'trimmer and qc summaries.'),
+        dest='single_pass',
+        action='store_true')
     parser.add_argument(
         '--fastqc_out',
         help=('The output directory for fastqc. Required if reads are to be '
@@ -109,92 +133,184 @@ def parseCmdLine():
             args.fastqc_trimmed is None:
         parser.error('At least one of --fastqc_raw, --trim, '
                      '--fastqc_trimmed is requried.')
+    if args.single_pass and (args.fastqc or args.trimmomatic or
+                             not args.trim):
+        parser.error('--single-pass trims with the amaize trimmer, it needs '
+                     '--trim and excludes --fastqc and --trimmomatic.')
 
     return args
 
 
+def sampleGroups(args, fastqs, n):
+    """Group the fastqs n at a time, led by the sample name of the first."""
+    return [(os.path.basename(fastqs[i]).split(args.separator)[0],
+             *fastqs[i:i+n]) for i in range(0, len(fastqs), n)]
+
+
 def fourTrimOut(trimDir, forward, reverse):
     """Create the four output file names for trimmomatic."""
-    sampleF = forward.split(".fq.gz")[0]
-    sampleR = reverse.split(".fq.gz")[0]
+    sampleF = os.path.basename(forward).split(".fq.gz")[0]
+    sampleR = os.path.basename(reverse).split(".fq.gz")[0]
     return (os.path.join(trimDir, f"{sampleF}_paired_trimmed.fq.gz"),
             os.path.join(trimDir, f"{sampleF}_unpaired_trimmed.fq.gz"),
             os.path.join(trimDir, f"{sampleR}_paired_trimmed.fq.gz"),
             os.path.join(trimDir, f"{sampleR}_unpaired_trimmed.fq.gz"))
 
 
-def trimPE(args, prevJob, logs, trimDir, sample, forward, reverse):
-    """Trim paired-end fastq files."""
-    pf, uf, pr, ur = fourTrimOut(trimDir, forward, reverse)
-    tpe = jobs.tempScript(sbatch.trimPEScript())
-    prevJobPE = jobs.job(prevJob, args.trim, logs, "trim_PE", tpe.name, sample,
-                         0, forward, reverse, pf, uf, pr, ur)
-    os.unlink(tpe.name)
-    return (prevJobPE, pf, uf, pr, ur)
-
-
-def trimSE(args, prevJob, logs, trimDir, sample, unpaired):
-    """Trim single-end fastq files."""
-    se = os.path.join(trimDir, f"{unpaired.split('.fq.gz')[0]}_trimmed.fq.gz")
-    tse = jobs.tempScript(sbatch.trimSEScript())
-    prevJobSE = jobs.job(prevJob, args.trim, logs, "trim_SE", tse.name, sample,
-                         0, unpaired, se)
-    os.unlink(tse.name)
-    return (prevJobSE, se)
-
-
-def trim(args, prevJob, outDir, sample, *reads):
-    """Trim fastq files."""
-    trimDir = jobs.outDir(args.trim_out, outDir)
-    logs = jobs.outDir(args.logs, outDir)
-    if len(reads) == 3:
-        prevJobPE, pf, uf, pr, ur = trimPE(
-            args, prevJob, logs, trimDir, sample, reads[0], reads[1])
-        prevJobSE, se = trimSE(args, prevJob, logs, trimDir, sample, reads[2])
-        return (prevJobPE, prevJobSE), (pf, uf, pr, ur, se)
-    elif len(reads) == 2:
-        prevJobPE, pf, uf, pr, ur = trimPE(
-            args, prevJob, logs, trimDir, sample, reads[0], reads[1])
-        return prevJobPE, (pf, uf, pr, ur)
+def summaryPath(args, sample, fastq):
+    """Return the amaize qc summary of a fastq of a sample."""
+    return os.path.join(jobs.outDir(args.fastqc_out, args.kind, sample),
+                        os.path.basename(fastq).split(".fq.gz")[0] +
+                        "_qc.npz")
+
+
+def singlePassQc(args, sample, raws, trimmed):
+    """Return the trimmer options and summaries of a single pass task.
+
+    The raw and trimmed reads are only summarized if their qc was asked for.
+    """
+    options, summaries = [], []
+    for option, run, fastqs in (("--raw_qc", args.fastqc_raw, raws),
+                                ("--trimmed_qc", args.fastqc_trimmed,
+                                 trimmed)):
+        if args.single_pass and run:
+            options += [option, jobs.outDir(args.fastqc_out, args.kind,
+                                            sample)]
+            summaries += [summaryPath(args, sample, fastq)
+                          for fastq in fastqs]
+    return options, summaries
+
+
+def trimPE(args, steps, pairs):
+    """Trim paired-end fastq files, one array task per sample."""
+    outs = [fourTrimOut(jobs.outDir(args.trim_out, args.kind, sample),
+                        forward, reverse)
+            for sample, forward, reverse in pairs]
+    qcs = [singlePassQc(args, sample, (forward, reverse), out)
+           for (sample, forward, reverse), out in zip(pairs, outs)]
+    tasks = [(sample, *options, forward, reverse, *out)
+             for (sample, forward, reverse), out, (options, _) in
+             zip(pairs, outs, qcs)]
+    script = sbatch.render("trimmomatic_pe" if args.trimmomatic else
+                            "trim_pe")
+    steps.add("trim_PE", script, tasks=tasks,
+              inputs=[read for pair in pairs for read in pair[1:]],
+              outputs=[read for out in outs for read in out] +
+              [summary for _, summaries in qcs for summary in summaries],
+              limit=args.array_limit, run=args.trim)
+    return outs
+
+
+def trimSE(args, steps, singles):
+    """Trim single-end fastq files, one array task per sample."""
+    outs = [os.path.join(
+        jobs.outDir(args.trim_out, args.kind, sample),
+        f"{os.path.basename(unpaired).split('.fq.gz')[0]}_trimmed.fq.gz")
+        for sample, unpaired in singles]
+    qcs = [singlePassQc(args, sample, (unpaired,), (out,))
+           for (sample, unpaired), out in zip(singles, outs)]
+    tasks = [(sample, *options, unpaired, out)
+             for (sample, unpaired), out, (options, _) in
+             zip(singles, outs, qcs)]
+    script = sbatch.render("trimmomatic_se" if args.trimmomatic else
+                            "trim_se")
+    steps.add("trim_SE", script, tasks=tasks,
+              inputs=[single[1] for single in singles],
+              outputs=outs +
+              [summary for _, summaries in qcs for summary in summaries],
+              limit=args.array_limit, run=args.trim)
+    return [(out,) for out in outs]
+
+
+def trim(args, steps, groups):
+    """Trim fastq files, returning the trimmed groups."""
+    samples = [group[0] for group in groups]
+    if len(groups[0]) == 4:
+        paired = trimPE(args, steps, [group[:3] for group in groups])
+        single = trimSE(args, steps, [group[::3] for group in groups])
+        return [(sample, *pe, *se)
+                for sample, pe, se in zip(samples, paired, single)]
+    elif len(groups[0]) == 3:
+        return [(sample, *pe) for sample, pe in
+                zip(samples, trimPE(args, steps, groups))]
     else:
-        prevJobSE, se = trimSE(args, prevJob, logs, trimDir, sample, reads)
+        return [(sample, *se) for sample, se in
+                zip(samples, trimSE(args, steps, groups))]
+
+
+def fastqc(args, steps, state, groups, run):
+    """Quality check the given reads, one array task per sample.
+
+    The amaize qc summaries of all samples are then merged into one.
+    """
+    if not run:
+        return
+    tasks = [(sample, jobs.outDir(args.fastqc_out, args.kind, sample),
+              *fastqs) for sample, *fastqs in groups]
+    if args.fastqc:
+        steps.add(f"fastqc_{state}", sbatch.render("fastqc"), tasks=tasks,
+                  inputs=[fastq for task in tasks for fastq in task[2:]],
+                  outputs=[os.path.join(task[1], os.path.basename(
+                      fastq).split(".fq.gz")[0] + "_fastqc.zip")
+                      for task in tasks for fastq in task[2:]],
+                  limit=args.array_limit)
+        return
+    summaries = [summaryPath(args, sample, fastq)
+                 for sample, *fastqs in groups for fastq in fastqs]
+    steps.add(f"qc_{state}", sbatch.render("qc"), tasks=tasks,
+              inputs=[fastq for task in tasks for fastq in task[2:]],
+              outputs=summaries, limit=args.array_limit)
+    mergeQc(args, steps, state, summaries)
+
 
+def mergeQc(args, steps, state, summaries):
+    """Merge the amaize qc summaries of all samples into one."""
+    merged = os.path.join(args.fastqc_out, args.kind, f"{state}_merged_qc")
+    steps.add(f"qc_{state}_merge", sbatch.render("qc_merge"), merged,
+              *summaries, inputs=summaries, outputs=[f"{merged}.npz"])
 
-def fastqc(args, prevJob, outDir, sample, state, *fastqs):
-    """Perform fastqc on the given reads."""
-    fastqcRawOutDir = jobs.outDir(args.fastqc_out, outDir)
-    logs = jobs.outDir(args.logs, outDir)
-    fqc = jobs.tempScript(sbatch.fastqcScript())
-    prevJob = jobs.job(
-        prevJob, args.fastqc_raw, logs, f"fastqc_{state}", fqc.name, sample, 0,
-        fastqcRawOutDir, *fastqs)
-    os.unlink(fqc.name)
-    return prevJob
+
+def singlePass(args, steps, groups):
+    """Trim and summarize the reads of each sample in one job.
+
+    The trimming job of each sample also counts the qc of its raw and
+    trimmed reads, so only the summaries across samples are left to merge.
+    """
+    trimmed = trim(args, steps, groups)
+    for state, run, stateGroups in (("raw", args.fastqc_raw, groups),
+                                    ("trimmed", args.fastqc_trimmed,
+                                     trimmed)):
+        if run:
+            mergeQc(args, steps, state, [
+                summaryPath(args, sample, fastq)
+                for sample, *fastqs in stateGroups for fastq in fastqs])
 
 
 def fastqcTrimFastqc(args, fastqs, n):
-    """Fastqc and trim appropriately."""
-    for i in range(0, len(fastqs), n):
-        sample = os.path.basename(fastqs[i]).split(args.separator)[0]
-        outDir = os.path.join(args.kind, sample)
-        if args.fastqc_raw:
-            prevJob = fastqc(args, 0, outDir, sample, "raw", *fastqs[i:i+n])
-        if args.trim:
-            prevJob, trimmed = trim(args, prevJob, outDir, sample,
-                                    *fastqs[i:i+n])
-            if args.fastqc_trimmed:
-                prevJob = fastqc(args, prevJob, outDir, sample, "trimmed",
-                                 *trimmed)
-        elif args.fastqc_trimmed:
-            fastqc(args, prevJob, outDir, sample, "trimmed", *fastqs[i:i+n])
+    """Fastqc and trim appropriately, one job array per step.
+
+    The raw fastqc and the trimming only share inputs so they run side by
+    side, the trimmed fastqc waits on the trimming of each sample.
+    """
+    groups = sampleGroups(args, fastqs, n)
+    steps = Pipeline(args.kind, jobs.outDir(args.logs, args.kind))
+    if args.single_pass:
+        singlePass(args, steps, groups)
+        steps.submit()
+        return
+    fastqc(args, steps, "raw", groups, args.fastqc_raw)
+    if args.trim:
+        groups = trim(args, steps, groups)
+    fastqc(args, steps, "trimmed", groups, args.fastqc_trimmed)
+    steps.submit()
 
 
 def pipeline(args):
     """Run fastq and trimmomatic appropriately depending on options."""
     fastqs = []
     if args.command == "DIR":
-        fastqs = [file_ for file_ in os.listdir(
-            args.dir) if file_.endswith(".fq.gz")]
+        fastqs = sorted(os.path.join(args.dir, file_) for file_ in
+                        os.listdir(args.dir) if file_.endswith(".fq.gz"))
     elif args.forward and args.reverse and args.unpaired:
         fastqs = list(itertools.chain(
             *zip(args.forward, args.reverse, args.unpaired)))
@@ -203,14 +319,17 @@ def pipeline(args):
     else:
         fastqs = args.unpaired
 
-    if (args.command == "DIR" and args.ends == 1) or \
-            (args.forward and args.reverse and args.unpaired):
+    if args.command == "DIR":
+        fastqcTrimFastqc(args, fastqs, {1: 3, 2: 2}.get(args.ends, 1))
+    elif args.forward and args.reverse and args.unpaired:
         fastqcTrimFastqc(args, fastqs, 3)
-    elif args.ends == 2 or (args.forward and args.reverse):
+    elif args.forward and args.reverse:
         fastqcTrimFastqc(args, fastqs, 2)
     else:
         fastqcTrimFastqc(args, fastqs, 1)
 
+    jobs.queue()
+
 
 def main():
     """Parse cmd line arguments and pass to functions."""
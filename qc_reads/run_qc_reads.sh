@@ -2,17 +2,22 @@
 
 kind=untreated
 
+## every sample goes in one call so each step is submitted as one job array
+reads=""
 for sample in `cat samples.txt`; 
 do
-    python qc_and_trim.py FILES \
-        $kind \
-        --fastqc_raw \
-        --fastqc_out /scratch/maxh/results/fastqc_reports/ \
+    reads="$reads \
         --forward /scratch/maxh/data/${kind}_reads/raw_fastq/${sample}_R1_subset.fq.gz \
         --reverse /scratch/maxh/data/${kind}_reads/raw_fastq/${sample}_R2_subset.fq.gz \
-        --unpaired /scratch/maxh/data/${kind}_reads/raw_fastq/${sample}_unpaired_subset.fq.gz
+        --unpaired /scratch/maxh/data/${kind}_reads/raw_fastq/${sample}_unpaired_subset.fq.gz"
 done 
 
+python qc_and_trim.py FILES \
+    $kind \
+    --fastqc_raw \
+    --fastqc_out /scratch/maxh/results/fastqc_reports/ \
+    $reads
+
 # python scripts/qc_and_trim.py \
 #         $kind \
 #         $sample \